@@ -0,0 +1,61 @@
+import contextlib
+import os
+import time
+
+def write_atomic(path, content):
+    """
+    Replaces a file with new content so that readers see either the old or the new file, never a half written one
+
+    The content is written to a temporary file next to the target, which is then renamed over it. The temporary
+    name includes the process id, so processes writing the same file don't write into each other's temporary file.
+
+    Parameters:
+        path (str): The file to write.
+        content (str or bytes): Text is written as UTF-8.
+
+    Raises:
+        OSError: If the file can't be written.
+    """
+    temporary = f"{path}.{os.getpid()}.tmp"
+    if isinstance(content, str):
+        with open(temporary, "w", encoding="utf-8") as file:
+            file.write(content)
+    else:
+        with open(temporary, "wb") as file:
+            file.write(content)
+    os.replace(temporary, path)
+
+@contextlib.contextmanager
+def file_lock(path, timeout=30.0, stale_seconds=60.0):
+    """
+    Holds a lock shared by all processes that use the same path, for read-modify-write of a shared file
+
+    The lock is a file created next to the path, which works the same on every platform. A lock file older than
+    stale_seconds is left over from a process that crashed and is removed.
+
+    Raises:
+        TimeoutError: If the lock can't be taken within timeout seconds.
+    """
+    lockPath = path + ".lock"
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            os.close(os.open(lockPath, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lockPath) > stale_seconds:
+                    os.remove(lockPath)
+                    continue
+            except OSError:
+                continue
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"Could not lock '{path}' within {timeout:.0f} seconds")
+            time.sleep(0.05)
+    try:
+        yield
+    finally:
+        try:
+            os.remove(lockPath)
+        except OSError:
+            pass
@@ -0,0 +1,385 @@
+"""
+Times each stage of a weather cycle against local stand-ins for FMI, OpenWeatherMap and the SMTP server
+
+Usage:
+    python benchmarks/bench_end_to_end.py [--locations 10 100 1000] [--owm-latency-ms 20] [--owm-error-rate 0.0]
+                                          [--fmi-latency-ms 20] [--fmi-error-rate 0.0] [--output results.jsonl] [--metrics]
+
+The stand-ins are a WFS server that replays a recorded FMI response for every requested place, with a
+configurable rate of 503 errors, an OpenWeatherMap server with a configurable latency and rate of 500 errors, and an SMTP server that accepts and
+discards all mail. The bot is pointed at them with FMI_WFS_URL, OPENWEATHER_URL, SMTP_SERVER and SMTP_PORT, and all
+files it writes go into a temporary directory. Set FMI_RESPONSE_FORMAT=multipointcoverage to time the compact FMI format, and
+FMI_OBSERVATION_MODE=region to time the bounding box query with the nearest station averages. Every location count uses its own location names, so nothing is
+served from the caches of an earlier round, and the history is seeded with a day of observations so the
+historical comparison and the charts have data to work with.
+
+The stages are the ones of tasks.run_weather_cycle: reading the locations, resolving their stations, fetching, storing the history,
+sortDataByCity, calculating the averages, forecasts, charts, send_weather_email and writing the logs. The last
+row is a full run_weather_cycle on a fresh set of locations.
+"""
+import argparse
+import datetime
+import http.server
+import json
+import os
+import random
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# One station of a recorded fmi::observations::weather::simple response, the position is replaced for each place
+FMI_OBSERVATION_MEMBERS = """
+<wfs:member><BsWfs:BsWfsElement gml:id="BsWfsElement.1.1.1"><BsWfs:Location><gml:Point gml:id="BsWfsElementP.1.1.1" srsDimension="2" srsName="http://www.opengis.net/def/crs/EPSG/0/4258"><gml:pos>{position} </gml:pos></gml:Point></BsWfs:Location><BsWfs:Time>{earlier}</BsWfs:Time><BsWfs:ParameterName>t2m</BsWfs:ParameterName><BsWfs:ParameterValue>4.6</BsWfs:ParameterValue></BsWfs:BsWfsElement></wfs:member>
+<wfs:member><BsWfs:BsWfsElement gml:id="BsWfsElement.1.1.2"><BsWfs:Location><gml:Point gml:id="BsWfsElementP.1.1.2" srsDimension="2" srsName="http://www.opengis.net/def/crs/EPSG/0/4258"><gml:pos>{position} </gml:pos></gml:Point></BsWfs:Location><BsWfs:Time>{earlier}</BsWfs:Time><BsWfs:ParameterName>ws_10min</BsWfs:ParameterName><BsWfs:ParameterValue>3.9</BsWfs:ParameterValue></BsWfs:BsWfsElement></wfs:member>
+<wfs:member><BsWfs:BsWfsElement gml:id="BsWfsElement.1.1.3"><BsWfs:Location><gml:Point gml:id="BsWfsElementP.1.1.3" srsDimension="2" srsName="http://www.opengis.net/def/crs/EPSG/0/4258"><gml:pos>{position} </gml:pos></gml:Point></BsWfs:Location><BsWfs:Time>{earlier}</BsWfs:Time><BsWfs:ParameterName>wawa</BsWfs:ParameterName><BsWfs:ParameterValue>10.0</BsWfs:ParameterValue></BsWfs:BsWfsElement></wfs:member>
+<wfs:member><BsWfs:BsWfsElement gml:id="BsWfsElement.1.2.1"><BsWfs:Location><gml:Point gml:id="BsWfsElementP.1.2.1" srsDimension="2" srsName="http://www.opengis.net/def/crs/EPSG/0/4258"><gml:pos>{position} </gml:pos></gml:Point></BsWfs:Location><BsWfs:Time>{latest}</BsWfs:Time><BsWfs:ParameterName>t2m</BsWfs:ParameterName><BsWfs:ParameterValue>4.8</BsWfs:ParameterValue></BsWfs:BsWfsElement></wfs:member>
+<wfs:member><BsWfs:BsWfsElement gml:id="BsWfsElement.1.2.2"><BsWfs:Location><gml:Point gml:id="BsWfsElementP.1.2.2" srsDimension="2" srsName="http://www.opengis.net/def/crs/EPSG/0/4258"><gml:pos>{position} </gml:pos></gml:Point></BsWfs:Location><BsWfs:Time>{latest}</BsWfs:Time><BsWfs:ParameterName>ws_10min</BsWfs:ParameterName><BsWfs:ParameterValue>4.1</BsWfs:ParameterValue></BsWfs:BsWfsElement></wfs:member>
+<wfs:member><BsWfs:BsWfsElement gml:id="BsWfsElement.1.2.3"><BsWfs:Location><gml:Point gml:id="BsWfsElementP.1.2.3" srsDimension="2" srsName="http://www.opengis.net/def/crs/EPSG/0/4258"><gml:pos>{position} </gml:pos></gml:Point></BsWfs:Location><BsWfs:Time>{latest}</BsWfs:Time><BsWfs:ParameterName>wawa</BsWfs:ParameterName><BsWfs:ParameterValue>10.0</BsWfs:ParameterValue></BsWfs:BsWfsElement></wfs:member>"""
+
+FMI_FORECAST_MEMBER = """
+<wfs:member><BsWfs:BsWfsElement><BsWfs:Location><gml:Point><gml:pos>{position} </gml:pos></gml:Point></BsWfs:Location><BsWfs:Time>{time}</BsWfs:Time><BsWfs:ParameterName>{name}</BsWfs:ParameterName><BsWfs:ParameterValue>{value}</BsWfs:ParameterValue></BsWfs:BsWfsElement></wfs:member>"""
+
+FMI_ORIGIN_RESPONSE = """<?xml version="1.0" encoding="UTF-8"?>
+<wfs:FeatureCollection xmlns:wfs="http://www.opengis.net/wfs/2.0" xmlns:om="http://www.opengis.net/om/2.0" xmlns:omso="http://inspire.ec.europa.eu/schemas/omso/3.0" xmlns:gml="http://www.opengis.net/gml/3.2">
+<wfs:member><omso:PointTimeSeriesObservation><om:resultTime><gml:TimeInstant><gml:timePosition>{origin}</gml:timePosition></gml:TimeInstant></om:resultTime></omso:PointTimeSeriesObservation></wfs:member>
+</wfs:FeatureCollection>"""
+
+# A recorded fmi::observations::weather::timevaluepair response cut down to the station FMI picked for the place
+FMI_STATION_RESPONSE = """<?xml version="1.0" encoding="UTF-8"?>
+<wfs:FeatureCollection xmlns:wfs="http://www.opengis.net/wfs/2.0" xmlns:gml="http://www.opengis.net/gml/3.2" xmlns:target="http://xml.fmi.fi/namespace/om/atmosphericfeatures/1.1">
+<wfs:member><target:Location><gml:identifier codeSpace="http://xml.fmi.fi/namespace/stationcode/fmisid">{fmisid}</gml:identifier></target:Location><gml:Point><gml:pos>{position} </gml:pos></gml:Point></wfs:member>
+</wfs:FeatureCollection>"""
+
+FMI_COLLECTION = """<?xml version="1.0" encoding="UTF-8"?>
+<wfs:FeatureCollection xmlns:wfs="http://www.opengis.net/wfs/2.0" xmlns:BsWfs="http://xml.fmi.fi/schema/wfs/2.0" xmlns:gml="http://www.opengis.net/gml/3.2">{members}
+</wfs:FeatureCollection>"""
+
+# The same observations in the format of fmi::observations::weather::multipointcoverage
+FMI_COVERAGE_RESPONSE = """<?xml version="1.0" encoding="UTF-8"?>
+<wfs:FeatureCollection xmlns:wfs="http://www.opengis.net/wfs/2.0" xmlns:gml="http://www.opengis.net/gml/3.2" xmlns:gmlcov="http://www.opengis.net/gmlcov/1.0" xmlns:swe="http://www.opengis.net/swe/2.0">
+<wfs:member><gmlcov:MultiPointCoverage><gml:domainSet><gmlcov:SimpleMultiPoint srsDimension="3"><gmlcov:positions>
+{positions}
+</gmlcov:positions></gmlcov:SimpleMultiPoint></gml:domainSet><gml:rangeSet><gml:DataBlock><gml:doubleOrNilReasonTupleList>
+{values}
+</gml:doubleOrNilReasonTupleList></gml:DataBlock></gml:rangeSet><gmlcov:rangeType><swe:DataRecord><swe:field name="t2m"/><swe:field name="ws_10min"/><swe:field name="wawa"/></swe:DataRecord></gmlcov:rangeType></gmlcov:MultiPointCoverage></wfs:member>
+</wfs:FeatureCollection>"""
+
+class StandInSettings:
+    owm_latency = 0.02
+    owm_error_rate = 0.0
+    fmi_latency = 0.02
+    fmi_error_rate = 0.0
+    requests = {"fmi": 0, "fmi_errors": 0, "owm": 0, "owm_errors": 0}
+    lock = threading.Lock()
+
+def station_id(place):
+    """
+    Gives every place its own station, so batched responses can be split per place
+    """
+    return 100000 + sum(ord(character) * (index + 1) for index, character in enumerate(place))
+
+def station_position(station):
+    number = station - 100000
+    return f"{60 + number % 10000 / 10000:.4f} {24 + number // 10000 % 1000 / 1000:.4f}"
+
+def owm_response(city_id, name):
+    # The city centre is a little off its FMI station, as it is for real places
+    latitude, longitude = (float(part) for part in station_position(city_id).split())
+    return {
+        "id": city_id,
+        "coord": {"lat": round(latitude + 0.03, 4), "lon": round(longitude - 0.02, 4)},
+        "dt": int(time.time()) // 600 * 600,
+        "name": name,
+        "main": {"temp": round(random.uniform(-2, 8), 2)},
+        "wind": {"speed": round(random.uniform(0, 12), 2)},
+        "weather": [{"description": "broken clouds"}],
+    }
+
+def isoformat(moment):
+    return moment.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path.startswith("/wfs") and random.random() < StandInSettings.fmi_error_rate:
+            time.sleep(StandInSettings.fmi_latency)
+            self.count("fmi_errors")
+            self.respond(503, b"Service Unavailable", "text/plain")
+        elif url.path.startswith("/wfs"):
+            time.sleep(StandInSettings.fmi_latency)
+            self.count("fmi")
+            self.respond(200, self.fmi_response(query), "text/xml; charset=UTF-8")
+        elif random.random() < StandInSettings.owm_error_rate:
+            time.sleep(StandInSettings.owm_latency)
+            self.count("owm_errors")
+            self.respond(500, b'{"cod": 500, "message": "Internal error"}', "application/json")
+        else:
+            time.sleep(StandInSettings.owm_latency)
+            self.count("owm")
+            if url.path.startswith("/group"):
+                ids = [int(city_id) for city_id in query["id"][0].split(",")]
+                body = json.dumps({"cnt": len(ids), "list": [owm_response(city_id, str(city_id)) for city_id in ids]})
+            elif "id" in query:
+                body = json.dumps(owm_response(int(query["id"][0]), query["id"][0]))
+            else:
+                name = query.get("q", [""])[0]
+                body = json.dumps(owm_response(station_id(name), name))
+            self.respond(200, body.encode("utf-8"), "application/json")
+
+    def fmi_response(self, query):
+        storedQuery = query.get("storedquery_id", [""])[0]
+        stations = [station_id(place) for place in query.get("place", [])] + [int(fmisid) for fmisid in query.get("fmisid", [])]
+        if "bbox" in query:
+            # A grid of stations over the area the places are in
+            stations = [100000 + latitude + longitude * 10000 for latitude in range(0, 10000, 500) for longitude in range(0, 1000, 50)]
+        now = datetime.datetime.now(datetime.timezone.utc).replace(second=0, microsecond=0)
+        if storedQuery == "fmi::observations::weather::timevaluepair":
+            return FMI_STATION_RESPONSE.format(fmisid=stations[0], position=station_position(stations[0])).encode("utf-8")
+        if storedQuery.endswith("::timevaluepair"):
+            origin = now.replace(hour=now.hour // 3 * 3, minute=0)
+            return FMI_ORIGIN_RESPONSE.format(origin=isoformat(origin)).encode("utf-8")
+
+        if "forecast" in storedQuery:
+            start = now.replace(minute=0)
+            # Forecasts are asked for by coordinates, and each point comes back at the coordinates it was asked for
+            points = [latlon.replace(",", " ") for latlon in query.get("latlon", [])] + [station_position(station) for station in stations]
+            random.shuffle(points)
+            members = [
+                FMI_FORECAST_MEMBER.format(position=point, time=isoformat(start + datetime.timedelta(hours=hour)), name=name, value=value)
+                for point in points
+                for hour in range(49)
+                for name, value in (("Temperature", 3.0 + hour % 5), ("WindSpeedMS", 4.0))
+            ]
+            return FMI_COLLECTION.format(members="".join(members)).encode("utf-8")
+
+        latest = now.replace(minute=now.minute // 10 * 10)
+        earlier = latest - datetime.timedelta(minutes=10)
+        # FMI doesn't promise to keep the requested order, so the stand-in doesn't either
+        random.shuffle(stations)
+        if storedQuery.endswith("::multipointcoverage"):
+            rows = [(station, moment, values) for station in stations for moment, values in ((earlier, "4.6 3.9 10.0"), (latest, "4.8 4.1 10.0"))]
+            return FMI_COVERAGE_RESPONSE.format(
+                positions="\n".join(f"{station_position(station)}  {int(moment.timestamp())}" for station, moment, _ in rows),
+                values="\n".join(values for _, _, values in rows),
+            ).encode("utf-8")
+        members = [
+            FMI_OBSERVATION_MEMBERS.format(position=station_position(station), earlier=isoformat(earlier), latest=isoformat(latest))
+            for station in stations
+        ]
+        return FMI_COLLECTION.format(members="".join(members)).encode("utf-8")
+
+    def count(self, name):
+        with StandInSettings.lock:
+            StandInSettings.requests[name] += 1
+
+    def respond(self, status, body, contentType):
+        self.send_response(status)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """
+    Speaks just enough SMTP to accept a message and throw it away
+    """
+    messages = 0
+
+    def handle(self):
+        self.reply("220 localhost benchmark sink")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode("ascii", "replace").strip().upper()
+            if command.startswith(("EHLO", "HELO")):
+                self.reply("250 localhost")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                SMTPSinkHandler.messages += 1
+                self.reply("250 OK")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+    def reply(self, text):
+        self.wfile.write(text.encode("ascii") + b"\r\n")
+
+def start_server(server):
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def write_workbooks(locations, recipients):
+    from openpyxl import Workbook
+
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.append(["Locations"])
+    for location in locations:
+        sheet.append([location])
+    workbook.save("Locations.xlsx")
+
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.append(["User List", "Role", "Schedule"])
+    for recipient in recipients:
+        sheet.append([recipient, "Recipient", None])
+    workbook.save("Users.xlsx")
+
+def seed_history(history_store, locations, Observation):
+    """
+    Stores a day of 10-minute observations for each location, like a bot that has been running for a while
+    """
+    end = datetime.datetime.now(datetime.timezone.utc).replace(second=0, microsecond=0) - datetime.timedelta(minutes=30)
+    observations = [
+        Observation(location, "Finnish Meteorological Institute", 2.0 + step % 12 / 4, 3.0 + step % 7 / 2, end - datetime.timedelta(minutes=10 * step), wawa=0)
+        for step in range(144, 0, -1)
+        for location in locations
+    ]
+    history_store.append(observations)
+
+def timed(results, stage, function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    results[stage] = (time.perf_counter() - started) * 1000
+    return result
+
+def run_round(tasks, count, recipients):
+    """
+    Runs the stages of one weather cycle for count locations and returns the time of each stage in milliseconds
+    """
+    from calculateAverages import aggregateWeatherData, formatAverages
+    from chartRenderer import collect_charts, shutdown_charts, start_charts
+    from dataHandling import getLocationsFromExcel, sortDataByCity
+    from forecastStore import format_forecasts
+    from historyStore import history_store
+    from logStore import log_store
+    from observation import Observation
+    from weather_bot import send_weather_email
+
+    names = [f"Paikka {count}-{index}" for index in range(count)]
+    write_workbooks(names, recipients)
+    seed_history(history_store, names, Observation)
+
+    results = {}
+    locations = timed(results, "read locations", getLocationsFromExcel, "Locations.xlsx", [])
+    timed(results, "resolve locations", tasks.resolve_locations, locations)
+    openweather_data, weather_institute_data = timed(results, "fetch", tasks.fetch_all_weather_data, locations, "benchmark")
+    historical_means = timed(results, "store history", tasks.store_history, openweather_data + weather_institute_data)
+    fetched = {"OpenWeatherMap": openweather_data, "Finnish Meteorological Institute": weather_institute_data}
+    combined = {source: [data for data in sourceData if data is not None] for source, sourceData in fetched.items()}
+    notices = tasks.describe_missing_data(locations, fetched)
+    sortedData = timed(results, "sortDataByCity", sortDataByCity, combined)
+    averages = timed(results, "calculateAverages", lambda: formatAverages(aggregateWeatherData(sortedData), historical_means))
+    forecasts = timed(results, "forecasts", lambda: format_forecasts(tasks.update_forecasts(locations)))
+    charts = timed(results, "charts", lambda: collect_charts(start_charts(history_store, locations)))
+    shutdown_charts()
+    sent = timed(results, "send_weather_email", send_weather_email, combined, averages, recipients, charts, forecasts, notices)
+    if not sent:
+        raise RuntimeError("The report was not sent")
+    timed(results, "logging", lambda: (log_store.flush(), log_store.export_all()))
+
+    # A full cycle, on locations that have not been fetched before
+    write_workbooks([f"Kokonainen {count}-{index}" for index in range(count)], recipients)
+    timed(results, "run_weather_cycle", tasks.run_weather_cycle, recipients)
+    shutdown_charts()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--locations", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--owm-latency-ms", type=float, default=20)
+    parser.add_argument("--owm-error-rate", type=float, default=0.0)
+    parser.add_argument("--fmi-latency-ms", type=float, default=20)
+    parser.add_argument("--fmi-error-rate", type=float, default=0.0, help="Share of FMI requests answered with 503, 1 for an FMI outage")
+    parser.add_argument("--output", help="Append the results as JSON lines to this file, for comparing runs")
+    parser.add_argument("--metrics", action="store_true", help="Also print the metrics the bot recorded, in the Prometheus text format")
+    args = parser.parse_args()
+
+    StandInSettings.owm_latency = args.owm_latency_ms / 1000
+    StandInSettings.owm_error_rate = args.owm_error_rate
+    StandInSettings.fmi_latency = args.fmi_latency_ms / 1000
+    StandInSettings.fmi_error_rate = args.fmi_error_rate
+
+    web = start_server(http.server.ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler))
+    smtp = start_server(socketserver.ThreadingTCPServer(("127.0.0.1", 0), SMTPSinkHandler))
+    base = f"http://127.0.0.1:{web.server_address[1]}"
+    output = os.path.abspath(args.output) if args.output else None
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # The settings are read when the modules are imported, so they are set before importing tasks
+        os.environ.update({
+            "FMI_WFS_URL": f"{base}/wfs",
+            "OPENWEATHER_URL": f"{base}/weather",
+            "OPENWEATHER_GROUP_URL": f"{base}/group",
+            "LOCATION_CACHE_FILE": os.path.join(workdir, "location_ids.json"),
+            "OPENWEATHER_API_KEY": "benchmark",
+            "SMTP_SERVER": "127.0.0.1",
+            "SMTP_PORT": str(smtp.server_address[1]),
+            "EMAIL_ADDRESS": "bot@example.com",
+            "DEFAULT_ADMINS": "admin@example.com",
+            "LOG_DATABASE": os.path.join(workdir, "logs.db"),
+            "OUTBOX_DATABASE": os.path.join(workdir, "outbox.db"),
+            "HISTORY_DIRECTORY": os.path.join(workdir, "history"),
+            "CHART_CACHE_DIRECTORY": os.path.join(workdir, "chart_cache"),
+            "METRICS_FILE": os.path.join(workdir, "metrics.prom"),
+        })
+        os.chdir(workdir)
+        sys.path.insert(0, REPO)
+        import tasks
+        from mailTransport import outbox
+        from metrics import metrics
+        from errorHandling import flush_notifications
+
+        outbox.start()
+        recipients = ["recipient@example.com"]
+        rounds = {}
+        for count in args.locations:
+            print(f"Running {count} locations...", file=sys.stderr)
+            rounds[count] = run_round(tasks, count, recipients)
+
+        stages = list(next(iter(rounds.values())))
+        print()
+        print(f"{'stage (ms)':<20}" + "".join(f"{count:>12}" for count in args.locations))
+        for stage in stages:
+            print(f"{stage:<20}" + "".join(f"{rounds[count][stage]:>12.1f}" for count in args.locations))
+        print()
+        print(f"Requests: {StandInSettings.requests}, mails received: {SMTPSinkHandler.messages}")
+
+        if output:
+            with open(output, "a", encoding="utf-8") as file:
+                for count, results in rounds.items():
+                    file.write(json.dumps({
+                        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+                        "locations": count,
+                        "owm_latency_ms": args.owm_latency_ms,
+                        "owm_error_rate": args.owm_error_rate,
+                        "stages_ms": results,
+                    }) + "\n")
+        # Error digests are sent while the stand-ins and Users.xlsx still exist
+        flush_notifications()
+        if args.metrics:
+            print()
+            print(metrics.to_prometheus())
+        # The temporary directory is removed, so the metrics can't be written there when the program exits
+        metrics.enabled = False
+        os.chdir(REPO)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Compares the streaming FMI parser with the previous ElementTree parser, and with the parser of the
+multipointcoverage format on the same observations
+
+Usage:
+    python benchmarks/bench_fmi_parser.py [recorded_response.xml ...]
+
+Without arguments, responses of 1, 6 and 24 hours of 10-minute observations for 1 and 20 stations are generated.
+Recorded responses are parsed with the parsers of the simple format only. They can be saved with e.g. curl "https://opendata.fmi.fi/wfs?service=WFS&version=2.0.0&request=getFeature&storedquery_id=fmi::observations::weather::simple&place=Helsinki&parameters=t2m,ws_10min,wawa"
+"""
+import datetime
+import os
+import sys
+import timeit
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from observation import wawa_mapping
+from weatherInstitute import parse_weather_data, parse_weather_data_by_location, parse_coverage_weather_data, parse_coverage_weather_data_by_location
+
+def legacy_parse_weather_data(xml_data, location):
+    """
+    The parser before the streaming rewrite, kept here as the baseline
+    """
+    mapping = dict(wawa_mapping)  # The old parser rebuilt the mapping on every call
+    root = ET.fromstring(xml_data)
+    latest_time = None
+    temperature = None
+    wind_speed = None
+    weather_state = None
+    for element in root.findall(".//{*}BsWfsElement"):
+        obs_time = element.find("{*}Time").text
+        param_name = element.find("{*}ParameterName").text
+        param_value = element.find("{*}ParameterValue").text
+        if latest_time is None or obs_time >= latest_time:
+            latest_time = obs_time
+            if param_name == "t2m":
+                temperature = param_value
+            elif param_name == "ws_10min":
+                wind_speed = param_value
+            elif param_name == "wawa":
+                weather_state = param_value
+    return {
+        "kaupunki": location,
+        "lämpötila": temperature + " Celsius",
+        "säätila": mapping.get(int(float(weather_state)), "Tuntematon säätila"),
+        "tuulen_nopeus": wind_speed + " m/s avarage speed measured in the last 10 minutes",
+    }
+
+def generate_response(stations, hours):
+    """
+    Generates a response in the format of fmi::observations::weather::simple
+    """
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    parts = [
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<wfs:FeatureCollection xmlns:wfs="http://www.opengis.net/wfs/2.0" '
+        'xmlns:BsWfs="http://xml.fmi.fi/schema/wfs/2.0" xmlns:gml="http://www.opengis.net/gml/3.2">'
+    ]
+    for station in range(stations):
+        position = f"{60 + station * 0.1:.5f} {24 + station * 0.1:.5f} "
+        for step in range(hours * 6 + 1):
+            obs_time = (start + datetime.timedelta(minutes=10 * step)).strftime("%Y-%m-%dT%H:%M:%SZ")
+            for name, value in (("t2m", -3.2 + step * 0.1), ("ws_10min", 4.5), ("wawa", 0.0)):
+                parts.append(
+                    f'<wfs:member><BsWfs:BsWfsElement gml:id="BsWfsElement.{station + 1}.{step + 1}.1">'
+                    f'<BsWfs:Location><gml:Point srsDimension="2"><gml:pos>{position}</gml:pos></gml:Point></BsWfs:Location>'
+                    f'<BsWfs:Time>{obs_time}</BsWfs:Time><BsWfs:ParameterName>{name}</BsWfs:ParameterName>'
+                    f'<BsWfs:ParameterValue>{value:.1f}</BsWfs:ParameterValue></BsWfs:BsWfsElement></wfs:member>'
+                )
+    parts.append("</wfs:FeatureCollection>")
+    return "".join(parts).encode("utf-8")
+
+def generate_coverage_response(stations, hours):
+    """
+    Generates the same observations as generate_response in the format of fmi::observations::weather::multipointcoverage
+    """
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    positions = []
+    values = []
+    for station in range(stations):
+        for step in range(hours * 6 + 1):
+            epoch = int((start + datetime.timedelta(minutes=10 * step)).timestamp())
+            positions.append(f"{60 + station * 0.1:.5f} {24 + station * 0.1:.5f}  {epoch}  ")
+            values.append(f"{-3.2 + step * 0.1:.1f} 4.5 0.0 ")
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<wfs:FeatureCollection xmlns:wfs="http://www.opengis.net/wfs/2.0" xmlns:gml="http://www.opengis.net/gml/3.2" '
+        'xmlns:gmlcov="http://www.opengis.net/gmlcov/1.0" xmlns:swe="http://www.opengis.net/swe/2.0">'
+        '<wfs:member><gmlcov:MultiPointCoverage><gml:domainSet><gmlcov:SimpleMultiPoint srsDimension="3">'
+        f'<gmlcov:positions>\n{chr(10).join(positions)}\n</gmlcov:positions></gmlcov:SimpleMultiPoint></gml:domainSet>'
+        f'<gml:rangeSet><gml:DataBlock><gml:doubleOrNilReasonTupleList>\n{chr(10).join(values)}\n</gml:doubleOrNilReasonTupleList>'
+        '</gml:DataBlock></gml:rangeSet><gmlcov:rangeType><swe:DataRecord>'
+        '<swe:field name="t2m"/><swe:field name="ws_10min"/><swe:field name="wawa"/>'
+        '</swe:DataRecord></gmlcov:rangeType></gmlcov:MultiPointCoverage></wfs:member></wfs:FeatureCollection>'
+    ).encode("utf-8")
+
+def bench(label, function, repeat=5):
+    number = 1
+    while timeit.timeit(function, number=number) < 0.2:
+        number *= 2
+    best = min(timeit.repeat(function, number=number, repeat=repeat)) / number
+    print(f"  {label:<22} {best * 1000:9.3f} ms")
+    return best
+
+def main(paths):
+    payloads = []
+    if paths:
+        for path in paths:
+            with open(path, "rb") as file:
+                payloads.append((os.path.basename(path), 1, file.read(), None))
+    else:
+        for stations in (1, 20):
+            for hours in (1, 6, 24):
+                payloads.append((f"{stations} stations, {hours} h", stations, generate_response(stations, hours), generate_coverage_response(stations, hours)))
+
+    for label, stations, payload, coverage in payloads:
+        print(f"{label} ({len(payload) / 1024:.0f} KiB)")
+        if stations == 1:
+            legacy = bench("legacy parser", lambda: legacy_parse_weather_data(payload, "Helsinki"))
+            streaming = bench("streaming parser", lambda: parse_weather_data(payload, "Helsinki"))
+        else:
+            locations = {f"Place {index}": (60 + index * 0.1, 24 + index * 0.1) for index in range(stations)}
+            legacy = bench("legacy parser", lambda: legacy_parse_weather_data(payload, "Helsinki"))
+            streaming = bench("streaming per location", lambda: parse_weather_data_by_location(payload, locations))
+        print(f"  speedup                {legacy / streaming:9.2f}x")
+        if coverage is None:
+            continue
+        print(f"  coverage response      {len(coverage) / 1024:9.0f} KiB")
+        if stations == 1:
+            covered = bench("coverage parser", lambda: parse_coverage_weather_data(coverage, "Helsinki"))
+        else:
+            covered = bench("coverage per location", lambda: parse_coverage_weather_data_by_location(coverage, locations))
+        print(f"  speedup over streaming {streaming / covered:9.2f}x")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,89 @@
+"""
+Measures report rendering time against the number of cities
+
+Usage:
+    python benchmarks/bench_report_render.py [row counts ...]
+
+Compares reportRenderer.render_report with the previous renderer, which built the body with repeated string
+concatenation, and checks that both produce the same HTML for values that need no escaping.
+"""
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from observation import Observation
+from reportRenderer import format_observation, render_report, _REPORT_TEMPLATE
+
+def legacy_render_report(weather_data, averages):
+    """
+    The renderer before reportRenderer, kept here as the baseline
+    """
+    body = _REPORT_TEMPLATE.substitute(notices="", averages="", forecasts="", charts="", sources="")[:-len("</body>")]
+    emailBody = body
+    emailBody += """
+    <h2>Averages:</h2>
+    <table class="averages-table">
+    <tr>
+    """
+    for key in averages[0].keys():
+        emailBody += f"<th>{key.capitalize()}</th>"
+    emailBody += "</tr>"
+    for average in averages:
+        emailBody += "<tr>"
+        for key in average.keys():
+            emailBody += f"<td>{average[key]}</td>"
+        emailBody += "</tr>"
+    emailBody += "</table>"
+    body = emailBody
+    for source, observations in weather_data.items():
+        data = [format_observation(observation) for observation in observations]
+        body += f"<h2>Source: {source}</h2>"
+        body += "<table border='1'><tr>"
+        headers = data[0].keys()
+        for key in headers:
+            body += f"<th>{key.capitalize()}</th>"
+        body += "</tr>"
+        for city_data in data:
+            body += "<tr>"
+            for key in headers:
+                body += f"<td>{city_data[key]}</td>"
+            body += "</tr>"
+        body += "</table>"
+    body += "</body>"
+    return body
+
+def make_report(rows):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    weather_data = {
+        "OpenWeatherMap": [Observation(f"Kaupunki {index}", "OpenWeatherMap", -1.5, 3.2, now, condition="clear sky") for index in range(rows)],
+        "Finnish Meteorological Institute": [Observation(f"Kaupunki {index}", "Finnish Meteorological Institute", -1.2, 3.6, now, wawa=0) for index in range(rows)],
+    }
+    averages = [
+        {"kaupunki": f"Kaupunki {index}", "Keskimääräinen lämpötila": "-1.4 Celsius", "Keskimääräinen Tuulen nopeus": "3.4 m/s", "Säätila": "Selkeää"}
+        for index in range(rows)
+    ]
+    return weather_data, averages
+
+def best_time(function, repeat=5):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+def main(rowCounts):
+    print(f"{'rows':>7} {'legacy ms':>12} {'renderer ms':>12} {'speedup':>8}")
+    for rows in rowCounts:
+        weather_data, averages = make_report(rows)
+        if render_report(weather_data, averages) != legacy_render_report(weather_data, averages):
+            raise SystemExit(f"Output differs from the legacy renderer at {rows} rows")
+        legacy = best_time(lambda: legacy_render_report(weather_data, averages))
+        current = best_time(lambda: render_report(weather_data, averages))
+        print(f"{rows:>7} {legacy * 1000:>12.2f} {current * 1000:>12.2f} {legacy / current:>7.2f}x")
+
+if __name__ == "__main__":
+    main([int(count) for count in sys.argv[1:]] or [10, 100, 1000, 10000])
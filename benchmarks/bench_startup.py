@@ -0,0 +1,152 @@
+"""
+Measures the cold start of the bot: import time of each module and time to the first weather request
+
+Usage:
+    python benchmarks/bench_startup.py [--runs N]
+
+Every measurement runs in a fresh Python process. The first request is made against a local stand-in for the
+weather APIs, so the time measured is from process start until the first HTTP request arrives.
+The script exits with status 1 if a median is over its budget, see "Startup budget" in README.md.
+"""
+import argparse
+import http.server
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Budgets for the median of the runs, in milliseconds. Each is the measured median with about a 50 % margin,
+# so an import that slips back into module level shows up as over budget.
+IMPORT_BUDGET_MS = {
+    "tasks": 300,
+    "weatherInstitute": 50,
+    "calculateAverages": 5,
+    "dataHandling": 30,
+    "errorHandling": 50,
+    "weather_bot": 50,
+}
+FIRST_FETCH_BUDGET_MS = 450
+
+FMI_RESPONSE = b"""<?xml version="1.0" encoding="UTF-8"?>
+<wfs:FeatureCollection xmlns:wfs="http://www.opengis.net/wfs/2.0" xmlns:BsWfs="http://xml.fmi.fi/schema/wfs/2.0" xmlns:gml="http://www.opengis.net/gml/3.2">
+<wfs:member><BsWfs:BsWfsElement><BsWfs:Location><gml:Point><gml:pos>60.17 24.94 </gml:pos></gml:Point></BsWfs:Location><BsWfs:Time>2024-01-01T00:00:00Z</BsWfs:Time><BsWfs:ParameterName>t2m</BsWfs:ParameterName><BsWfs:ParameterValue>-1.0</BsWfs:ParameterValue></BsWfs:BsWfsElement></wfs:member>
+<wfs:member><BsWfs:BsWfsElement><BsWfs:Location><gml:Point><gml:pos>60.17 24.94 </gml:pos></gml:Point></BsWfs:Location><BsWfs:Time>2024-01-01T00:00:00Z</BsWfs:Time><BsWfs:ParameterName>ws_10min</BsWfs:ParameterName><BsWfs:ParameterValue>3.0</BsWfs:ParameterValue></BsWfs:BsWfsElement></wfs:member>
+<wfs:member><BsWfs:BsWfsElement><BsWfs:Location><gml:Point><gml:pos>60.17 24.94 </gml:pos></gml:Point></BsWfs:Location><BsWfs:Time>2024-01-01T00:00:00Z</BsWfs:Time><BsWfs:ParameterName>wawa</BsWfs:ParameterName><BsWfs:ParameterValue>0.0</BsWfs:ParameterValue></BsWfs:BsWfsElement></wfs:member>
+</wfs:FeatureCollection>"""
+
+OPENWEATHER_RESPONSE = json.dumps({
+    "dt": 1704067200,
+    "main": {"temp": -1.5},
+    "wind": {"speed": 2.5},
+    "weather": [{"description": "clear sky"}],
+}).encode("utf-8")
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    first_request = None
+
+    def do_GET(self):
+        if StandInHandler.first_request is None:
+            StandInHandler.first_request = time.time()
+        body = FMI_RESPONSE if self.path.startswith("/wfs") else OPENWEATHER_RESPONSE
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def run_python(code, env=None):
+    """
+    Runs code in a fresh interpreter, from an empty directory so no files are written into the repository
+    """
+    with tempfile.TemporaryDirectory() as workdir:
+        environment = dict(os.environ, PYTHONPATH=REPO, **(env or {}))
+        return subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            cwd=workdir, env=environment, capture_output=True, text=True,
+        )
+
+def import_time_ms(module):
+    """
+    Gets the cumulative import time of a module from the -X importtime report
+    """
+    result = run_python(f"import {module}")
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    for line in result.stderr.splitlines():
+        parts = [part.strip() for part in line.split("|")]
+        if len(parts) == 3 and parts[2] == module:
+            return int(parts[1]) / 1000
+    raise RuntimeError(f"No import time reported for {module}")
+
+def heaviest_imports(module, count=8):
+    result = run_python(f"import {module}")
+    entries = []
+    for line in result.stderr.splitlines():
+        parts = [part.strip() for part in line.split("|")]
+        if len(parts) == 3 and parts[1].isdigit():
+            entries.append((int(parts[1]) / 1000, parts[2]))
+    return sorted(entries, reverse=True)[:count]
+
+def time_to_first_fetch_ms():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    StandInHandler.first_request = None
+    try:
+        started = time.time()
+        result = run_python(
+            "import tasks; tasks.fetch_all_weather_data(['Helsinki'], 'key')",
+            env={"FMI_WFS_URL": f"{base}/wfs", "OPENWEATHER_URL": f"{base}/weather"},
+        )
+        if result.returncode != 0 or StandInHandler.first_request is None:
+            raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr else "No request was made")
+        return (StandInHandler.first_request - started) * 1000
+    finally:
+        server.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    overBudget = []
+
+    print("Import time (median of fresh processes)")
+    for module, budget in IMPORT_BUDGET_MS.items():
+        try:
+            median = statistics.median(import_time_ms(module) for _ in range(args.runs))
+        except RuntimeError as e:
+            print(f"  {module:<20} failed: {e}")
+            overBudget.append(module)
+            continue
+        status = "ok" if median <= budget else "OVER BUDGET"
+        print(f"  {module:<20} {median:8.1f} ms  (budget {budget} ms) {status}")
+        if median > budget:
+            overBudget.append(module)
+
+    print("Heaviest imports of tasks")
+    for cumulative, name in heaviest_imports("tasks"):
+        print(f"  {name:<40} {cumulative:8.1f} ms")
+
+    try:
+        median = statistics.median(time_to_first_fetch_ms() for _ in range(args.runs))
+        status = "ok" if median <= FIRST_FETCH_BUDGET_MS else "OVER BUDGET"
+        print(f"Time to first fetch  {median:8.1f} ms  (budget {FIRST_FETCH_BUDGET_MS} ms) {status}")
+        if median > FIRST_FETCH_BUDGET_MS:
+            overBudget.append("first fetch")
+    except RuntimeError as e:
+        print(f"Time to first fetch failed: {e}")
+        overBudget.append("first fetch")
+
+    sys.exit(1 if overBudget else 0)
+
+if __name__ == "__main__":
+    main()
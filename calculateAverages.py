@@ -1,48 +1,121 @@
-import re
+import math
 
-def calculateAverages(weatherDataPerCity):
+# Order in which the sources are trusted for the weather state, the first source that has a state is used
+state_priority = ["Finnish Meteorological Institute", "OpenWeatherMap"]
+
+# Weight of each source in the means, sources that are not listed get a weight of 1
+source_weights = {}
+
+def aggregateWeatherData(sortedData, weights=None):
     """
-    Merge data from different sources, averaging numerical values where possible and 
-    keeping unique values otherwise.
+    Builds a cities × sources table of the observations and calculates its statistics with array operations
+
+    Sources that are missing for a city are NaN in the table and are left out of that city's statistics.
+
+    Parameters:
+        sortedData (dict): The observations of each city, as returned by sortDataByCity.
+        weights (dict): Weight of each source in the means, defaults to source_weights.
+
+    Returns:
+        dict: The cities, sources and weather states, and the mean, min, max and spread of the
+        temperature and wind speed as arrays with one value per city.
     """
-    temps = []
-    windSpeeds = []
-    weatherStates = []
-
-    for city in weatherDataPerCity:
-        # Extract and convert temperatures, handling any units (like "Celsius")
-        temps.append(parse_temperature(city.get("lämpötila", "0")))
-        windSpeeds.append(city.get("tuulen_nopeus", "0"))
-        weatherStates.append(city.get("säätila", "Ei tietoa"))
-
-    averagesInData = {
-        "kaupunki" : city["kaupunki"],
-        "Keskimääräinen lämpötila" : f"{sum(temps) / 2:.1f} Celsius",
-        "Keskimääräinen Tuulen nopeus" : f"{sum_wind_speed(windSpeeds)} m/s",
-        "Säätila" : weatherStates[1] if weatherStates is not None else "Unknown",
-    }
+    import numpy as np
+
+    cities = list(sortedData.keys())
+    sources = []
+    sourceIndex = {}
+    for observations in sortedData.values():
+        for observation in observations:
+            if observation.source not in sourceIndex:
+                sourceIndex[observation.source] = len(sources)
+                sources.append(observation.source)
+
+    shape = (len(cities), len(sources))
+    temperatures = np.full(shape, np.nan)
+    windSpeeds = np.full(shape, np.nan)
+    states = []
+
+    for row, observations in enumerate(sortedData.values()):
+        statesBySource = {}
+        for observation in observations:
+            column = sourceIndex[observation.source]
+            temperatures[row, column] = observation.temperature
+            windSpeeds[row, column] = observation.wind_speed
+            statesBySource[observation.source] = observation.description
+        states.append(__pickWeatherState(statesBySource))
+
+    weights = source_weights if weights is None else weights
+    sourceWeights = np.array([weights.get(source, 1.0) for source in sources], dtype=float)
+
+    result = {"cities": cities, "sources": sources, "states": states}
+    for name, values in (("temperature", temperatures), ("wind_speed", windSpeeds)):
+        statistics = __statistics(values, sourceWeights)
+        for statistic, column in statistics.items():
+            result[f"{name}_{statistic}"] = column
+    return result
 
-    return averagesInData
+def formatAverages(aggregated, historical_means=None):
+    """
+    Formats the aggregated statistics into the rows shown in the report
+    """
+    rows = []
+    for index, city in enumerate(aggregated["cities"]):
+        rows.append({
+            "kaupunki": city,
+            "Keskimääräinen lämpötila": __formatValue(aggregated["temperature_mean"][index], "Celsius"),
+            "Keskimääräinen Tuulen nopeus": __formatValue(aggregated["wind_speed_mean"][index], "m/s"),
+            "Säätila": aggregated["states"][index],
+            "Lämpötila min–max": __formatRange(aggregated["temperature_min"][index], aggregated["temperature_max"][index], "Celsius"),
+            "Tuulen nopeus min–max": __formatRange(aggregated["wind_speed_min"][index], aggregated["wind_speed_max"][index], "m/s"),
+        })
+        if historical_means is not None:
+            rows[-1]["Poikkeama historiallisesta lämpötilasta"] = __formatDeviation(aggregated["temperature_mean"][index], historical_means.get(city))
+    return rows
 
-def parse_temperature(temp_str):
+def __statistics(values, sourceWeights):
     """
-    Parses temperature data
+    Calculates the NaN-aware weighted mean, min, max and spread of each row
     """
-    # Remove any non-numeric parts (e.g., " Celsius") and convert to float
-    try:
-        return float(temp_str.split()[0])  # Extract numerical part if formatted like "20 Celsius"
-    except (ValueError, IndexError):
-        return None
-
-def sum_wind_speed(data):
-    total_speed = 0.0
-    variable = data
-    for tuulen_nopeus in data:
-        match = re.search(r"[-+]?\d*\.?\d+", tuulen_nopeus)  # Finds the first decimal or whole number in the string
-        
-        # If a number is found, convert it to float and add it to total_speed
-        if match:
-            speed = float(match.group())
-            total_speed += speed
-
-    return f"{total_speed:1.1f}"
\ No newline at end of file
+    import numpy as np
+
+    present = ~np.isnan(values)
+    rowWeights = present * sourceWeights
+    totalWeights = rowWeights.sum(axis=1)
+    filled = np.where(present, values, 0.0)
+    hasData = totalWeights > 0
+
+    mean = np.full(values.shape[0], np.nan)
+    np.divide((filled * rowWeights).sum(axis=1), totalWeights, out=mean, where=hasData)
+
+    # fmin and fmax skip NaN values without warning about rows that have no data at all
+    minimum = np.fmin.reduce(values, axis=1, initial=np.inf)
+    maximum = np.fmax.reduce(values, axis=1, initial=-np.inf)
+    anyPresent = present.any(axis=1)
+    minimum[~anyPresent] = np.nan
+    maximum[~anyPresent] = np.nan
+
+    return {
+        "mean": mean,
+        "min": minimum,
+        "max": maximum,
+        "spread": maximum - minimum,
+        "count": present.sum(axis=1),
+    }
+
+def __pickWeatherState(statesBySource):
+    for source in state_priority:
+        if source in statesBySource:
+            return statesBySource[source]
+    return next(iter(statesBySource.values()), "Ei tietoa")
+
+def __formatValue(value, unit):
+    return "Ei tietoa" if math.isnan(value) else f"{value:.1f} {unit}"
+
+def __formatRange(minimum, maximum, unit):
+    return "Ei tietoa" if math.isnan(minimum) else f"{minimum:.1f}–{maximum:.1f} {unit}"
+
+def __formatDeviation(value, historicalMean):
+    if historicalMean is None or math.isnan(value):
+        return "Ei tietoa"
+    return f"{value - historicalMean:+.1f} Celsius"
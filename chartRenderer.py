@@ -0,0 +1,177 @@
+import datetime
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+import config
+from atomicFile import write_atomic
+
+# Hours of history shown in each chart
+chart_hours = int(os.getenv("CHART_HOURS", "48"))
+
+# Number of processes drawing charts
+chart_workers = int(os.getenv("CHART_WORKERS", "2"))
+
+# Most charts in one report, the rest are left out so the email stays small and the charts are ready in time
+chart_max_count = int(os.getenv("CHART_MAX_COUNT", "50"))
+
+# Most bytes of PNG images in one report, base64 makes them a third larger, so the default stays well under the
+# 25 MB limit of most mail servers
+chart_max_bytes = int(os.getenv("CHART_MAX_BYTES", str(10 * 1024 * 1024)))
+
+# Rendered charts are kept here, named by the hash of the data they show
+chart_cache_directory = os.getenv("CHART_CACHE_DIRECTORY", "chart_cache")
+
+# Changing how charts look must change the hash, so charts drawn by an older version are not reused
+_CHART_VERSION = b"2"
+
+_pool = None
+
+def start_charts(history, cities, end=None):
+    """
+    Starts drawing the temperature and wind speed chart of each city from its history
+
+    Charts whose data hasn't changed since they were last drawn are read from the cache, the rest are drawn in
+    a process pool while the rest of the cycle runs. Only the first CHART_MAX_COUNT cities get a chart. Collect
+    the results with collect_charts.
+
+    Parameters:
+        history (HistoryStore): The history the charts are drawn from.
+        cities (list): The cities to draw charts for.
+        end (datetime): End of the charts, defaults to now.
+
+    Returns:
+        dict: A cached PNG image or a future of one for each city that has history to show, None for the cities
+        left over the maximum.
+    """
+    end = end or datetime.datetime.now(datetime.timezone.utc)
+    start = end - datetime.timedelta(hours=chart_hours)
+    _pruneCache()
+    pending = {}
+    started = 0
+    # The history of every city is read in one pass over the day partitions
+    histories = history.query_many(cities, ("temperature", "wind_speed"), start, end)
+    for city in cities:
+        if city not in histories or len(histories[city][0]) < 2:
+            continue
+        if started >= chart_max_count:
+            pending[city] = None
+            continue
+        started += 1
+        times, values = histories[city]
+        # Only plain lists are sent to the worker processes
+        seconds = times.astype("int64").tolist()
+        temperatures = values["temperature"].astype(float).tolist()
+        windSpeeds = values["wind_speed"].astype(float).tolist()
+
+        path = os.path.join(chart_cache_directory, f"{_dataHash(city, seconds, temperatures, windSpeeds)}.png")
+        if os.path.exists(path):
+            with open(path, "rb") as file:
+                pending[city] = file.read()
+            os.utime(path)
+            continue
+        pending[city] = _getPool().submit(_drawChart, city, seconds, temperatures, windSpeeds, path)
+    return pending
+
+def collect_charts(pending, timeout=30):
+    """
+    Waits for the charts started with start_charts
+
+    A chart that fails, isn't ready within the timeout or would take the images over CHART_MAX_BYTES is left
+    out of the report.
+
+    Returns:
+        dict: The PNG image of each city's chart.
+    """
+    deadline = datetime.datetime.now() + datetime.timedelta(seconds=timeout)
+    charts = {}
+    size = 0
+    for city, chart in pending.items():
+        if chart is None:
+            continue
+        try:
+            if not isinstance(chart, bytes):
+                chart = chart.result(timeout=max(0, (deadline - datetime.datetime.now()).total_seconds()))
+            if size + len(chart) > chart_max_bytes:
+                print(f"Chart of {city} would make the report too large, it is left out of the report.")
+                continue
+            size += len(chart)
+            charts[city] = chart
+        except TimeoutError:
+            print(f"Chart of {city} was not ready in time, it is left out of the report.")
+        except Exception as e:
+            print(f"Failed to draw the chart of {city}: {e}")
+    return charts
+
+def shutdown_charts():
+    """
+    Stops the chart processes
+    """
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+        _pool = None
+
+def _getPool():
+    global _pool
+    if _pool is None:
+        import multiprocessing
+
+        # Forking a process whose outbox and log threads are running can deadlock the child, so workers are spawned
+        _pool = ProcessPoolExecutor(max_workers=chart_workers, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+def _pruneCache():
+    """
+    Removes charts that haven't been used for a day, the data of every city changes at least that often
+    """
+    if not os.path.isdir(chart_cache_directory):
+        return
+    expired = datetime.datetime.now().timestamp() - 86400
+    for name in os.listdir(chart_cache_directory):
+        path = os.path.join(chart_cache_directory, name)
+        try:
+            if os.path.getmtime(path) < expired:
+                os.remove(path)
+        except OSError:
+            continue
+
+def _dataHash(city, seconds, temperatures, windSpeeds):
+    digest = hashlib.sha256(_CHART_VERSION)
+    digest.update(city.encode("utf-8"))
+    digest.update(repr((seconds, temperatures, windSpeeds)).encode("ascii"))
+    return digest.hexdigest()
+
+def _drawChart(city, seconds, temperatures, windSpeeds, path):
+    """
+    Draws one city's chart and saves it into the cache, runs in a worker process
+    """
+    import io
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.dates as mdates
+    import matplotlib.pyplot as plt
+
+    times = [datetime.datetime.fromtimestamp(second, datetime.timezone.utc) for second in seconds]
+    figure, temperatureAxis = plt.subplots(figsize=(8, 3), dpi=100)
+    try:
+        temperatureAxis.plot(times, temperatures, ".", color="#D9534F", markersize=3)
+        temperatureAxis.set_ylabel("Lämpötila (Celsius)", color="#D9534F")
+        windAxis = temperatureAxis.twinx()
+        windAxis.plot(times, windSpeeds, ".", color="#007BFF", markersize=3)
+        windAxis.set_ylabel("Tuulen nopeus (m/s)", color="#007BFF")
+        temperatureAxis.xaxis.set_major_formatter(mdates.DateFormatter("%d.%m. %H:%M"))
+        temperatureAxis.tick_params(axis="x", labelrotation=30)
+        temperatureAxis.set_title(city)
+        # Fixed margins, working them out with tight_layout takes longer than drawing the chart
+        figure.subplots_adjust(left=0.08, right=0.92, bottom=0.25, top=0.9)
+
+        buffer = io.BytesIO()
+        figure.savefig(buffer, format="png")
+    finally:
+        plt.close(figure)
+
+    image = buffer.getvalue()
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    write_atomic(path, image)
+    return image
@@ -0,0 +1,10 @@
+"""
+Loads the .env file once for the whole bot
+
+Modules that read environment variables when they are imported import this module first,
+so the variables are set no matter which module is imported first.
+"""
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
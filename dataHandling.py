@@ -1,22 +1,25 @@
-from RPA.Excel.Files import Files
-from openpyxl import Workbook
+import os
+import threading
+
+from metrics import metrics
+from notificationRules import parse_rule
+
+# Parsed rows of each workbook, with the modification time and size of the file they were read from
+__workbookCache = {}
+__workbookCacheLock = threading.Lock()
 
 def getLocationsFromExcel(excelFileName:str,default_locations):
     """
     Gets location data from Locations.xlsx
     Locations.xlsx is structured so that the first line is for headers and the rest are made up of location names
-    """
-    locations = []
-    excel = Files()
 
+    The file is only read again when it has been changed since the last call.
+    """
     try:
-        excel.open_workbook(excelFileName)        
-        locationsEnd = excel.find_empty_row();
-        for row in range(2, locationsEnd):
-            excelRow = excel.get_cell_value(row,"A")
-            if __emptyRowSkipper(excelRow):
-                locations.append(excelRow)
+        rows = __readWorkbookRows(excelFileName)
     except FileNotFoundError:
+        from openpyxl import Workbook
+
         # Create a new workbook and select the active sheet
         workbook = Workbook()
         sheet = workbook.active
@@ -29,46 +32,35 @@ def getLocationsFromExcel(excelFileName:str,default_locations):
         
         workbook.save(excelFileName)
 
-        locations = default_locations
+        return list(default_locations)
 
     except Exception as e:
         raise ValueError(f"An error occurred while accessing '{excelFileName}': {e}")
 
-    finally:
-        try:
-            excel.close_workbook()
-        except Exception as e:
-            print(f"Failed to close workbook: {e}")
-    
-    return locations;
+    return [row[0] for row in rows if __emptyRowSkipper(row[0])]
 
 def getRecipienEmails(excelFileName, administrators):
     """
     Fetches the list of recipient emails from an excel document
-    """
-    recipients = []
-    excel = Files()
 
+    The file is only read again when it has been changed since the last call.
+    """
     try:
-        excel.open_workbook(excelFileName)
-
-        last_row = excel.find_empty_row()
-
-        for row in range(2, last_row):
-            email = excel.get_cell_value(row,"A")
-            if __emptyRowSkipper(email):
-                recipients.append(email)
+        rows = __readWorkbookRows(excelFileName)
     except FileNotFoundError:
+        from openpyxl import Workbook
+
         # If the file is missing, create a new workbook with a default structure
         workbook = Workbook()
         sheet = workbook.active
 
         # Set header values
-        sheet["A1"] = "Email"
+        sheet["A1"] = "User List"
         sheet["B1"] = "Role"
         
         # Populate default user emails with "Administrator" role
-        for i, email in enumerate(administrators, start=2):
+        recipients = []
+        for i, email in enumerate(__splitAddresses(administrators), start=2):
             sheet[f"A{i}"] = email
             sheet[f"B{i}"] = "Administrator"
             recipients.append(email)  # Add to recipients list
@@ -76,19 +68,133 @@ def getRecipienEmails(excelFileName, administrators):
         # Save the new workbook
         workbook.save(excelFileName)
 
+        return recipients
+
     except Exception as e:
         raise ValueError(f"An error occurred while reading '{excelFileName}': {e}")
 
-    finally:
+    return [row[0] for row in rows if __emptyRowSkipper(row[0])]
+
+def getRecipientSchedules(excelFileName, administrators):
+    """
+    Gets the report schedule of each recipient from the "Schedule" column (C) of Users.xlsx
+
+    The schedule is a cron-like expression such as "0 7 * * 1" (07:00 every Monday), see scheduler.CronSchedule.
+
+    Returns:
+        dict: The schedule of each recipient email, None for recipients without a schedule of their own.
+    """
+    recipients = getRecipienEmails(excelFileName, administrators)
+    try:
+        rows = __readWorkbookRows(excelFileName)
+    except FileNotFoundError:
+        return {email: None for email in recipients}
+
+    schedules = {}
+    for row in rows:
+        if __emptyRowSkipper(row[0]):
+            schedule = row[2] if len(row) > 2 else None
+            schedules[row[0]] = str(schedule).strip() if __emptyRowSkipper(schedule) else None
+    return {email: schedules.get(email) for email in recipients}
+
+def getAdministrators(excelFileName="Users.xlsx"):
+    """
+    Gets the emails of the users whose role is "Administrator" (case insensitive)
+
+    Returns:
+        list: The administrator emails, or an empty list if the file can't be read.
+    """
+    try:
+        rows = __readWorkbookRows(excelFileName)
+    except FileNotFoundError:
+        print(f"Error: '{excelFileName}' file not found.")
+        return []
+    except Exception as e:
+        print(f"An unexpected error occurred: {e}")
+        return []
+
+    admin_emails = [
+        row[0] for row in rows
+        if __emptyRowSkipper(row[0]) and len(row) > 1 and str(row[1] or "").strip().lower() == "administrator"
+    ]
+    if not admin_emails:
+        print("No administrators found.")
+    return admin_emails
+
+def getNotificationRules(excelFileName="Rules.xlsx"):
+    """
+    Gets the users' notification rules from Rules.xlsx
+
+    The columns are Email, City, Parameter (temperature or wind_speed), Condition (>, >=, < or <=) and Threshold,
+    so a row "user@example.com | Espoo | wind_speed | > | 15" means "wind > 15 m/s in Espoo".
+
+    Returns:
+        tuple: The rules, and the row numbers and errors of the rows that could not be read.
+        There are no rules if the file doesn't exist.
+    """
+    try:
+        rows = __readWorkbookRows(excelFileName)
+    except FileNotFoundError:
+        return [], []
+
+    rules = []
+    invalid = []
+    # The rows start below the header, on row 2 of the sheet
+    for rowNumber, row in enumerate(rows, start=2):
+        if not __emptyRowSkipper(row[0]):
+            continue
         try:
-            excel.close_workbook()
-        except Exception as e:
-            print(f"Failed to close workbook: {e}")
+            if len(row) < 5:
+                raise ValueError("Row should have Email, City, Parameter, Condition and Threshold")
+            rules.append(parse_rule(*row[:5]))
+        except ValueError as e:
+            invalid.append((rowNumber, str(e)))
+    return rules, invalid
+
+def __readWorkbookRows(excelFileName):
+    """
+    Reads the rows below the header of the first sheet of a workbook
+
+    The rows are read in one read-only pass and kept in memory, and the file is read again only
+    when its modification time or size changes, so edits made to the file are picked up on the next call.
+    """
+    stat = os.stat(excelFileName)
+    signature = (stat.st_mtime_ns, stat.st_size)
 
-    return recipients
+    with __workbookCacheLock:
+        cached = __workbookCache.get(excelFileName)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+    from openpyxl import load_workbook
+
+    with metrics.span("excel_read_seconds", file=os.path.basename(excelFileName)):
+        workbook = load_workbook(excelFileName, read_only=True, data_only=True)
+        try:
+            rows = [
+                tuple(value.strip() if isinstance(value, str) else value for value in row)
+                for row in workbook.worksheets[0].iter_rows(min_row=2, values_only=True)
+                if row
+            ]
+        finally:
+            workbook.close()
+
+    with __workbookCacheLock:
+        __workbookCache[excelFileName] = (signature, rows)
+    return rows
+
+def __splitAddresses(addresses):
+    """
+    Turns a comma separated string of addresses, like DEFAULT_ADMINS, into a list
+    """
+    if addresses is None:
+        return []
+    if isinstance(addresses, str):
+        addresses = addresses.split(",")
+    return [address.strip() for address in addresses if address and address.strip()]
 
 def __emptyRowSkipper(value):
-    if value is None: return False;
+    if value is None or value == "": return False;
     return True;
 
 def sortDataByCity(sources):
@@ -99,7 +205,7 @@ def sortDataByCity(sources):
 
     for source in sources.values():
         for cityData in source:
-            city_name = cityData["kaupunki"]
+            city_name = cityData.city
             
             # Check if the city already has an entry in the dictionary
             if city_name in dataSortedByCity:
@@ -1,21 +1,20 @@
 import os
-import pandas
-from openpyxl import load_workbook
+import atexit
+import html
+import queue
+import threading
+import time
 from datetime import datetime
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from dotenv import load_dotenv
 
-from weather_bot import log_email_send
-
-load_dotenv()
+import config
+from logStore import log_store
+from mailTransport import outbox
+from dataHandling import getAdministrators
+from metrics import metrics
 
 #Default admins
 defaultAdmins = os.getenv("DEFAULT_ADMINS")
 
-errorLogFilePath = "error_log.xlsx";
-
 #defines error_info
 error_info = {
     "errLVL": "Error",
@@ -23,11 +22,22 @@ error_info = {
     "errMsg": "File not found",
 }
 
+# Identical errors reported within this many seconds are sent to the administrators as one digest
+notification_window = int(os.getenv("ERROR_NOTIFICATION_WINDOW", "300"))
+
+__notificationQueue = queue.Queue()
+__pendingErrors = {}
+__pendingLock = threading.Lock()
+__notifierThread = None
+
 
 def reportErrorData(errorLVL,error,tb):
     """
         Used for logging errors in the application
 
+        The error is written to the error log right away. The administrators are notified from a background
+        thread, which collects identical errors for notification_window seconds and sends them as one digest.
+
         Parameters:
             errorLVL:
                 Should be a string that indicates how critical an error is
@@ -36,24 +46,27 @@ def reportErrorData(errorLVL,error,tb):
             tb:
                 TB is used for getting information on where the error occured. This is what should be given to this part excluding the quotation marks(""), "traceback.extract_tb(e.__traceback__)"
     """
-    error_info["errLVL"] = str(errorLVL);
-    error_info["errMsg"] = str(error)        
+    # Every call gets its own copy, since errors can be reported from several fetch threads at once
+    details = dict(error_info)
+    details["errLVL"] = str(errorLVL);
+    details["errMsg"] = str(error)        
     
     if(isinstance(tb,str)):
-        error_info["errLocation"] = tb;
+        details["errLocation"] = tb;
     else:
         # Use traceback to capture the file name and line number
         file_path, line_number = tb[-1].filename, tb[-1].lineno
 
         # Extract just the file name
         file_name = os.path.basename(file_path)
-        error_info["errLocation"] = f"{file_name}, line {line_number}"     
+        details["errLocation"] = f"{file_name}, line {line_number}"     
             
-    __logErrorToExcel(error_info)
+    metrics.increment("errors_reported_total", level=details["errLVL"])
+    __logError(details)
 
-def __logErrorToExcel(error_details={"errMsg":"No message defined","errLVL":"unknown", "errLocation":"unknown file and row"}):
+def __logError(error_details={"errMsg":"No message defined","errLVL":"unknown", "errLocation":"unknown file and row"}):
     """
-    Write error message in error_log.xlsx
+    Write error message in the error log, which is exported to error_log.xlsx, and queue it for the administrators
     Parameters:
         error_details should contain all the data that is needed for logging the info into excel.
         This would include the following:
@@ -70,30 +83,93 @@ def __logErrorToExcel(error_details={"errMsg":"No message defined","errLVL":"unk
         "Location": "data_processing.py, line 54",
         "Error Message": "File not found",
     }
-    logErrorToExcel(error_info)
+    logError(error_info)
     """
-    try:
-        workbook = load_workbook(errorLogFilePath)
-        sheet = workbook.active
-    except FileNotFoundError:
-        from openpyxl import Workbook
-        workbook = Workbook()
-        sheet = workbook.active
-        # Write headers if file is new
-        sheet.append(["Timestamp", "Error Level", "Location","Error Message"])
-    # Append error details as a new row
-    currentTime = datetime.now().strftime("%Y-%m-%d %H:%M:%S");
-    sheet.append([
-        currentTime,
+    # Append error details as a new row, error_log.xlsx is exported from the log store
+    log_store.append("error_log", [
         error_details.get("errLVL", ""),
         error_details.get("errLocation",""),
         error_details.get("errMsg", ""),
     ])
 
-    # Save the workbook
-    workbook.save(errorLogFilePath)
+    __startNotifier()
+    __notificationQueue.put((datetime.now(), dict(error_details)))
 
-    errorContent = f"""
+def flush_notifications():
+    """
+    Sends the digest of the errors collected so far without waiting for the window to end
+    """
+    # Takes in the errors that the worker hasn't picked up yet
+    while True:
+        try:
+            __collectError(*__notificationQueue.get_nowait())
+        except queue.Empty:
+            break
+
+    with __pendingLock:
+        pending = dict(__pendingErrors)
+        __pendingErrors.clear()
+    if pending:
+        __notifyAdministrator(__formatDigest(pending), f"There have been {sum(error['count'] for error in pending.values())} errors, while making Weather Report")
+
+def __startNotifier():
+    global __notifierThread
+    with __pendingLock:
+        if __notifierThread is None:
+            __notifierThread = threading.Thread(target=__notificationWorker, name="error-notifier", daemon=True)
+            __notifierThread.start()
+            atexit.register(flush_notifications)
+
+def __notificationWorker():
+    """
+    Collects queued errors by (level, location, message) and sends one digest per notification window
+    """
+    windowEnd = None
+    while True:
+        timeout = None if windowEnd is None else max(0.0, windowEnd - time.monotonic())
+        try:
+            reportedAt, details = __notificationQueue.get(timeout=timeout)
+        except queue.Empty:
+            pass
+        else:
+            __collectError(reportedAt, details)
+            if windowEnd is None:
+                windowEnd = time.monotonic() + notification_window
+
+        if windowEnd is not None and time.monotonic() >= windowEnd:
+            windowEnd = None
+            try:
+                flush_notifications()
+            except Exception as e:
+                print(f"Failed to notify administrators: {e}")
+
+def __collectError(reportedAt, details):
+    """
+    Adds an error to the pending digest, counting it with the identical errors already there
+    """
+    key = (details.get("errLVL", ""), details.get("errLocation", ""), details.get("errMsg", ""))
+    with __pendingLock:
+        pending = __pendingErrors.setdefault(key, {"count": 0, "first": reportedAt})
+        pending["count"] += 1
+        pending["last"] = reportedAt
+
+def __formatDigest(pending):
+    """
+    Forms the HTML body of a digest, with one row per distinct error
+    """
+    rows = []
+    for (level, location, message), error in sorted(pending.items(), key=lambda item: item[1]["first"]):
+        rows.append(f"""
+        <tr>
+            <td>{error["first"].strftime("%Y-%m-%d %H:%M:%S")}</td>
+            <td>{error["last"].strftime("%Y-%m-%d %H:%M:%S")}</td>
+            <td>{error["count"]}</td>
+            <td>{html.escape(level)}</td>
+            <td>{html.escape(location)}</td>
+            <td>{html.escape(message)}</td>
+        </tr>""")
+
+    return f"""
     <!DOCTYPE html>
     <html>
     <head>
@@ -119,106 +195,42 @@ def __logErrorToExcel(error_details={"errMsg":"No message defined","errLVL":"unk
 
     <table>
         <tr>
-            <th>Timestamp</th>
-            <td>{currentTime}</td>
-        </tr>
-        <tr>
+            <th>First Seen</th>
+            <th>Last Seen</th>
+            <th>Occurrences</th>
             <th>Error Level</th>
-            <td>{error_details.get("errLVL", "")}</td>
-        </tr>
-        <tr>
             <th>Location</th>
-            <td>{error_details.get("errLocation", "")}</td>
-        </tr>
-        <tr>
             <th>Error Message</th>
-            <td>{error_details.get("errMsg", "")}</td>
-        </tr>
+        </tr>{"".join(rows)}
     </table>
 
     </body>
     </html>
     """
-    __notifyAdministrator(errorContent)
 
-def __notifyAdministrator(body):
-    print("Notifying...")
+def __notifyAdministrator(body, subject="There has been an error, while making Weather Report"):
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
 
-    admin_emails = __getAdministrators();
+    print("Notifying...")
 
-    smtp_server = "smtp.gmail.com"
-    smtp_port = 587
+    admin_emails = getAdministrators("Users.xlsx");
     sender_email = os.getenv("EMAIL_ADDRESS")
-    sender_password = os.getenv("EMAIL_PASSWORD")
-
 
-    if admin_emails is []:
-        admin_emails = defaultAdmins
+    if not admin_emails:
+        admin_emails = [email.strip() for email in (defaultAdmins or "").split(",") if email.strip()]
         msg = MIMEMultipart()
         msg['From'] = sender_email
         msg['To'] = ", ".join(admin_emails)
         msg['Subject'] = "No administrators found in Users.xlsx"
-        body = "The Users.xlsx file does not contain any administrators. Default administrators have been notified."
-        msg.attach(MIMEText(body, 'plain'))
-        try:
-            with smtplib.SMTP(smtp_server, smtp_port) as server:
-                server.starttls()  # Secure the connection
-                server.login(sender_email, sender_password)
-                server.sendmail(sender_email, admin_emails, msg.as_string())
-            print("Email sent successfully.")
-            log_email_send("Success", body)  # Log success if email is sent
-        except Exception as e:
-            print(f"Failed to send email: {e}")
-            log_email_send("Failed", body)  # Log failure if email is not sent
-
-    # Compose the email
+        notice = "The Users.xlsx file does not contain any administrators. Default administrators have been notified."
+        msg.attach(MIMEText(notice, 'plain'))
+        outbox.queue(msg, admin_emails)
+
+    # Compose the email, the outbox sends it over the shared connection and logs the result
     msg = MIMEMultipart()
     msg['From'] = sender_email
     msg['To'] = ", ".join(admin_emails)
-    msg['Subject'] = "There has been an error, while making Weather Report"
+    msg['Subject'] = subject
     msg.attach(MIMEText(body, 'html'))
-    try:
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()  # Secure the connection
-            server.login(sender_email, sender_password)
-            server.sendmail(sender_email, admin_emails, msg.as_string())
-        print("Email sent successfully.")
-        log_email_send("Success", body)  # Log success if email is sent
-    except Exception as e:
-        print(f"Failed to send email: {e}")
-        log_email_send("Failed", body)  # Log failure if email is not sent
-
-def __getAdministrators():
-    """
-    Gets a list of all administrator emails
-    """
-    print("Getting administrators...")
-
-    try:
-            # Read the Excel file into a DataFrame
-            df = pandas.read_excel("Users.xlsx")
-            
-            # Check the columns (for reference)
-            print("Columns in the file:", df.columns.tolist())
-
-            # Filter rows where the Role is "administrator" (case insensitive)
-            admins = df[df["Role"].str.lower() == "administrator"]
-
-            # Extract the email addresses from the filtered DataFrame
-            admin_emails = admins["User List"].tolist()
-
-            # Check if any administrators were found
-            if not admin_emails:
-                print("No administrators found.")
-            
-            return admin_emails
-
-    except FileNotFoundError:
-        print("Error: 'Users.xlsx' file not found.")
-        return []
-    except KeyError as e:
-        print(f"Error: Missing expected column in the spreadsheet: {e}")
-        return []
-    except Exception as e:
-        print(f"An unexpected error occurred: {e}")
-        return []
\ No newline at end of file
+    outbox.queue(msg, admin_emails)
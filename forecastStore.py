@@ -0,0 +1,142 @@
+import datetime
+import math
+import os
+import threading
+import time
+
+import config
+
+# How often FMI is asked whether a new model run has been published, in minutes
+forecast_check_minutes = int(os.getenv("FORECAST_CHECK_MINUTES", "30"))
+
+# Hours ahead shown in the forecast table of the report
+forecast_report_hours = (6, 12, 24, 48)
+
+class ForecastStore:
+    """
+    The latest forecast of each location, together with the origin time of the model run it came from
+
+    Forecasts change only when FMI publishes a new model run, a few times a day. The store remembers which run
+    each location's forecast is from, so only locations that don't have the latest run yet need to be fetched.
+    When a file path is given, the forecasts are also kept in a shelve file and survive a restart.
+    """
+
+    def __init__(self, path=None, check_minutes=forecast_check_minutes):
+        self.path = path
+        self.check_seconds = check_minutes * 60
+        self._forecasts = None
+        self._latestOrigin = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def latest_origin(self, probe):
+        """
+        Gets the origin time of the newest model run, asking FMI with probe at most once per check interval
+
+        Parameters:
+            probe (callable): Gets the origin time of the newest model run from FMI.
+        """
+        with self._lock:
+            if self._latestOrigin is None or time.time() - self._checked >= self.check_seconds:
+                origin = probe()
+                self._checked = time.time()
+                if origin is not None:
+                    self._latestOrigin = origin
+            return self._latestOrigin
+
+    def outdated(self, locations, origin):
+        """
+        Gets the locations that have no forecast from the given model run
+        """
+        with self._lock:
+            forecasts = self._load()
+            return [location for location in locations if location not in forecasts or forecasts[location][0] != origin]
+
+    def put(self, origin, forecasts):
+        """
+        Stores the forecasts of the given model run
+
+        Parameters:
+            origin (datetime): Origin time of the model run.
+            forecasts (dict): The (time, temperature, wind speed) points of each location.
+        """
+        with self._lock:
+            stored = self._load()
+            for location, points in forecasts.items():
+                stored[location] = (origin, points)
+            if self.path:
+                self._writeToDisk({location: stored[location] for location in forecasts})
+
+    def get(self, locations):
+        """
+        Gets the stored forecasts of the given locations
+
+        Returns:
+            dict: The origin time and points of each location that has a forecast.
+        """
+        with self._lock:
+            forecasts = self._load()
+            return {location: forecasts[location] for location in locations if location in forecasts}
+
+    def _load(self):
+        if self._forecasts is None:
+            self._forecasts = {}
+            if self.path:
+                import shelve
+
+                try:
+                    with shelve.open(self.path) as disk:
+                        self._forecasts = dict(disk)
+                except Exception as e:
+                    print(f"Failed to read the forecast file: {e}")
+        return self._forecasts
+
+    def _writeToDisk(self, forecasts):
+        import shelve
+
+        try:
+            with shelve.open(self.path) as disk:
+                disk.update(forecasts)
+        except Exception as e:
+            print(f"Failed to write the forecast file: {e}")
+
+def format_forecasts(forecasts, now=None, hours=forecast_report_hours):
+    """
+    Formats the forecasts into the rows of the forecast table of the report
+
+    Parameters:
+        forecasts (dict): The origin time and points of each location, as returned by ForecastStore.get.
+        now (datetime): The time the hours ahead are counted from, defaults to now.
+        hours (tuple): The hours ahead shown in the table.
+
+    Returns:
+        list: One row per location.
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    rows = []
+    for location, (origin, points) in forecasts.items():
+        row = {"kaupunki": location}
+        for hour in hours:
+            row[f"+{hour} h"] = __formatPoint(__closestPoint(points, now + datetime.timedelta(hours=hour)))
+        row["Ennuste laadittu"] = origin.astimezone().strftime("%d.%m. %H:%M")
+        rows.append(row)
+    return rows
+
+def __closestPoint(points, moment):
+    """
+    Gets the point closest to moment, if it is within an hour of it
+    """
+    closest = min(points, key=lambda point: abs(point[0] - moment), default=None)
+    if closest is None or abs(closest[0] - moment) > datetime.timedelta(hours=1):
+        return None
+    return closest
+
+def __formatPoint(point):
+    if point is None or math.isnan(point[1]):
+        return "Ei tietoa"
+    if math.isnan(point[2]):
+        return f"{point[1]:.1f} Celsius"
+    return f"{point[1]:.1f} Celsius, {point[2]:.1f} m/s"
+
+# Forecasts shared by the weather task, backed by a file if FORECAST_FILE is set
+forecast_store = ForecastStore(path=os.getenv("FORECAST_FILE") or None)
@@ -0,0 +1,388 @@
+import datetime
+import json
+import os
+import threading
+
+import config
+from atomicFile import write_atomic
+
+# Columns of the store and the type each is stored as. Times are seconds from the start of the partition's day (UTC).
+history_columns = {
+    "time": "<i4",
+    "location": "<i4",
+    "source": "<i1",
+    "temperature": "<f4",
+    "wind_speed": "<f4",
+    "wawa": "<i2",
+}
+
+# Parameters that can be queried, the other columns describe the observation
+history_parameters = ("temperature", "wind_speed", "wawa")
+
+# Value stored for a missing wawa code
+_MISSING_WAWA = -1
+
+class HistoryStore:
+    """
+    Columnar store of every observation, partitioned by day
+
+    Each day is a directory with one append-only binary file per column, so adding a cycle's observations is
+    a few small appends. Finished days can be compacted into one compressed .npz file, which keeps years of
+    10-minute data small on disk. Location and source names are stored once in dictionary.json and referred
+    to by number in the columns.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+        self._dictionary = None
+        self._latest = None
+
+    def append(self, observations):
+        """
+        Stores observations, skipping those that are not newer than the last stored one of the same location and source
+
+        Observations of days that have already been compacted are skipped, a provider can report a stale time for
+        a station that lags behind.
+
+        Returns:
+            int: The number of observations stored.
+        """
+        import numpy as np
+
+        with self._lock:
+            dictionary = self._loadDictionary()
+            if self._latest is None:
+                self._latest = self._loadLatest(dictionary)
+            partitions = {}
+            latest = {}
+            compacted = {}
+            skipped = 0
+            for observation in observations:
+                if observation is None:
+                    continue
+                timestamp = observation.timestamp.astimezone(datetime.timezone.utc)
+                key = (observation.city, observation.source)
+                previous = latest.get(key, self._latest.get(key))
+                if previous is not None and timestamp <= previous:
+                    continue
+
+                day = timestamp.date()
+                if day not in compacted:
+                    compacted[day] = os.path.exists(self._partitionPath(day) + ".npz")
+                if compacted[day]:
+                    skipped += 1
+                    continue
+                latest[key] = timestamp
+
+                dayStart = datetime.datetime.combine(day, datetime.time(), datetime.timezone.utc)
+                columns = partitions.setdefault(day, {column: [] for column in history_columns})
+                columns["time"].append(int((timestamp - dayStart).total_seconds()))
+                columns["location"].append(self._id(dictionary, "locations", observation.city))
+                columns["source"].append(self._id(dictionary, "sources", observation.source))
+                columns["temperature"].append(observation.temperature)
+                columns["wind_speed"].append(observation.wind_speed)
+                columns["wawa"].append(_MISSING_WAWA if observation.wawa is None else observation.wawa)
+
+            if skipped:
+                print(f"Skipped {skipped} observations of days that have already been compacted.")
+            if not partitions:
+                return 0
+
+            self._saveDictionary(dictionary)
+            for day, columns in partitions.items():
+                directory = self._partitionPath(day)
+                os.makedirs(directory, exist_ok=True)
+                for column, dtype in history_columns.items():
+                    with open(os.path.join(directory, column), "ab") as file:
+                        np.asarray(columns[column], dtype=dtype).tofile(file)
+            # Only now that the rows are on disk, so a failed write leaves them to be stored on the next append
+            self._latest.update(latest)
+            return sum(len(columns["time"]) for columns in partitions.values())
+
+    def query(self, location, parameter, start, end, source=None):
+        """
+        Gets the values of a parameter of a location between two times
+
+        Parameters:
+            location (str): The location name.
+            parameter (str): One of history_parameters.
+            start (datetime): Start of the range, inclusive.
+            end (datetime): End of the range, exclusive.
+            source (str): Only return observations of this source, by default all sources are returned.
+
+        Returns:
+            tuple: The times as a numpy datetime64[s] array and the values, both sorted by time.
+        """
+        import numpy as np
+
+        times, values = [], []
+        for data in self._scan(start, end, location, source, (parameter,)):
+            times.append(data["timestamps"])
+            values.append(data[parameter])
+        if not times:
+            return np.array([], dtype="datetime64[s]"), np.array([], dtype=history_columns[parameter])
+
+        times = np.concatenate(times)
+        values = np.concatenate(values)
+        order = np.argsort(times, kind="stable")
+        return times[order], values[order]
+
+    def query_many(self, locations, parameters, start, end, source=None):
+        """
+        Gets the values of several parameters of several locations, reading each day partition only once
+
+        Returns:
+            dict: For each location that has observations in the range, the times sorted by time and a dictionary of the values of each parameter.
+        """
+        import numpy as np
+
+        wanted = set(locations)
+        dictionary = self._loadDictionary()
+        ids = np.array([index for index, name in enumerate(dictionary["locations"]) if name in wanted], dtype="<i4")
+        chunks = [data for data in self._scan(start, end, None, source, tuple(parameters)) if len(data["location"])]
+        if not chunks or not len(ids):
+            return {}
+
+        times = np.concatenate([data["timestamps"] for data in chunks])
+        locationIds = np.concatenate([data["location"] for data in chunks])
+        values = {parameter: np.concatenate([data[parameter] for data in chunks]) for parameter in parameters}
+        keep = np.isin(locationIds, ids)
+        # Sorted by location and then time, so each location is one contiguous slice
+        order = np.lexsort((times[keep], locationIds[keep]))
+        times, locationIds = times[keep][order], locationIds[keep][order]
+        values = {parameter: columnValues[keep][order] for parameter, columnValues in values.items()}
+
+        result = {}
+        uniqueIds, starts = np.unique(locationIds, return_index=True)
+        ends = list(starts[1:]) + [len(locationIds)]
+        for locationId, first, last in zip(uniqueIds, starts, ends):
+            result[dictionary["locations"][locationId]] = (
+                times[first:last],
+                {parameter: columnValues[first:last] for parameter, columnValues in values.items()},
+            )
+        return result
+
+    def rollup(self, location, parameter, start, end, bucket_seconds=86400, statistic="mean", source=None):
+        """
+        Aggregates the values of a parameter of a location into fixed time buckets
+
+        Parameters:
+            bucket_seconds (int): Length of each bucket, counted from start.
+            statistic (str): "mean", "min", "max" or "count".
+
+        Returns:
+            tuple: The start time of each bucket as datetime64[s], and the statistic of each bucket (NaN for empty buckets).
+        """
+        import numpy as np
+
+        times, values = self.query(location, parameter, start, end, source)
+        bucketCount = max(1, int(-(-(end - start).total_seconds() // bucket_seconds)))
+        starts = np.datetime64(_utcNaive(start), "s") + np.arange(bucketCount) * np.timedelta64(bucket_seconds, "s")
+        values = values.astype(float)
+        if parameter == "wawa":
+            values[values == _MISSING_WAWA] = np.nan
+        valid = ~np.isnan(values)
+        indexes = ((times - starts[0]) // np.timedelta64(bucket_seconds, "s")).astype(int)[valid]
+        values = values[valid]
+
+        counts = np.bincount(indexes, minlength=bucketCount).astype(float)
+        if statistic == "count":
+            return starts, counts
+        result = np.full(bucketCount, np.nan)
+        if statistic == "mean":
+            sums = np.bincount(indexes, weights=values, minlength=bucketCount)
+            np.divide(sums, counts, out=result, where=counts > 0)
+        elif statistic in ("min", "max"):
+            fill = np.inf if statistic == "min" else -np.inf
+            reduced = np.full(bucketCount, fill)
+            (np.minimum if statistic == "min" else np.maximum).at(reduced, indexes, values)
+            result[counts > 0] = reduced[counts > 0]
+        else:
+            raise ValueError(f"Unknown statistic '{statistic}'")
+        return starts, result
+
+    def location_means(self, parameter, start, end, source=None):
+        """
+        Gets the mean of a parameter for every location at once between two times
+
+        Returns:
+            dict: The mean of each location that has observations in the range.
+        """
+        import numpy as np
+
+        dictionary = self._loadDictionary()
+        locationCount = len(dictionary["locations"])
+        sums = np.zeros(locationCount)
+        counts = np.zeros(locationCount)
+        for data in self._scan(start, end, None, source, (parameter,)):
+            values = data[parameter].astype(float)
+            valid = ~np.isnan(values) if parameter != "wawa" else values != _MISSING_WAWA
+            sums += np.bincount(data["location"][valid], weights=values[valid], minlength=locationCount)[:locationCount]
+            counts += np.bincount(data["location"][valid], minlength=locationCount)[:locationCount]
+        return {
+            name: float(sums[index] / counts[index])
+            for index, name in enumerate(dictionary["locations"])
+            if counts[index] > 0
+        }
+
+    def compact(self, before):
+        """
+        Compresses every uncompacted day before the given date into a single .npz file
+
+        Returns:
+            int: The number of days compacted.
+        """
+        import numpy as np
+
+        compacted = 0
+        with self._lock:
+            for day in self._days():
+                directory = self._partitionPath(day)
+                if day >= before or not os.path.isdir(directory):
+                    continue
+                columns = self._readDirectory(directory)
+                np.savez_compressed(directory + ".npz", **columns)
+                for column in history_columns:
+                    os.remove(os.path.join(directory, column))
+                os.rmdir(directory)
+                compacted += 1
+        return compacted
+
+    def _scan(self, start, end, location, source, parameters):
+        """
+        Yields the times, locations and the given parameters of the matching rows of each day partition between start and end
+        """
+        import numpy as np
+
+        dictionary = self._loadDictionary()
+        locationId = dictionary["locations"].index(location) if location in dictionary["locations"] else None
+        sourceId = dictionary["sources"].index(source) if source in dictionary["sources"] else None
+        if (location is not None and locationId is None) or (source is not None and sourceId is None):
+            return
+
+        startSeconds = np.datetime64(_utcNaive(start), "s")
+        endSeconds = np.datetime64(_utcNaive(end), "s")
+        day = _utcNaive(start).date()
+        lastDay = _utcNaive(end).date()
+        while day <= lastDay:
+            columns = self._readPartition(day)
+            if columns is not None and len(columns["time"]):
+                timestamps = np.datetime64(day, "s") + columns["time"].astype("timedelta64[s]")
+                mask = (timestamps >= startSeconds) & (timestamps < endSeconds)
+                if locationId is not None:
+                    mask &= columns["location"] == locationId
+                if sourceId is not None:
+                    mask &= columns["source"] == sourceId
+                if mask.any():
+                    data = {parameter: columns[parameter][mask] for parameter in parameters}
+                    data["timestamps"] = timestamps[mask]
+                    data["location"] = columns["location"][mask]
+                    yield data
+            day += datetime.timedelta(days=1)
+
+    def _loadLatest(self, dictionary):
+        """
+        Gets the last stored time of each location and source from the newest partition, so observations stored
+        before a restart are not stored again
+        """
+        import numpy as np
+
+        days = self._days()
+        if not days:
+            return {}
+        day = days[-1]
+        directory = self._partitionPath(day)
+        if os.path.exists(directory + ".npz"):
+            with np.load(directory + ".npz") as data:
+                columns = {column: data[column] for column in ("time", "location", "source")}
+        else:
+            columns = self._readDirectory(directory)
+        dayStart = datetime.datetime.combine(day, datetime.time(), datetime.timezone.utc)
+        latest = {}
+        for seconds, location, source in zip(columns["time"].tolist(), columns["location"].tolist(), columns["source"].tolist()):
+            key = (dictionary["locations"][location], dictionary["sources"][source])
+            timestamp = dayStart + datetime.timedelta(seconds=seconds)
+            if key not in latest or timestamp > latest[key]:
+                latest[key] = timestamp
+        return latest
+
+    def _readPartition(self, day):
+        import numpy as np
+
+        directory = self._partitionPath(day)
+        if os.path.exists(directory + ".npz"):
+            with np.load(directory + ".npz") as data:
+                return {column: data[column] for column in history_columns}
+        if os.path.isdir(directory):
+            with self._lock:
+                return self._readDirectory(directory)
+        return None
+
+    def _readDirectory(self, directory):
+        import numpy as np
+
+        columns = {}
+        for column, dtype in history_columns.items():
+            path = os.path.join(directory, column)
+            columns[column] = np.fromfile(path, dtype=dtype) if os.path.exists(path) else np.array([], dtype=dtype)
+        # An append that was interrupted can leave some columns longer than others
+        rows = min(len(values) for values in columns.values())
+        return {column: values[:rows] for column, values in columns.items()}
+
+    def _days(self):
+        if not os.path.isdir(self.root):
+            return []
+        days = set()
+        for name in os.listdir(self.root):
+            try:
+                days.add(datetime.date.fromisoformat(name.removesuffix(".npz")))
+            except ValueError:
+                continue
+        return sorted(days)
+
+    def _partitionPath(self, day):
+        return os.path.join(self.root, day.isoformat())
+
+    def _id(self, dictionary, kind, name):
+        names = dictionary[kind]
+        if name not in dictionary["_index"][kind]:
+            dictionary["_index"][kind][name] = len(names)
+            names.append(name)
+            dictionary["_changed"] = True
+        return dictionary["_index"][kind][name]
+
+    def _loadDictionary(self):
+        if self._dictionary is None:
+            path = os.path.join(self.root, "dictionary.json")
+            if os.path.exists(path):
+                with open(path, encoding="utf-8") as file:
+                    stored = json.load(file)
+            else:
+                stored = {"locations": [], "sources": []}
+            self._dictionary = {
+                "locations": stored["locations"],
+                "sources": stored["sources"],
+                "_index": {kind: {name: index for index, name in enumerate(stored[kind])} for kind in ("locations", "sources")},
+                "_changed": False,
+            }
+        return self._dictionary
+
+    def _saveDictionary(self, dictionary):
+        if not dictionary["_changed"]:
+            return
+        os.makedirs(self.root, exist_ok=True)
+        path = os.path.join(self.root, "dictionary.json")
+        write_atomic(path, json.dumps({"locations": dictionary["locations"], "sources": dictionary["sources"]}, ensure_ascii=False))
+        dictionary["_changed"] = False
+
+def _utcNaive(moment):
+    """
+    Converts a time into naive UTC, which is what numpy datetime64 uses
+    """
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return moment
+
+# History shared by the weather task
+history_store = HistoryStore(os.getenv("HISTORY_DIRECTORY", "history"))
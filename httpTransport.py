@@ -0,0 +1,203 @@
+import os
+import random
+import threading
+import time
+
+import config
+import requests
+from metrics import metrics
+from requests.adapters import HTTPAdapter
+
+# Connection pool, timeout and retry settings for each weather provider
+provider_settings = {
+    "OpenWeatherMap": {
+        "pool_size": int(os.getenv("OPENWEATHER_POOL_SIZE", os.getenv("OPENWEATHER_MAX_CONCURRENCY", "8"))),
+        "timeout": (3.05, 10),  # (connect, read) timeout in seconds
+        "retries": 3,
+        "backoff_base": 0.5,  # seconds before the first retry, doubled on every attempt
+        "backoff_max": 8.0,
+        "breaker_failures": int(os.getenv("OPENWEATHER_BREAKER_FAILURES", "5")),  # failed attempts in a row that open the circuit
+        "breaker_cooldown": float(os.getenv("OPENWEATHER_BREAKER_COOLDOWN", "60")),  # seconds before a probe is let through
+    },
+    "Finnish Meteorological Institute": {
+        "pool_size": int(os.getenv("FMI_POOL_SIZE", os.getenv("FMI_MAX_CONCURRENCY", "4"))),
+        "timeout": (3.05, 10),
+        "retries": 3,
+        "backoff_base": 1.0,
+        "backoff_max": 16.0,
+        "breaker_failures": int(os.getenv("FMI_BREAKER_FAILURES", "5")),
+        "breaker_cooldown": float(os.getenv("FMI_BREAKER_COOLDOWN", "60")),
+    },
+}
+
+# Status codes that mean the provider is temporarily unable to answer
+retryable_status_codes = {429, 500, 502, 503, 504}
+
+__sessions = {}
+__sessionsLock = threading.Lock()
+__breakers = {}
+
+class CircuitOpenError(requests.RequestException):
+    """
+    Raised instead of making a request to a provider whose circuit breaker is open
+    """
+
+class CircuitBreaker:
+    """
+    Stops requests to a provider that keeps failing, so a cycle doesn't wait for timeout after timeout
+
+    After failure_threshold failed attempts in a row the circuit opens and requests fail right away with
+    CircuitOpenError. When cooldown seconds have passed, a single request is let through as a probe: if it
+    succeeds the circuit closes, if it fails the circuit stays open for another cooldown.
+    """
+
+    def __init__(self, provider, failure_threshold, cooldown):
+        self.provider = provider
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self._failures = 0
+        self._openedAt = 0.0
+        self._lock = threading.Lock()
+
+    def before_request(self):
+        """
+        Checks whether a request may be made
+
+        Returns:
+            bool: True if the request is the probe of a half-open circuit.
+
+        Raises:
+            CircuitOpenError: If the circuit is open, or half-open with the probe already on its way.
+        """
+        with self._lock:
+            if self.state == "closed":
+                return False
+            if self.state == "open" and time.monotonic() - self._openedAt >= self.cooldown:
+                self._setState("half_open")
+                return True
+            raise CircuitOpenError(f"{self.provider} is unavailable, requests are paused after {self.failure_threshold} failures in a row")
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            if self.state != "closed":
+                print(f"{self.provider} is answering again")
+                self._setState("closed")
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == "half_open" or (self.state == "closed" and self._failures >= self.failure_threshold):
+                print(f"{self.provider} failed {self._failures} times in a row, pausing requests for {self.cooldown:.0f} seconds")
+                self._openedAt = time.monotonic()
+                self._setState("open")
+
+    def _setState(self, state):
+        self.state = state
+        metrics.increment("circuit_transitions_total", provider=self.provider, state=state)
+
+def get_breaker(provider):
+    """
+    Gets the circuit breaker of a provider, creating it on first use
+    """
+    with __sessionsLock:
+        breaker = __breakers.get(provider)
+        if breaker is None:
+            settings = provider_settings[provider]
+            breaker = __breakers[provider] = CircuitBreaker(provider, settings["breaker_failures"], settings["breaker_cooldown"])
+        return breaker
+
+def get_session(provider):
+    """
+    Gets the shared session of a provider, creating it on first use
+
+    The session keeps connections alive between requests, so only the first request to a host pays for
+    the TCP and TLS handshakes. The pool holds as many connections per host as the provider is allowed
+    to have requests running at the same time.
+    """
+    with __sessionsLock:
+        session = __sessions.get(provider)
+        if session is None:
+            poolSize = max(1, provider_settings[provider]["pool_size"])
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=poolSize, pool_block=True)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            __sessions[provider] = session
+        return session
+
+def backoff_delay(provider, attempt):
+    """
+    Gets how long to wait before retrying, using exponential backoff with full jitter
+
+    Parameters:
+        provider (str): The provider whose settings are used.
+        attempt (int): The number of the attempt that just failed, starting from 0.
+    """
+    settings = provider_settings[provider]
+    ceiling = min(settings["backoff_max"], settings["backoff_base"] * (2 ** attempt))
+    return random.uniform(0, ceiling)
+
+def request_with_retries(provider, url, params=None, retries=None):
+    """
+    Makes a GET request with the shared session of a provider, retrying on connection errors and
+    on responses that indicate a temporary problem
+
+    Every attempt goes through the provider's circuit breaker. A probe of a half-open circuit is not retried.
+
+    Parameters:
+        provider (str): The provider the request is made to, a key of provider_settings.
+        url (str): The url of the request.
+        params (dict): The query parameters of the request.
+        retries (int): The number of retries after the first attempt, defaults to the provider setting.
+
+    Returns:
+        requests.Response: The first response that was not retryable, or the last response if all attempts failed.
+
+    Raises:
+        CircuitOpenError: If the provider's circuit is open.
+        requests.RequestException: If the last attempt failed without getting a response.
+    """
+    settings = provider_settings[provider]
+    retries = settings["retries"] if retries is None else retries
+    session = get_session(provider)
+    breaker = get_breaker(provider)
+
+    attempt = 0
+    while True:
+        probe = breaker.before_request()
+        try:
+            with metrics.span("http_request_seconds", provider=provider):
+                response = session.get(url, params=params, timeout=settings["timeout"])
+            metrics.increment("http_responses_total", provider=provider, status=response.status_code)
+            metrics.increment("http_response_bytes_total", len(response.content), provider=provider)
+            if response.status_code not in retryable_status_codes:
+                breaker.record_success()
+                return response
+            breaker.record_failure()
+            if attempt >= retries or probe:
+                return response
+            print(f"Attempt {attempt + 1} to {provider} failed with status code: {response.status_code}")
+            delay = __retryAfter(response)
+        except requests.RequestException as e:
+            metrics.increment("http_errors_total", provider=provider, error=type(e).__name__)
+            breaker.record_failure()
+            if attempt >= retries or probe:
+                raise
+            print(f"Attempt {attempt + 1} to {provider} encountered an error: {e}")
+            delay = None
+
+        metrics.increment("http_retries_total", provider=provider)
+        time.sleep(delay if delay is not None else backoff_delay(provider, attempt))
+        attempt += 1
+
+def __retryAfter(response):
+    """
+    Gets the delay the provider asked for with the Retry-After header, if it gave one in seconds
+    """
+    value = response.headers.get("Retry-After")
+    try:
+        return min(float(value), 60.0) if value is not None else None
+    except ValueError:
+        return None
@@ -0,0 +1,221 @@
+import json
+import os
+import threading
+import time
+
+import config
+from atomicFile import file_lock, write_atomic
+
+# The station and city ids of the locations are kept here
+location_cache_file = os.getenv("LOCATION_CACHE_FILE", "location_ids.json")
+
+# A location FMI had no station for is asked about again after this many hours
+location_retry_hours = int(os.getenv("LOCATION_RETRY_HOURS", "24"))
+
+class LocationResolver:
+    """
+    The FMI station and OpenWeatherMap city of each location in Locations.xlsx
+
+    Names are resolved once, after which the providers are asked by id. That spares them from geocoding the name
+    on every request and keeps an ambiguous name on the same station. The ids are kept in a JSON file together with
+    the signature of Locations.xlsx. When the sheet changes, the names that left it are forgotten and only the new
+    names are resolved.
+
+    Several processes, such as the shard workers, can share the file. Each one merges only the ids it changed into
+    the file under a lock, and reads the ids the others stored when the file changes.
+    """
+
+    def __init__(self, path=location_cache_file):
+        self.path = path
+        self._locations = None
+        self._signature = None
+        self._loadedVersion = None
+        self._changedLocations = set()
+        self._removedLocations = set()
+        self._signatureChanged = False
+        self._lock = threading.Lock()
+
+    def validate(self, excelFileName, locations):
+        """
+        Forgets the ids of the names that are no longer in the sheet, if it has changed since they were resolved
+
+        Only the process that reads the whole sheet calls this, the weather task, never a shard worker with its share.
+
+        Parameters:
+            excelFileName (str): The sheet the locations were read from.
+            locations (list): All locations now in the sheet.
+        """
+        try:
+            stat = os.stat(excelFileName)
+        except OSError:
+            return
+        signature = [stat.st_mtime_ns, stat.st_size]
+        with self._lock:
+            self._load()
+            self._reloadIfChanged()
+            if signature != self._signature:
+                current = set(locations)
+                removed = [location for location in self._locations if location not in current]
+                for location in removed:
+                    del self._locations[location]
+                self._removedLocations.update(removed)
+                self._changedLocations.difference_update(removed)
+                if removed:
+                    print(f"{excelFileName} has changed, forgot the ids of {len(removed)} locations that left it.")
+                self._signature = signature
+                self._signatureChanged = True
+
+    def refresh(self):
+        """
+        Reads the ids again if another process has stored new ones in the file
+        """
+        with self._lock:
+            self._load()
+            self._reloadIfChanged()
+
+    def unresolved_stations(self, locations):
+        """
+        Gets the locations that have no FMI station yet and are due to be asked about
+        """
+        retryAfter = time.time() - location_retry_hours * 3600
+        with self._lock:
+            self._load()
+            return [
+                location for location in dict.fromkeys(locations)
+                if "fmisid" not in self._locations.get(location, {}) or
+                (self._locations[location]["fmisid"] is None and self._locations[location].get("fmi_checked", 0) < retryAfter)
+            ]
+
+    def fmisid(self, location):
+        """
+        Gets the FMI station id of the location, None if it isn't known
+        """
+        with self._lock:
+            self._load()
+            return self._locations.get(location, {}).get("fmisid")
+
+    def station_coordinates(self, location):
+        """
+        Gets the (latitude, longitude) of the location's FMI station, None if it isn't known
+        """
+        with self._lock:
+            self._load()
+            entry = self._locations.get(location, {})
+            if entry.get("latitude") is None:
+                return None
+            return entry["latitude"], entry["longitude"]
+
+    def location_coordinates(self, location):
+        """
+        Gets the (latitude, longitude) of the location itself, as given by OpenWeatherMap, None if it isn't known
+        """
+        with self._lock:
+            self._load()
+            coordinates = self._locations.get(location, {}).get("openweather_coordinates")
+            return tuple(coordinates) if coordinates is not None else None
+
+    def openweather_id(self, location):
+        """
+        Gets the OpenWeatherMap city id of the location, None if it isn't known
+        """
+        with self._lock:
+            self._load()
+            return self._locations.get(location, {}).get("openweather_id")
+
+    def put_station(self, location, station):
+        """
+        Stores the FMI station of the location
+
+        Parameters:
+            location (str): The name in Locations.xlsx.
+            station (tuple): The fmisid, latitude and longitude of the station, None if FMI has no station for the name.
+        """
+        with self._lock:
+            self._load()
+            entry = self._locations.setdefault(location, {})
+            if station is None:
+                entry.update(fmisid=None, fmi_checked=time.time())
+            else:
+                entry.update(fmisid=station[0], latitude=station[1], longitude=station[2])
+            self._changedLocations.add(location)
+
+    def put_openweather(self, location, openweather_id, coordinates=None):
+        """
+        Stores the OpenWeatherMap city id the name resolved to, and the city's (latitude, longitude) if given
+        """
+        with self._lock:
+            self._load()
+            entry = self._locations.setdefault(location, {})
+            entry["openweather_id"] = openweather_id
+            if coordinates is not None:
+                entry["openweather_coordinates"] = list(coordinates)
+            self._changedLocations.add(location)
+
+    def save(self):
+        """
+        Merges the ids that have changed into the file, keeping the ids other processes have stored there
+        """
+        with self._lock:
+            if not (self._changedLocations or self._removedLocations or self._signatureChanged):
+                return
+            try:
+                with file_lock(self.path):
+                    stored, signature = self._read()
+                    for location in self._removedLocations:
+                        stored.pop(location, None)
+                    for location in self._changedLocations:
+                        if location in self._locations:
+                            stored[location] = dict(stored.get(location, {}), **self._locations[location])
+                    if self._signatureChanged:
+                        signature = self._signature
+                    write_atomic(self.path, json.dumps({"signature": signature, "locations": stored}, ensure_ascii=False))
+                    self._loadedVersion = self._version()
+                self._locations, self._signature = stored, signature
+                self._changedLocations.clear()
+                self._removedLocations.clear()
+                self._signatureChanged = False
+            except (OSError, TimeoutError) as e:
+                print(f"Failed to write the location ids to '{self.path}': {e}")
+
+    def _load(self):
+        if self._locations is not None:
+            return
+        self._loadedVersion = self._version()
+        self._locations, self._signature = self._read()
+
+    def _reloadIfChanged(self):
+        # The ids this process hasn't saved yet are kept over the ones read from the file
+        version = self._version()
+        if version == self._loadedVersion:
+            return
+        self._loadedVersion = version
+        stored, signature = self._read()
+        for location in self._removedLocations:
+            stored.pop(location, None)
+        for location in self._changedLocations:
+            if location in self._locations:
+                stored[location] = self._locations[location]
+        self._locations = stored
+        if not self._signatureChanged:
+            self._signature = signature
+
+    def _read(self):
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                stored = json.load(file)
+            return stored["locations"], stored["signature"]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Failed to read the location ids from '{self.path}': {e}")
+        return {}, None
+
+    def _version(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+# Location ids shared by the fetchers
+location_resolver = LocationResolver()
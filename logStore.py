@@ -0,0 +1,183 @@
+import atexit
+import datetime
+import os
+import sqlite3
+import threading
+import time
+
+import config
+from metrics import metrics
+
+# Columns of each log, in the order they are written to the Excel files
+log_tables = {
+    "email_log": {
+        "columns": ["timestamp", "status", "message"],
+        "headers": ["Timestamp", "Status", "Message"],
+        "excel": "Log.xlsx",
+    },
+    "error_log": {
+        "columns": ["timestamp", "level", "location", "message"],
+        "headers": ["Timestamp", "Error Level", "Location", "Error Message"],
+        "excel": "error_log.xlsx",
+    },
+}
+
+class LogStore:
+    """
+    Append-only log backed by SQLite in WAL mode
+
+    Rows are buffered in memory and written in one transaction when the buffer is full, when the oldest buffered
+    row is older than flush_interval, or when the program exits. The Excel files read by the business are
+    produced from the database with export_to_excel instead of being rewritten on every event.
+    """
+
+    def __init__(self, path, batch_size=50, flush_interval=5.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._connection = None
+        self._timer = None
+
+    def append(self, table, row):
+        """
+        Adds a row to a log, the timestamp is added automatically
+
+        Parameters:
+            table (str): The log to write to, a key of log_tables.
+            row (list): The values of the other columns of the log.
+        """
+        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self._lock:
+            self._buffer.append((table, [timestamp, *row]))
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            due = len(self._buffer) >= self.batch_size or time.monotonic() - self._oldest >= self.flush_interval
+            if due:
+                self._flushLocked()
+            elif self._timer is None:
+                # Makes sure a quiet log is still written within flush_interval
+                self._timer = threading.Timer(self.flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """
+        Writes the buffered rows to the database
+        """
+        with self._lock:
+            self._flushLocked()
+
+    def export_to_excel(self, table, excel_path=None):
+        """
+        Writes all rows of a log into an Excel file, replacing the file
+
+        Parameters:
+            table (str): The log to export, a key of log_tables.
+            excel_path (str): The file to write, defaults to the file the log has always been kept in.
+        """
+        from openpyxl import Workbook
+
+        definition = log_tables[table]
+        self.flush()
+        with self._lock:
+            rows = self._connect().execute(f"SELECT {', '.join(definition['columns'])} FROM {table} ORDER BY id").fetchall()
+
+        # A write-only workbook streams the rows to disk instead of keeping them all as cell objects
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        sheet.append(definition["headers"])
+        for row in rows:
+            sheet.append(list(row))
+        with metrics.span("excel_save_seconds", file=os.path.basename(excel_path or definition["excel"])):
+            workbook.save(excel_path or definition["excel"])
+        print(f"Exported {len(rows)} rows of {table} to {excel_path or definition['excel']}")
+
+    def export_all(self):
+        for table in log_tables:
+            self.export_to_excel(table)
+
+    def _flushLocked(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._buffer:
+            return
+        rows, self._buffer, self._oldest = self._buffer, [], None
+        try:
+            connection = self._connect()
+            with metrics.span("log_flush_seconds"), connection:
+                for table in log_tables:
+                    tableRows = [row for rowTable, row in rows if rowTable == table]
+                    if tableRows:
+                        columns = log_tables[table]["columns"]
+                        connection.executemany(
+                            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                            tableRows,
+                        )
+        except sqlite3.Error as e:
+            print(f"Failed to write logs to {self.path}: {e}")
+
+    def _connect(self):
+        if self._connection is None:
+            isNew = not os.path.exists(self.path)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            for table, definition in log_tables.items():
+                columns = ", ".join(f"{column} TEXT" for column in definition["columns"])
+                self._connection.execute(f"CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY, {columns})")
+            self._connection.commit()
+            if isNew:
+                self._importExcelLogs()
+        return self._connection
+
+    def _importExcelLogs(self):
+        """
+        Copies the rows of existing Excel logs into a new database, so the exports keep the old history
+        """
+        for table, definition in log_tables.items():
+            if not os.path.exists(definition["excel"]):
+                continue
+            try:
+                from openpyxl import load_workbook
+
+                workbook = load_workbook(definition["excel"], read_only=True)
+                rows = [
+                    [None if value is None else str(value) for value in row[:len(definition["columns"])]]
+                    for row in workbook.active.iter_rows(min_row=2, values_only=True)
+                    if any(value is not None for value in row)
+                ]
+                workbook.close()
+                columns = definition["columns"]
+                with self._connection:
+                    self._connection.executemany(
+                        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                        [row + [None] * (len(columns) - len(row)) for row in rows],
+                    )
+            except Exception as e:
+                print(f"Failed to import {definition['excel']} into the log database: {e}")
+
+# Log shared by the whole bot
+log_store = LogStore(os.getenv("LOG_DATABASE", "logs.db"))
+atexit.register(log_store.flush)
+
+# How often the Excel files are regenerated from the log database, in seconds
+log_export_interval = int(os.getenv("LOG_EXPORT_INTERVAL", "3600"))
+__lastExport = None
+
+def export_logs_if_due():
+    """
+    Regenerates the Excel logs if log_export_interval has passed since the last export
+    """
+    global __lastExport
+    now = time.monotonic()
+    if __lastExport is not None and now - __lastExport < log_export_interval:
+        return
+    __lastExport = now
+    try:
+        log_store.export_all()
+    except Exception as e:
+        print(f"Failed to export logs to Excel: {e}")
@@ -0,0 +1,264 @@
+import atexit
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+
+import config
+from logStore import log_store
+from metrics import metrics
+
+smtp_server = os.getenv("SMTP_SERVER", "smtp.gmail.com")
+smtp_port = int(os.getenv("SMTP_PORT", "587"))
+
+# A connection that has been idle longer than this is checked with NOOP before it is used again
+idle_check_seconds = 60
+
+# Retry settings for messages that failed with a transient error
+max_attempts = 8
+backoff_base = 5.0
+backoff_max = 600.0
+
+# Sent and failed messages are kept this many days, without their body, so their status can still be looked up
+outbox_retention_days = int(os.getenv("OUTBOX_RETENTION_DAYS", "7"))
+
+class SMTPConnection:
+    """
+    A long-lived, authenticated SMTP connection that reconnects when the server has dropped it
+    """
+
+    def __init__(self, server=None, port=None):
+        self.server = server or smtp_server
+        self.port = port or smtp_port
+        self._smtp = None
+        self._lastUsed = 0.0
+
+    def send(self, sender, recipients, message):
+        """
+        Sends a message, reconnecting once if the connection turns out to be closed
+        """
+        import smtplib
+
+        try:
+            self._ensureConnected().sendmail(sender, recipients, message)
+        except smtplib.SMTPServerDisconnected:
+            self.close()
+            self._ensureConnected().sendmail(sender, recipients, message)
+        self._lastUsed = time.monotonic()
+
+    def close(self):
+        import smtplib
+
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._smtp = None
+
+    def _ensureConnected(self):
+        import smtplib
+
+        if self._smtp is not None and time.monotonic() - self._lastUsed > idle_check_seconds:
+            # Servers close idle connections, so an old connection is checked before use
+            try:
+                if self._smtp.noop()[0] != 250:
+                    self.close()
+            except (smtplib.SMTPException, OSError):
+                self.close()
+
+        if self._smtp is None:
+            metrics.increment("smtp_connections_total")
+            smtp = smtplib.SMTP(self.server, self.port, timeout=30)
+            smtp.ehlo()
+            if smtp.has_extn("starttls"):
+                smtp.starttls()  # Secure the connection
+                smtp.ehlo()
+            sender_email = os.getenv("EMAIL_ADDRESS")
+            sender_password = os.getenv("EMAIL_PASSWORD")
+            if sender_password and smtp.has_extn("auth"):
+                smtp.login(sender_email, sender_password)
+            self._smtp = smtp
+            self._lastUsed = time.monotonic()
+        return self._smtp
+
+class Outbox:
+    """
+    Persistent queue of outgoing mail, drained by a background worker over one shared SMTP connection
+
+    Messages are stored in SQLite before they are sent, so mail that could not be delivered is retried with
+    a backoff, also after the bot has been restarted. Every final result is written to the email log.
+    """
+
+    def __init__(self, path, connection=None):
+        self.path = path
+        self.connection = connection or SMTPConnection()
+        self._db = None
+        self._dbLock = threading.Lock()
+        self._wakeUp = threading.Event()
+        self._results = threading.Condition()
+        self._worker = None
+
+    def queue(self, msg, recipients, summary=None):
+        """
+        Adds a message to the outbox
+
+        Parameters:
+            msg (email.message.Message): The composed message.
+            recipients (list): The addresses the message is delivered to.
+            summary (str): Short description of the message for the email log, defaults to its subject and recipients.
+
+        Returns:
+            int: The id of the message in the outbox.
+        """
+        summary = summary or f"{msg['Subject']} to {', '.join(recipients)}"
+        with self._dbLock:
+            db = self._connect()
+            with db:
+                cursor = db.execute(
+                    "INSERT INTO outbox (created, sender, recipients, message, summary, attempts, next_attempt, status) "
+                    "VALUES (?, ?, ?, ?, ?, 0, ?, 'pending')",
+                    (time.time(), msg["From"], json.dumps(list(recipients)), msg.as_string(), summary, time.time()),
+                )
+        self._startWorker()
+        self._wakeUp.set()
+        return cursor.lastrowid
+
+    def wait(self, messageId, timeout):
+        """
+        Waits until a message has been sent or has permanently failed
+
+        Returns:
+            str: "sent", "failed", or "pending" if the message is still being retried when the timeout ends.
+        """
+        deadline = time.monotonic() + timeout
+        with self._results:
+            while True:
+                status = self.status(messageId)
+                remaining = deadline - time.monotonic()
+                if status != "pending" or remaining <= 0:
+                    return status
+                self._results.wait(remaining)
+
+    def status(self, messageId):
+        with self._dbLock:
+            row = self._connect().execute("SELECT status FROM outbox WHERE id = ?", (messageId,)).fetchone()
+        return row[0] if row else "failed"
+
+    def start(self):
+        """
+        Starts delivering the messages in the outbox, including those left there by an earlier run
+        """
+        self._startWorker()
+        self._wakeUp.set()
+
+    def _startWorker(self):
+        with self._dbLock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._drain, name="outbox", daemon=True)
+                self._worker.start()
+
+    def _drain(self):
+        while True:
+            try:
+                self._drainOnce()
+            except Exception as e:
+                print(f"Outbox worker failed, retrying: {e}")
+                time.sleep(backoff_base)
+
+    def _drainOnce(self):
+        with self._dbLock:
+            due = self._connect().execute(
+                "SELECT id, sender, recipients, message, summary, attempts FROM outbox "
+                "WHERE status = 'pending' AND next_attempt <= ? ORDER BY id",
+                (time.time(),),
+            ).fetchall()
+            nextDue = self._connect().execute(
+                "SELECT MIN(next_attempt) FROM outbox WHERE status = 'pending'"
+            ).fetchone()[0]
+
+        for messageId, sender, recipients, message, summary, attempts in due:
+            self._deliver(messageId, sender, json.loads(recipients), message, summary, attempts)
+
+        if not due:
+            timeout = None if nextDue is None else max(0.0, nextDue - time.time())
+            self._wakeUp.wait(timeout)
+            self._wakeUp.clear()
+
+    def _deliver(self, messageId, sender, recipients, message, summary, attempts):
+        attempts += 1
+        try:
+            with metrics.span("smtp_send_seconds"):
+                self.connection.send(sender, recipients, message)
+            metrics.increment("emails_total", status="sent")
+            self._finish(messageId, "sent", attempts, None)
+            print("Email sent successfully.")
+            log_store.append("email_log", ["Success", summary])
+        except Exception as e:
+            metrics.increment("emails_total", status="retried" if self._isTransient(e) and attempts < max_attempts else "failed")
+            if self._isTransient(e) and attempts < max_attempts:
+                delay = random.uniform(0, min(backoff_max, backoff_base * (2 ** attempts)))
+                print(f"Failed to send email, retrying in {delay:.0f} seconds: {e}")
+                with self._dbLock:
+                    db = self._connect()
+                    with db:
+                        db.execute(
+                            "UPDATE outbox SET attempts = ?, next_attempt = ?, last_error = ? WHERE id = ?",
+                            (attempts, time.time() + delay, str(e), messageId),
+                        )
+                self.connection.close()
+            else:
+                self._finish(messageId, "failed", attempts, str(e))
+                print(f"Failed to send email: {e}")
+                log_store.append("email_log", ["Failed", summary])
+
+    def _finish(self, messageId, status, attempts, error):
+        with self._dbLock:
+            db = self._connect()
+            with db:
+                # The body is only needed for delivery, the email log has the summary
+                db.execute(
+                    "UPDATE outbox SET status = ?, attempts = ?, last_error = ?, message = NULL WHERE id = ?",
+                    (status, attempts, error, messageId),
+                )
+                db.execute(
+                    "DELETE FROM outbox WHERE status != 'pending' AND created < ?",
+                    (time.time() - outbox_retention_days * 86400,),
+                )
+        with self._results:
+            self._results.notify_all()
+
+    def _isTransient(self, error):
+        """
+        Tells whether sending may succeed later, connection problems and 4xx replies are transient
+        """
+        import smtplib
+        import socket
+
+        if isinstance(error, smtplib.SMTPRecipientsRefused):
+            return all(400 <= code < 500 for code, _ in error.recipients.values())
+        if isinstance(error, smtplib.SMTPResponseException):
+            return 400 <= error.smtp_code < 500
+        if isinstance(error, (smtplib.SMTPServerDisconnected, socket.timeout)):
+            return True
+        # Other SMTP errors are problems with the message or the server setup, retrying won't help
+        return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY, created REAL, sender TEXT, recipients TEXT, "
+                "message TEXT, summary TEXT, attempts INTEGER, next_attempt REAL, status TEXT, last_error TEXT)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (status, next_attempt)")
+            self._db.commit()
+        return self._db
+
+# Outbox shared by the weather report and the error notifications
+outbox = Outbox(os.getenv("OUTBOX_DATABASE", "outbox.db"))
+
+atexit.register(outbox.connection.close)
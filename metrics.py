@@ -0,0 +1,168 @@
+import bisect
+import os
+import threading
+import time
+
+import config
+from atomicFile import write_atomic
+
+# Metrics are written here, as Prometheus text or, if the name ends with .jsonl, as one JSON line per export
+metrics_file = os.getenv("METRICS_FILE", "metrics.prom")
+
+# Metrics are written at most this often by Metrics.export_if_due, in seconds
+metrics_export_interval = int(os.getenv("METRICS_EXPORT_INTERVAL", "60"))
+
+# Set METRICS_ENABLED=0 to turn recording off
+metrics_enabled = os.getenv("METRICS_ENABLED", "1") != "0"
+
+# Upper bounds of the histogram buckets, in seconds for durations
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Prefix of every metric name in the exports
+_PREFIX = "weatherbot_"
+
+class Metrics:
+    """
+    Counters and histograms kept in memory and written to a file now and then
+
+    Recording a value is a dictionary update under a lock, so the metrics can stay enabled in production.
+    Labels are given as keyword arguments, e.g. metrics.increment("cache_hits_total", provider="OpenWeatherMap").
+    """
+
+    def __init__(self, enabled=True, buckets=default_buckets):
+        self.enabled = enabled
+        self.buckets = buckets
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._exported = time.monotonic()
+
+    def increment(self, name, value=1, **labels):
+        """
+        Adds value to a counter
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """
+        Records a value, such as a duration in seconds, in a histogram
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def span(self, name, **labels):
+        """
+        Times a block of code into a histogram of seconds
+
+        Example:
+            with metrics.span("stage_seconds", stage="fetch"):
+                ...
+        """
+        return _Span(self, name, labels)
+
+    def snapshot(self):
+        """
+        Gets a copy of the current values
+
+        Returns:
+            dict: The counters and the histograms, each a list of dictionaries with the name, labels and values.
+        """
+        with self._lock:
+            counters = [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in self._counters.items()]
+            histograms = [
+                {"name": name, "labels": dict(labels), "buckets": list(counts), "sum": total, "count": count}
+                for (name, labels), (counts, total, count) in self._histograms.items()
+            ]
+        return {"counters": counters, "histograms": histograms}
+
+    def to_prometheus(self):
+        """
+        Formats the current values in the Prometheus text exposition format
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for name in sorted({counter["name"] for counter in snapshot["counters"]}):
+            lines.append(f"# TYPE {_PREFIX}{name} counter")
+            for counter in snapshot["counters"]:
+                if counter["name"] == name:
+                    lines.append(f"{_PREFIX}{name}{_formatLabels(counter['labels'])} {counter['value']}")
+
+        for name in sorted({histogram["name"] for histogram in snapshot["histograms"]}):
+            lines.append(f"# TYPE {_PREFIX}{name} histogram")
+            for histogram in snapshot["histograms"]:
+                if histogram["name"] != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(self.buckets) + ["+Inf"], histogram["buckets"]):
+                    cumulative += count
+                    labels = dict(histogram["labels"], le=str(bound))
+                    lines.append(f"{_PREFIX}{name}_bucket{_formatLabels(labels)} {cumulative}")
+                lines.append(f"{_PREFIX}{name}_sum{_formatLabels(histogram['labels'])} {histogram['sum']:.6f}")
+                lines.append(f"{_PREFIX}{name}_count{_formatLabels(histogram['labels'])} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, path=None):
+        """
+        Writes the metrics to a file, Prometheus text unless the file name ends with .jsonl
+        """
+        if not self.enabled:
+            return
+        path = path or metrics_file
+        self._exported = time.monotonic()
+        try:
+            if path.endswith(".jsonl"):
+                import json
+
+                snapshot = dict(self.snapshot(), time=time.time())
+                with open(path, "a", encoding="utf-8") as file:
+                    file.write(json.dumps(snapshot, ensure_ascii=False) + "\n")
+            else:
+                write_atomic(path, self.to_prometheus())
+        except OSError as e:
+            print(f"Failed to write the metrics to '{path}': {e}")
+
+    def export_if_due(self):
+        if time.monotonic() - self._exported >= metrics_export_interval:
+            self.export()
+
+class _Span:
+    __slots__ = ("metrics", "name", "labels", "started")
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, errorType, error, tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.started, **self.labels)
+        if errorType is not None:
+            self.metrics.increment("span_errors_total", span=self.name)
+        return False
+
+def _formatLabels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escapeLabel(value)}"' for key, value in labels.items()) + "}"
+
+def _escapeLabel(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+# Metrics shared by the whole bot, the tasks also write them to METRICS_FILE when they exit
+metrics = Metrics(enabled=metrics_enabled)
@@ -0,0 +1,200 @@
+import bisect
+import json
+import math
+import os
+from collections import namedtuple
+
+from atomicFile import write_atomic
+
+# A user's condition on one parameter of one city, e.g. Rule("user@example.com", "Espoo", "wind_speed", ">", 15.0)
+Rule = namedtuple("Rule", ["email", "city", "parameter", "operator", "threshold"])
+
+# Parameters that rules can be set on, and the names they can be given with in Rules.xlsx
+parameter_aliases = {
+    "temperature": "temperature",
+    "lämpötila": "temperature",
+    "temp": "temperature",
+    "wind_speed": "wind_speed",
+    "wind": "wind_speed",
+    "tuuli": "wind_speed",
+    "tuulen nopeus": "wind_speed",
+}
+
+rule_operators = (">", ">=", "<", "<=")
+
+units = {"temperature": "Celsius", "wind_speed": "m/s"}
+
+# The last values and the known rules are kept here, so a restart doesn't send the alerts again
+notification_state_file = os.getenv("NOTIFICATION_STATE_FILE", "notification_state.json")
+
+def parse_rule(email, city, parameter, operator, threshold):
+    """
+    Forms a rule from the cells of a row of Rules.xlsx
+
+    The threshold can be given with its unit, e.g. "15 m/s".
+
+    Raises:
+        ValueError: If the parameter, operator or threshold is not valid.
+    """
+    name = parameter_aliases.get(str(parameter).strip().lower())
+    if name is None:
+        raise ValueError(f"Unknown parameter '{parameter}', use one of {', '.join(parameter_aliases)}")
+    operator = str(operator).strip()
+    if operator not in rule_operators:
+        raise ValueError(f"Unknown condition '{operator}', use one of {', '.join(rule_operators)}")
+    if isinstance(threshold, str):
+        threshold = threshold.split()[0].replace(",", ".") if threshold.strip() else ""
+    try:
+        threshold = float(threshold)
+    except (TypeError, ValueError):
+        raise ValueError(f"Threshold '{threshold}' is not a number")
+    return Rule(str(email).strip(), str(city).strip(), name, operator, threshold)
+
+class NotificationRules:
+    """
+    Index of the users' notification rules, keyed by (city, parameter)
+
+    The thresholds of each key and operator are kept sorted, so the rules whose condition became true when a
+    value changed are found with two binary searches, whatever the number of rules. Only keys whose value changed
+    since the previous evaluation are looked at, and a rule triggers when its condition becomes true, not on
+    every cycle while it stays true. The values and rules are saved to a file after each evaluation.
+    """
+
+    def __init__(self, path=notification_state_file):
+        self.path = path
+        self._rules = frozenset()
+        self._index = {}
+        self._values = None
+        self._storedRules = frozenset()
+        self._newRules = []
+
+    def __len__(self):
+        return len(self._rules)
+
+    def update(self, rules):
+        """
+        Replaces the rules, the index is built again only if they changed
+
+        New rules whose condition is already true trigger on the next evaluation.
+        """
+        self._load()
+        rules = frozenset(rules)
+        if rules == self._rules:
+            return
+        self._newRules.extend(rules - self._rules - self._storedRules)
+        self._storedRules = frozenset()
+        self._rules = rules
+
+        index = {}
+        for rule in rules:
+            index.setdefault((rule.city, rule.parameter), {}).setdefault(rule.operator, []).append(rule)
+        for operators in index.values():
+            for operator, operatorRules in operators.items():
+                operatorRules.sort(key=lambda rule: rule.threshold)
+                operators[operator] = ([rule.threshold for rule in operatorRules], operatorRules)
+        self._index = index
+
+    def evaluate(self, values):
+        """
+        Gets the rules that became true with the new values
+
+        Parameters:
+            values (dict): The current value of each (city, parameter), NaN or None when there is no value.
+
+        Returns:
+            list: The triggered rules with the value that triggered them, as (rule, value) tuples.
+        """
+        self._load()
+        triggered = []
+        for key, value in values.items():
+            if value is None or math.isnan(value):
+                continue
+            previous = self._values.get(key)
+            if previous == value:
+                continue
+            self._values[key] = value
+            operators = self._index.get(key)
+            if operators:
+                triggered.extend((rule, value) for rule in _crossed(operators, previous, value))
+
+        for rule in self._newRules:
+            value = self._values.get((rule.city, rule.parameter))
+            if value is not None and _matches(rule, value) and not any(existing is rule for existing, _ in triggered):
+                triggered.append((rule, value))
+        self._newRules = []
+        return triggered
+
+    def save(self):
+        """
+        Writes the last values and the rules to the file
+        """
+        if self._values is None:
+            return
+        try:
+            write_atomic(self.path, json.dumps({
+                "values": [[city, parameter, value] for (city, parameter), value in self._values.items()],
+                "rules": [list(rule) for rule in self._rules | self._storedRules],
+            }, ensure_ascii=False))
+        except OSError as e:
+            print(f"Failed to write the notification state to '{self.path}': {e}")
+
+    def _load(self):
+        if self._values is not None:
+            return
+        self._values = {}
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                stored = json.load(file)
+            self._values = {(city, parameter): value for city, parameter, value in stored["values"]}
+            self._storedRules = frozenset(Rule(*rule) for rule in stored["rules"])
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Failed to read the notification state from '{self.path}': {e}")
+
+def _crossed(operators, previous, value):
+    """
+    Gets the rules of one (city, parameter) that are true for value but weren't for previous
+    """
+    crossed = []
+    for operator, (thresholds, rules) in operators.items():
+        # Rules true for a value are a prefix (> and >=) or a suffix (< and <=) of the rules sorted by threshold
+        if operator == ">":
+            now, before = bisect.bisect_left(thresholds, value), _prefix(bisect.bisect_left, thresholds, previous)
+            crossed.extend(rules[before:now])
+        elif operator == ">=":
+            now, before = bisect.bisect_right(thresholds, value), _prefix(bisect.bisect_right, thresholds, previous)
+            crossed.extend(rules[before:now])
+        elif operator == "<":
+            now, before = bisect.bisect_right(thresholds, value), _suffix(bisect.bisect_right, thresholds, previous)
+            crossed.extend(rules[now:before])
+        else:
+            now, before = bisect.bisect_left(thresholds, value), _suffix(bisect.bisect_left, thresholds, previous)
+            crossed.extend(rules[now:before])
+    return crossed
+
+def _prefix(search, thresholds, previous):
+    return 0 if previous is None else search(thresholds, previous)
+
+def _suffix(search, thresholds, previous):
+    return len(thresholds) if previous is None else search(thresholds, previous)
+
+def _matches(rule, value):
+    if rule.operator == ">":
+        return value > rule.threshold
+    if rule.operator == ">=":
+        return value >= rule.threshold
+    if rule.operator == "<":
+        return value < rule.threshold
+    return value <= rule.threshold
+
+def format_alert(rule, value):
+    """
+    Formats a triggered rule into a line of the notification email
+    """
+    unit = units[rule.parameter]
+    name = "Lämpötila" if rule.parameter == "temperature" else "Tuulen nopeus"
+    return f"{rule.city}: {name} {value:.1f} {unit} (ehto {rule.operator} {rule.threshold:g} {unit})"
+
+# Rules shared by the weather task
+notification_rules = NotificationRules()
@@ -0,0 +1,92 @@
+import datetime
+from dataclasses import dataclass
+from typing import Optional
+
+# wawa-koodien sanakirja säätilojen kuvausten kanssa
+wawa_mapping = {
+    0: "Ei merkittäviä sääilmiöitä",
+    4: "Auerta, savua tai ilmassa leijuvaa pölyä, näkyvyys vähintään 1 km",
+    5: "Auerta, savua tai ilmassa leijuvaa pölyä, näkyvyys alle 1 km",
+    10: "Utua",
+    20: "Sumua",
+    21: "Sadetta (olomuoto on määrittelemätön)",
+    22: "Tihkusadetta tai lumijyväsiä",
+    23: "Vesisadetta (ei jäätävää)",
+    24: "Lumisadetta",
+    25: "Jäätävää vesisadetta tai tihkua",
+    30: "Sumua havaintohetkellä",
+    31: "Sumua tai jääsumua erillisinä hattaroina",
+    32: "Sumua tai jääsumua, ohentunut edellisen tunnin aikana",
+    33: "Sumua tai jääsumua, ilman muutoksia",
+    34: "Sumua tai jääsumua, tullut sakeammaksi",
+    40: "Sadetta havaintohetkellä",
+    41: "Heikkoa tai kohtalaista sadetta",
+    42: "Kovaa sadetta",
+    50: "Tihkusadetta (heikkoa, ei jäätävää)",
+    51: "Heikkoa tihkua, ei jäätävää",
+    52: "Kohtalaista tihkua, ei jäätävää",
+    53: "Kovaa tihkua, ei jäätävää",
+    54: "Jäätävää heikkoa tihkua",
+    55: "Jäätävää kohtalaista tihkua",
+    56: "Jäätävää kovaa tihkua",
+    60: "Vesisadetta (heikkoa, ei jäätävää)",
+    61: "Heikkoa vesisadetta, ei jäätävää",
+    62: "Kohtalaista vesisadetta, ei jäätävää",
+    63: "Kovaa vesisadetta, ei jäätävää",
+    64: "Jäätävää heikkoa vesisadetta",
+    65: "Jäätävää kohtalaista vesisadetta",
+    66: "Jäätävää kovaa vesisadetta",
+    67: "Heikkoa lumensekaista vesisadetta tai tihkua (räntää)",
+    68: "Kohtalaista tai kovaa lumensekaista vesisadetta tai tihkua (räntää)",
+    70: "Lumisadetta",
+    71: "Heikkoa lumisadetta",
+    72: "Kohtalaista lumisadetta",
+    73: "Tiheää lumisadetta",
+    74: "Heikkoa jääjyvässadetta",
+    75: "Kohtalaista jääjyväsadetta",
+    76: "Kovaa jääjyväsadetta",
+    77: "Lumijyväsiä",
+    78: "Jääkiteitä",
+    80: "Heikkoja kuuroja tai ajoittaista sadetta",
+    81: "Heikkoja vesikuuroja",
+    82: "Kohtalaisia vesikuuroja",
+    83: "Kovia vesikuuroja",
+    84: "Ankaria vesikuuroja (>32 mm/h)",
+    85: "Heikkoja lumikuuroja",
+    86: "Kohtalaisia lumikuuroja",
+    87: "Kovia lumikuuroja",
+    89: "Raekuuroja mahdollisesti yhdessä vesi- tai räntäsateen kanssa"
+}
+
+@dataclass(slots=True)
+class Observation:
+    """
+    A single weather observation of a location from one provider
+
+    Values are kept as numbers and only formatted when the report is rendered.
+
+    Attributes:
+        city: The location the observation is for.
+        source: The provider the observation came from.
+        temperature: Temperature in Celsius.
+        wind_speed: Wind speed in m/s.
+        timestamp: When the observation was made, in UTC.
+        wawa: The WMO weather code of the observation, if the provider gives one.
+        condition: Description of the weather, for providers that don't give a wawa code.
+    """
+    city: str
+    source: str
+    temperature: float
+    wind_speed: float
+    timestamp: datetime.datetime
+    wawa: Optional[int] = None
+    condition: Optional[str] = None
+
+    @property
+    def description(self):
+        """
+        Gets the description of the weather state
+        """
+        if self.wawa is not None:
+            return wawa_mapping.get(self.wawa, "Tuntematon säätila")
+        return self.condition or "Ei tietoa"
@@ -0,0 +1,138 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import config
+from weatherInstitute import get_rounded_time
+
+# How long the observations of each provider are served from the cache, in seconds.
+# FMI publishes observations on a 10-minute grid, so its entries are also bound to the current time bucket.
+provider_ttls = {
+    "OpenWeatherMap": int(os.getenv("OPENWEATHER_CACHE_TTL", "600")),
+    "Finnish Meteorological Institute": int(os.getenv("FMI_CACHE_TTL", "600")),
+}
+
+class ObservationCache:
+    """
+    LRU cache for observations keyed by (provider, location, time bucket)
+
+    The time bucket is the 10-minute interval from get_rounded_time, so an entry is never served after the
+    observation grid has moved on, even if its TTL has not run out. When a file path is given, the entries are
+    also written to a shelve file, so a restarted bot can keep serving the current bucket without refetching.
+    """
+
+    def __init__(self, max_entries=5000, ttls=None, path=None):
+        self.max_entries = max_entries
+        self.ttls = dict(provider_ttls, **(ttls or {}))
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._diskBucket = None
+
+    def get(self, provider, location):
+        """
+        Gets the cached observation of a location, or None if there is no fresh entry for the current time bucket
+        """
+        key = self._key(provider, location)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and self.path:
+                entry = self._readFromDisk(key)
+                if entry is not None:
+                    self._store(key, entry)
+
+            if entry is not None and now - entry[0] < self.ttls.get(provider, 0):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            if entry is not None:
+                self._entries.pop(key, None)
+            self.misses += 1
+            return None
+
+    def put(self, provider, location, observation):
+        """
+        Stores the observation of a location for the current time bucket
+        """
+        if observation is None:
+            return
+        key = self._key(provider, location)
+        entry = (time.time(), observation)
+        with self._lock:
+            self._store(key, entry)
+            if self.path:
+                self._writeToDisk(key, entry)
+
+    def stats(self):
+        """
+        Gets the hit and miss counts of the cache
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+    def clear(self):
+        import shelve
+
+        with self._lock:
+            self._entries.clear()
+            if self.path:
+                with shelve.open(self.path) as disk:
+                    disk.clear()
+
+    def _key(self, provider, location):
+        return (provider, location, get_rounded_time().isoformat())
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _diskKey(self, key):
+        provider, location, bucket = key
+        return f"{bucket}|{provider}|{location}"
+
+    def _readFromDisk(self, key):
+        import shelve
+
+        try:
+            with shelve.open(self.path) as disk:
+                return disk.get(self._diskKey(key))
+        except Exception as e:
+            print(f"Failed to read the observation cache file: {e}")
+            return None
+
+    def _writeToDisk(self, key, entry):
+        import shelve
+
+        bucket = key[2]
+        try:
+            with shelve.open(self.path) as disk:
+                # Entries of earlier time buckets can never be served again, so they are dropped once per bucket
+                if self._diskBucket != bucket:
+                    for oldKey in [diskKey for diskKey in disk.keys() if not diskKey.startswith(bucket + "|")]:
+                        del disk[oldKey]
+                    self._diskBucket = bucket
+                disk[self._diskKey(key)] = entry
+        except Exception as e:
+            print(f"Failed to write the observation cache file: {e}")
+
+# Cache shared by the weather task, backed by a file if OBSERVATION_CACHE_FILE is set
+observation_cache = ObservationCache(
+    max_entries=int(os.getenv("OBSERVATION_CACHE_SIZE", "5000")),
+    path=os.getenv("OBSERVATION_CACHE_FILE") or None,
+)
@@ -0,0 +1,171 @@
+import html
+import math
+from string import Template
+
+# Characters that have to be escaped in HTML text
+_SPECIAL_CHARACTERS = frozenset('&<>"\'')
+
+# The page around the report, compiled once when the module is imported
+_REPORT_TEMPLATE = Template("""
+    <!DOCTYPE html>
+    <html lang="en">
+    <head>
+        <meta charset="UTF-8">
+         <style>
+            body { font-family: Arial, sans-serif; margin: 20px; }
+            h1 { color: #333; }
+            h2 { color: #555; margin-top: 20px; }
+            table { width: 80%; border-collapse: collapse; margin-bottom: 20px; }
+            th, td { border: 1px solid #ddd; padding: 10px; text-align: left; }
+            th { background-color: #f2f2f2; color: #333; }
+            tr:nth-child(even) { background-color: #f9f9f9; }
+            tr:hover { background-color: #ddd; }
+            /* Specific styles for averages */
+            .averages-table {
+                width: 80%;
+                margin-top: 20px;
+                border: 2px solid #007BFF; /* blue border for emphasis */
+            }
+            .averages-table th {
+                background-color: #007BFF; /* blue background for headers */
+                color: white; /* white text for headers */
+                font-weight: bold;
+            }
+            .averages-table td {
+                background-color: #E7F1FF; /* light blue background for data */
+            }
+            .notice {
+                width: 80%;
+                padding: 10px;
+                border: 1px solid #E0A800;
+                background-color: #FFF3CD; /* yellow for missing data */
+            }
+        </style>
+    </head>
+    <body>
+    <h1>Weather Report</h1>
+    $notices$averages$forecasts$charts$sources</body>""")
+
+_AVERAGES_HEADING = """
+    <h2>Averages:</h2>
+    <table class="averages-table">
+    <tr>
+    """
+
+def render_report(weather_data, averages, chart_ids=None, forecasts=None, notices=None):
+    """
+    Renders the HTML body of the weather report
+
+    Every piece of the report is collected into a list and joined once, so rendering time grows
+    linearly with the number of rows. All values are HTML escaped.
+
+    Parameters:
+        weather_data (dict): The observations of each source.
+        averages (list): The rows of averages, as returned by calculateAverages.formatAverages.
+        chart_ids (dict): The Content-ID of each city's chart image attached to the email.
+        forecasts (list): The rows of the forecast table, as returned by forecastStore.format_forecasts.
+        notices (list): Notices shown at the top of the report, such as sources that were not available.
+    """
+    sources = []
+    for source, observations in weather_data.items():
+        if not observations:
+            continue
+        sources.append(f"<h2>Source: {_escape(str(source))}</h2>")
+        sources.append("<table border='1'><tr>")
+        sources.append("".join(f"<th>{_escape(key.capitalize())}</th>" for key in format_observation(observations[0])))
+        sources.append("</tr>")
+        # Rows are formatted straight from the observations, without building a dictionary for each of them
+        sources.extend(_renderObservationRow(observation) for observation in observations)
+        sources.append("</table>")
+
+    return _REPORT_TEMPLATE.substitute(
+        notices="".join(f'<p class="notice">{_escape(notice)}</p>' for notice in notices or ()),
+        averages=render_averages(averages),
+        forecasts=render_forecasts(forecasts),
+        charts=render_charts(chart_ids),
+        sources="".join(sources),
+    )
+
+def render_averages(averages):
+    """
+    Renders the table of averages
+    """
+    if not averages:
+        return ""
+    parts = [_AVERAGES_HEADING]
+    _renderRows(parts, averages, headerRowOpened=True)
+    parts.append("</table>")
+    return "".join(parts)
+
+def render_forecasts(forecasts):
+    """
+    Renders the forecast table, in the same style as the averages
+    """
+    if not forecasts:
+        return ""
+    parts = ['<h2>Forecast:</h2><table class="averages-table">']
+    _renderRows(parts, forecasts)
+    parts.append("</table>")
+    return "".join(parts)
+
+def render_charts(chart_ids):
+    """
+    Renders the chart images, each referring to an image attached to the email by its Content-ID
+    """
+    if not chart_ids:
+        return ""
+    parts = ["<h2>Charts:</h2>"]
+    for city, contentId in chart_ids.items():
+        parts.append(f'<p><img src="cid:{_escape(contentId)}" alt="{_escape(city)}"></p>')
+    return "".join(parts)
+
+def format_observation(observation):
+    """
+    Formats an observation into the columns shown in the report
+    """
+    windSpeedNote = " avarage speed measured in the last 10 minutes" if observation.source == "Finnish Meteorological Institute" else ""
+    return {
+        "kaupunki": observation.city,
+        "lämpötila": _formatValue(observation.temperature, " Celsius"),
+        "säätila": observation.description,
+        "tuulen_nopeus": _formatValue(observation.wind_speed, " m/s" + windSpeedNote),
+    }
+
+def _renderObservationRow(observation):
+    """
+    Renders the same columns as format_observation as one table row
+    """
+    temperature, windSpeed = observation.temperature, observation.wind_speed
+    windSpeedNote = " avarage speed measured in the last 10 minutes" if observation.source == "Finnish Meteorological Institute" else ""
+    # NaN is the only value not equal to itself, checked inline as this runs once per row of the report
+    return "".join((
+        "<tr><td>", _escape(observation.city),
+        "</td><td>", "Ei tietoa" if temperature != temperature else format(temperature, ".1f") + " Celsius",
+        "</td><td>", _escape(observation.description),
+        "</td><td>", "Ei tietoa" if windSpeed != windSpeed else format(windSpeed, ".1f") + " m/s" + windSpeedNote, "</td></tr>",
+    ))
+
+def _formatValue(value, unit):
+    # A station average can lack a parameter that none of the neighbouring stations reported
+    return "Ei tietoa" if math.isnan(value) else format(value, ".1f") + unit
+
+def _renderRows(parts, rows, headerRowOpened=False):
+    """
+    Appends a header row from the keys of the first row, and one row per item, to parts
+    """
+    if not headerRowOpened:
+        parts.append("<tr>")
+    parts.append("".join(f"<th>{_escape(key.capitalize())}</th>" for key in rows[0]))
+    parts.append("</tr>")
+    parts.extend("<tr><td>" + "</td><td>".join(map(_escapeValue, row.values())) + "</td></tr>" for row in rows)
+
+def _escapeValue(value):
+    return _escape(value if isinstance(value, str) else str(value))
+
+def _escape(text):
+    """
+    Escapes text for HTML, skipping the escaping work for the common case of text without special characters
+    """
+    if _SPECIAL_CHARACTERS.isdisjoint(text):
+        return text
+    return html.escape(text)
@@ -0,0 +1,177 @@
+import datetime
+
+from weatherInstitute import observation_interval_minutes
+
+# Shorthands that can be used instead of a cron expression
+schedule_aliases = {
+    "@hourly": "0 * * * *",
+    "@daily": "0 7 * * *",
+    "@weekly": "0 7 * * 1",
+    "@monthly": "0 7 1 * *",
+}
+
+# Allowed range of each cron field: minute, hour, day of month, month, day of week (0 or 7 = Sunday)
+_fieldRanges = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+class CronSchedule:
+    """
+    A cron-like schedule, e.g. "0 7 * * 1" for 07:00 every Monday or "0 7 */3 * *" for every third day
+
+    Fields are minute, hour, day of month, month and day of week. Each field can be "*", a number, a range "a-b",
+    a step "*/n" or "a-b/n", or a comma separated list of these. Like in cron, when both day of month and day of
+    week are restricted, a day matching either of them is enough.
+    """
+
+    def __init__(self, expression):
+        self.expression = expression.strip()
+        fields = schedule_aliases.get(self.expression.lower(), self.expression).split()
+        if len(fields) != 5:
+            raise ValueError(f"Schedule '{expression}' should have 5 fields: minute hour day month weekday")
+
+        minutes, hours, days, months, weekdays = [
+            _parseField(field, low, high, expression) for field, (low, high) in zip(fields, _fieldRanges)
+        ]
+        self.minutes = sorted(minutes)
+        self.hours = sorted(hours)
+        self.days = days
+        self.months = months
+        # Sunday can be given as 0 or 7, Python numbers the weekdays from Monday = 0
+        self.weekdays = {(weekday - 1) % 7 for weekday in weekdays}
+        self.daysRestricted = fields[2] != "*"
+        self.weekdaysRestricted = fields[4] != "*"
+
+    def next_after(self, moment):
+        """
+        Gets the first time after moment that matches the schedule
+
+        Whole days that don't match are skipped at once, so finding a weekly or monthly time is as cheap as an hourly one.
+        """
+        candidate = moment.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        # Four years always contain every possible date, including February 29th
+        for _ in range(366 * 4 + 1):
+            if self._dayMatches(candidate):
+                fire = self._firstTimeOfDay(candidate)
+                if fire is not None:
+                    return fire
+            candidate = (candidate + datetime.timedelta(days=1)).replace(hour=0, minute=0)
+        raise ValueError(f"Schedule '{self.expression}' never fires")
+
+    def _dayMatches(self, day):
+        if day.month not in self.months:
+            return False
+        dayMatches = day.day in self.days
+        weekdayMatches = day.weekday() in self.weekdays
+        if self.daysRestricted and self.weekdaysRestricted:
+            return dayMatches or weekdayMatches
+        return dayMatches and weekdayMatches
+
+    def _firstTimeOfDay(self, start):
+        for hour in self.hours:
+            if hour < start.hour:
+                continue
+            for minute in self.minutes:
+                if hour == start.hour and minute < start.minute:
+                    continue
+                return start.replace(hour=hour, minute=minute)
+        return None
+
+def _parseField(field, low, high, expression):
+    values = set()
+    for part in field.split(","):
+        rangePart, _, step = part.partition("/")
+        if rangePart == "*":
+            start, end = low, high
+        elif "-" in rangePart:
+            start, end = (int(value) for value in rangePart.split("-", 1))
+        else:
+            start = end = int(rangePart)
+            if step:
+                end = high
+        step = int(step) if step else 1
+        if start < low or end > high or start > end or step < 1:
+            raise ValueError(f"Field '{field}' of schedule '{expression}' is out of range {low}-{high}")
+        values.update(range(start, end + 1, step))
+    return values
+
+def align_to_observation_grid(moment):
+    """
+    Moves a time forward to the next 10-minute boundary on which FMI publishes observations, unless it is already on one
+    """
+    aligned = moment.replace(second=0, microsecond=0)
+    overshoot = aligned.minute % observation_interval_minutes
+    if overshoot or aligned != moment:
+        aligned += datetime.timedelta(minutes=observation_interval_minutes - overshoot if overshoot else observation_interval_minutes)
+    return aligned
+
+class ReportScheduler:
+    """
+    Keeps track of when each recipient's next report is due
+
+    Times are absolute, so the time it takes to run a cycle doesn't push the following reports later.
+    """
+
+    def __init__(self, default_schedule):
+        self.default_schedule = default_schedule
+        self._jobs = {}
+
+    def update(self, schedules, now):
+        """
+        Sets the recipients and their schedules, keeping the next due time of recipients whose schedule didn't change
+
+        Parameters:
+            schedules (dict): The schedule expression of each recipient, None for the default schedule.
+            now (datetime): The current local time.
+
+        Returns:
+            list: The recipients whose schedule could not be read, they get the default schedule.
+        """
+        invalid = []
+        jobs = {}
+        for recipient, expression in schedules.items():
+            expression = expression or self.default_schedule
+            previous = self._jobs.get(recipient)
+            if previous is not None and previous[0] == expression:
+                jobs[recipient] = previous
+                continue
+            # A schedule that can't be read, or that never fires such as February 31st, falls back to the default
+            try:
+                schedule = CronSchedule(expression)
+                nextTime = schedule.next_after(now)
+            except ValueError:
+                invalid.append(recipient)
+                schedule = CronSchedule(self.default_schedule)
+                nextTime = schedule.next_after(now)
+            jobs[recipient] = (expression, schedule, align_to_observation_grid(nextTime))
+        self._jobs = jobs
+        return invalid
+
+    def next_due(self):
+        """
+        Gets the time of the soonest due report, or None if there are no recipients
+        """
+        return min((due for _, _, due in self._jobs.values()), default=None)
+
+    def pop_due(self, now):
+        """
+        Gets the recipients whose report is due and moves their next due time forward
+
+        A report that was missed, for example while the computer was asleep, is sent once and not once per missed time.
+        """
+        due = []
+        for recipient, (expression, schedule, dueTime) in self._jobs.items():
+            if dueTime <= now:
+                due.append(recipient)
+                self._jobs[recipient] = (expression, schedule, align_to_observation_grid(schedule.next_after(max(now, dueTime))))
+        return due
+
+    def retry(self, recipients, now, delay):
+        """
+        Makes the reports of the given recipients due again after a delay, for reports that could not be sent
+
+        A recipient whose next scheduled report comes sooner keeps that time.
+        """
+        retryTime = now + datetime.timedelta(seconds=delay)
+        for recipient in recipients:
+            job = self._jobs.get(recipient)
+            if job is not None and retryTime < job[2]:
+                self._jobs[recipient] = (job[0], job[1], retryTime)
@@ -0,0 +1,289 @@
+import bisect
+import datetime
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+import config
+from metrics import metrics
+from observation import Observation
+
+# "aggregator" makes the weather task collect the observations from shard workers instead of fetching them itself
+shard_mode = os.getenv("SHARD_MODE", "")
+
+# Database shared by the aggregator and the workers, on the same machine or on a file system with working locks
+shard_database = os.getenv("SHARD_DATABASE", "shards.db")
+
+# Name of this worker, keep it the same over restarts so the worker gets the same locations back
+shard_worker_name = os.getenv("SHARD_WORKER_NAME") or f"{socket.gethostname()}-{os.getpid()}"
+
+# A worker that hasn't sent a heartbeat for this many seconds is left out and its locations go to the others
+shard_worker_ttl = int(os.getenv("SHARD_WORKER_TTL", "60"))
+
+# How long the aggregator waits for the workers, locations without results by then are missing from the report
+shard_collect_timeout = int(os.getenv("SHARD_COLLECT_TIMEOUT", "120"))
+
+# How often the workers look for work and the aggregator for results, in seconds
+shard_poll_seconds = float(os.getenv("SHARD_POLL_SECONDS", "1"))
+
+# Points of each worker on the hash ring, more points spread the locations more evenly
+shard_virtual_nodes = int(os.getenv("SHARD_VIRTUAL_NODES", "64"))
+
+# Finished collections are kept this long, in seconds
+_RETENTION_SECONDS = 86400
+
+class HashRing:
+    """
+    Consistent hash ring that assigns each location to one worker
+
+    Every worker has a number of points on the ring and a location belongs to the worker of the first point after
+    the location's hash. When a worker joins, it only takes over the locations between its points and the points
+    before them, about 1/N of all locations, and the rest keep their worker.
+    """
+
+    def __init__(self, workers, virtual_nodes=shard_virtual_nodes):
+        points = sorted((_hash(f"{worker}#{node}"), worker) for worker in workers for node in range(virtual_nodes))
+        self._hashes = [point for point, _ in points]
+        self._workers = [worker for _, worker in points]
+
+    def owner(self, location):
+        """
+        Gets the worker the location belongs to, None if the ring has no workers
+        """
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, _hash(location)) % len(self._hashes)
+        return self._workers[index]
+
+    def assign(self, locations):
+        """
+        Splits the locations between the workers
+
+        Returns:
+            dict: The locations of each worker that has any.
+        """
+        shards = {}
+        for location in locations:
+            shards.setdefault(self.owner(location), []).append(location)
+        return shards
+
+class ShardCoordinator:
+    """
+    Hands out the locations of a collection to the shard workers and gathers their observations
+
+    The aggregator opens a collection with the list of locations. Each worker registers with heartbeats, works out
+    its share of the pending locations from the hash ring of the live workers, fetches them and stores the
+    normalised observations. When workers join or leave, the ones that are still alive pick up the locations
+    nobody has stored yet on their next look. A location fetched twice during the change is stored only once.
+    """
+
+    def __init__(self, path, worker_ttl=shard_worker_ttl):
+        self.path = path
+        self.worker_ttl = worker_ttl
+        self._db = None
+        self._dbLock = threading.Lock()
+        self._heartbeat = None
+
+    def heartbeat(self, worker):
+        """
+        Tells the other processes that the worker is alive
+        """
+        with self._dbLock:
+            db = self._connect()
+            db.execute("INSERT OR REPLACE INTO shard_workers (name, heartbeat) VALUES (?, ?)", (worker, time.time()))
+            db.commit()
+
+    def start_heartbeat(self, worker):
+        """
+        Sends heartbeats from a background thread, so a worker stays alive while it fetches a large shard
+        """
+        if self._heartbeat is not None:
+            return
+
+        def beat():
+            while True:
+                try:
+                    self.heartbeat(worker)
+                except sqlite3.Error as e:
+                    print(f"Failed to send the heartbeat of {worker}: {e}")
+                time.sleep(max(1.0, self.worker_ttl / 3))
+
+        self._heartbeat = threading.Thread(target=beat, name="shard-heartbeat", daemon=True)
+        self._heartbeat.start()
+
+    def leave(self, worker):
+        """
+        Removes the worker, its locations go to the other workers right away instead of after the TTL
+        """
+        with self._dbLock:
+            db = self._connect()
+            db.execute("DELETE FROM shard_workers WHERE name = ?", (worker,))
+            db.commit()
+
+    def live_workers(self):
+        """
+        Gets the names of the workers that have sent a heartbeat within the TTL
+        """
+        with self._dbLock:
+            rows = self._connect().execute(
+                "SELECT name FROM shard_workers WHERE heartbeat >= ? ORDER BY name", (time.time() - self.worker_ttl,)
+            ).fetchall()
+        return [name for name, in rows]
+
+    def open_collection(self, locations):
+        """
+        Starts a collection of the given locations
+
+        Returns:
+            int: Id of the collection.
+        """
+        with self._dbLock:
+            db = self._connect()
+            cursor = db.execute(
+                "INSERT INTO shard_collections (created, locations, status) VALUES (?, ?, 'open')",
+                (time.time(), json.dumps(list(dict.fromkeys(locations)), ensure_ascii=False)),
+            )
+            db.commit()
+            return cursor.lastrowid
+
+    def pending_work(self, worker):
+        """
+        Gets the locations of the newest open collection that are this worker's share and have no results yet
+
+        Collections older than the collection timeout are ignored, their aggregator has stopped waiting.
+
+        Returns:
+            tuple: The id of the collection and the worker's locations, or None if there is nothing to do.
+        """
+        with self._dbLock:
+            db = self._connect()
+            row = db.execute(
+                "SELECT id, locations FROM shard_collections WHERE status = 'open' AND created >= ? ORDER BY id DESC LIMIT 1",
+                (time.time() - shard_collect_timeout,),
+            ).fetchone()
+            if row is None:
+                return None
+            collection, locations = row
+            done = {location for location, in db.execute("SELECT DISTINCT location FROM shard_results WHERE collection = ?", (collection,))}
+            workers = [name for name, in db.execute("SELECT name FROM shard_workers WHERE heartbeat >= ?", (time.time() - self.worker_ttl,))]
+
+        if worker not in workers:
+            workers.append(worker)
+        ring = HashRing(workers)
+        mine = [location for location in json.loads(locations) if location not in done and ring.owner(location) == worker]
+        return (collection, mine) if mine else None
+
+    def put_results(self, collection, worker, locations, results):
+        """
+        Stores the observations a worker fetched
+
+        Parameters:
+            collection (int): Id of the collection.
+            worker (str): Name of the worker.
+            locations (list): The locations that were fetched.
+            results (dict): The observations of each source, a list in the same order as locations with None for
+            the locations the source had no data for.
+        """
+        rows = [
+            (collection, source, location, worker, None if observation is None else _encodeObservation(observation))
+            for source, observations in results.items()
+            for location, observation in zip(locations, observations)
+        ]
+        with self._dbLock:
+            db = self._connect()
+            db.executemany(
+                "INSERT OR IGNORE INTO shard_results (collection, source, location, worker, observation) VALUES (?, ?, ?, ?, ?)", rows
+            )
+            db.commit()
+        metrics.increment("shard_locations_total", len(locations), worker=worker)
+
+    def collect(self, locations, sources, timeout=shard_collect_timeout):
+        """
+        Has the workers fetch the locations and waits for their results
+
+        Parameters:
+            locations (list): The locations to collect.
+            sources (list): The providers the workers fetch from.
+            timeout (float): Seconds to wait for the workers.
+
+        Returns:
+            dict: The observations of each source in the same order as locations, with None for the locations that
+            had no data or weren't fetched in time, or None if no workers are alive.
+        """
+        if not self.live_workers():
+            return None
+        collection = self.open_collection(locations)
+        wanted = set(locations)
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._dbLock:
+                done = {location for location, in self._connect().execute(
+                    "SELECT DISTINCT location FROM shard_results WHERE collection = ?", (collection,)
+                )}
+            if wanted <= done or time.monotonic() >= deadline:
+                break
+            time.sleep(shard_poll_seconds)
+
+        with self._dbLock:
+            db = self._connect()
+            rows = db.execute("SELECT source, location, observation FROM shard_results WHERE collection = ?", (collection,)).fetchall()
+            db.execute("UPDATE shard_collections SET status = 'closed' WHERE id = ?", (collection,))
+            self._purge(db)
+            db.commit()
+
+        missing = len(wanted - done)
+        if missing:
+            print(f"{missing} locations were not collected from the shard workers in time.")
+            metrics.increment("shard_missing_locations_total", missing)
+
+        results = {source: {} for source in sources}
+        for source, location, observation in rows:
+            if source in results and observation is not None:
+                results[source][location] = _decodeObservation(observation)
+        return {source: [byLocation.get(location) for location in locations] for source, byLocation in results.items()}
+
+    def _purge(self, db):
+        expired = time.time() - _RETENTION_SECONDS
+        db.execute("DELETE FROM shard_results WHERE collection IN (SELECT id FROM shard_collections WHERE created < ?)", (expired,))
+        db.execute("DELETE FROM shard_collections WHERE created < ?", (expired,))
+        db.execute("DELETE FROM shard_workers WHERE heartbeat < ?", (expired,))
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS shard_workers (name TEXT PRIMARY KEY, heartbeat REAL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS shard_collections (id INTEGER PRIMARY KEY, created REAL, locations TEXT, status TEXT)")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS shard_results (collection INTEGER, source TEXT, location TEXT, worker TEXT, "
+                "observation TEXT, PRIMARY KEY (collection, source, location))"
+            )
+            self._db.commit()
+        return self._db
+
+def _hash(key):
+    # Python's own hash is different in every process, so the ring uses a hash that all workers agree on
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+def _encodeObservation(observation):
+    return json.dumps({
+        "city": observation.city,
+        "source": observation.source,
+        "temperature": observation.temperature,
+        "wind_speed": observation.wind_speed,
+        "timestamp": observation.timestamp.isoformat(),
+        "wawa": observation.wawa,
+        "condition": observation.condition,
+    }, ensure_ascii=False)
+
+def _decodeObservation(text):
+    values = json.loads(text)
+    values["timestamp"] = datetime.datetime.fromisoformat(values["timestamp"])
+    return Observation(**values)
+
+# Coordinator shared by the weather task and the shard worker task
+shard_coordinator = ShardCoordinator(shard_database)
@@ -0,0 +1,157 @@
+import heapq
+import math
+import os
+import threading
+
+import config
+from metrics import metrics
+from observation import Observation
+
+# Number of nearest stations averaged for each location
+fmi_nearest_stations = int(os.getenv("FMI_NEAREST_STATIONS", "3"))
+
+# Stations further than this from a location, in kilometres, are not used for it
+fmi_nearest_max_km = float(os.getenv("FMI_NEAREST_MAX_KM", "50"))
+
+_EARTH_RADIUS_KM = 6371.0
+
+# A station closer than this, in kilometres, is taken to be at the location and its values are used as such
+_SAME_PLACE_KM = 0.05
+
+class KDTree:
+    """
+    k-d tree over points on the earth's surface, for finding the nearest points in O(log n)
+
+    The points are stored as 3D unit vectors, so distances are right also far up north where a degree of longitude
+    is short, and the straight-line distance orders the points the same way as the distance along the surface.
+    """
+
+    def __init__(self, coordinates):
+        self._points = [_unitVector(latitude, longitude) for latitude, longitude in coordinates]
+        self._root = self._build(list(range(len(self._points))), 0)
+
+    def nearest(self, latitude, longitude, k):
+        """
+        Gets the k points nearest to a coordinate
+
+        Returns:
+            list: (distance in kilometres, index of the point) tuples, the nearest first.
+        """
+        point = _unitVector(latitude, longitude)
+        found = []  # Max-heap of the k nearest so far, as (-squared distance, index)
+
+        def search(node):
+            if node is None:
+                return
+            index, axis, left, right = node
+            other = self._points[index]
+            distance = (point[0] - other[0]) ** 2 + (point[1] - other[1]) ** 2 + (point[2] - other[2]) ** 2
+            if len(found) < k:
+                heapq.heappush(found, (-distance, index))
+            elif distance < -found[0][0]:
+                heapq.heapreplace(found, (-distance, index))
+            difference = point[axis] - other[axis]
+            near, far = (left, right) if difference < 0 else (right, left)
+            search(near)
+            # The other side can only hold nearer points if the splitting plane is closer than the furthest point found
+            if len(found) < k or difference * difference < -found[0][0]:
+                search(far)
+
+        if k > 0:
+            search(self._root)
+        return sorted((2 * _EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(-distance) / 2)), index) for distance, index in found)
+
+    def _build(self, indices, depth):
+        if not indices:
+            return None
+        axis = depth % 3
+        indices.sort(key=lambda index: self._points[index][axis])
+        middle = len(indices) // 2
+        return (indices[middle], axis, self._build(indices[:middle], depth + 1), self._build(indices[middle + 1:], depth + 1))
+
+class StationIndex:
+    """
+    The nearest FMI stations of each location, kept between cycles
+
+    The tree is built again only when the set of stations in the response changes, and the neighbours of each
+    location are looked up once per tree. A cycle then only has to weigh the values of the neighbours.
+    """
+
+    def __init__(self, k=fmi_nearest_stations, max_km=fmi_nearest_max_km):
+        self.k = k
+        self.max_km = max_km
+        self._stations = None
+        self._tree = None
+        self._neighbours = {}
+        self._lock = threading.Lock()
+
+    def aggregate(self, locations, stations):
+        """
+        Gives each location the inverse distance weighted average of its nearest stations
+
+        Each parameter is averaged over the neighbours that have a value for it. The weather code can't be averaged,
+        so it is taken from the nearest station that has one.
+
+        Parameters:
+            locations (dict): The (latitude, longitude) of each location.
+            stations (list): The (latitude, longitude, observation) of each station, as returned by parse_station_observations.
+
+        Returns:
+            dict: The observation of each location, None for locations without a station within the maximum distance.
+        """
+        stations = sorted(stations, key=lambda station: (station[0], station[1]))
+        with self._lock:
+            self._update([(latitude, longitude) for latitude, longitude, _ in stations])
+            neighbours = {location: self._nearest(coordinate) for location, coordinate in locations.items()}
+        return {location: _weigh(location, [(distance, stations[index][2]) for distance, index in near]) for location, near in neighbours.items()}
+
+    def _update(self, coordinates):
+        coordinates = tuple(coordinates)
+        if coordinates == self._stations:
+            return
+        self._stations = coordinates
+        self._tree = KDTree(coordinates)
+        self._neighbours = {}
+        metrics.increment("station_index_builds_total")
+
+    def _nearest(self, coordinate):
+        near = self._neighbours.get(coordinate)
+        if near is None:
+            near = [(distance, index) for distance, index in self._tree.nearest(coordinate[0], coordinate[1], self.k) if distance <= self.max_km]
+            self._neighbours[coordinate] = near
+        return near
+
+def _weigh(location, neighbours):
+    """
+    Forms the observation of a location from its neighbouring stations' observations, nearest first
+    """
+    if not neighbours:
+        return None
+    values = {}
+    for parameter in ("temperature", "wind_speed"):
+        weighted = [(distance, getattr(observation, parameter)) for distance, observation in neighbours if not math.isnan(getattr(observation, parameter))]
+        if weighted and weighted[0][0] < _SAME_PLACE_KM:
+            values[parameter] = weighted[0][1]
+        elif weighted:
+            weights = [1 / distance ** 2 for distance, _ in weighted]
+            values[parameter] = sum(weight * value for weight, (_, value) in zip(weights, weighted)) / sum(weights)
+        else:
+            values[parameter] = math.nan
+    if math.isnan(values["temperature"]) and math.isnan(values["wind_speed"]):
+        return None
+
+    return Observation(
+        city=location,
+        source="Finnish Meteorological Institute",
+        temperature=values["temperature"],
+        wind_speed=values["wind_speed"],
+        timestamp=max(observation.timestamp for _, observation in neighbours),
+        wawa=next((observation.wawa for _, observation in neighbours if observation.wawa is not None), None),
+    )
+
+def _unitVector(latitude, longitude):
+    latitude, longitude = math.radians(latitude), math.radians(longitude)
+    return (math.cos(latitude) * math.cos(longitude), math.cos(latitude) * math.sin(longitude), math.sin(latitude))
+
+# Index shared by the FMI fetches of the weather task
+station_index = StationIndex()
@@ -1,83 +1,613 @@
 from robocorp.tasks import task
 import requests
+import atexit
 import datetime
 import os
-from dotenv import load_dotenv
 import traceback
 import time
+import threading
+import dataclasses
+from concurrent.futures import ThreadPoolExecutor
 
-from weather_bot import send_weather_email, log_email_send
-from weatherInstitute import get_rounded_time, parse_weather_data
-from dataHandling import getLocationsFromExcel, getRecipienEmails, sortDataByCity
-from calculateAverages import calculateAverages
+import config
+
+from weather_bot import send_weather_email, send_alert_emails
+from weatherInstitute import get_rounded_time, parse_weather_data, parse_weather_data_by_location, parse_coverage_weather_data, parse_coverage_weather_data_by_location, parse_forecast_origin_time, parse_forecast_by_location, parse_station, parse_station_observations, forecast_parameters
+from dataHandling import getLocationsFromExcel, getRecipientSchedules, getNotificationRules, sortDataByCity
+from calculateAverages import aggregateWeatherData, formatAverages
 from errorHandling import reportErrorData
+from httpTransport import CircuitOpenError, request_with_retries
+from observationCache import observation_cache
+from observation import Observation
+from logStore import log_store, export_logs_if_due
+from mailTransport import outbox
+from scheduler import ReportScheduler, align_to_observation_grid
+from historyStore import history_store
+from chartRenderer import start_charts, collect_charts
+from forecastStore import forecast_store, format_forecasts
+from notificationRules import notification_rules
+from metrics import metrics
+from locationResolver import location_resolver
+from stationIndex import station_index
+from sharding import shard_mode, shard_coordinator, shard_worker_name, shard_poll_seconds
+
+# Maximum number of simultaneous requests made to each weather provider
+provider_concurrency = {
+    "OpenWeatherMap": int(os.getenv("OPENWEATHER_MAX_CONCURRENCY", "8")),
+    "Finnish Meteorological Institute": int(os.getenv("FMI_MAX_CONCURRENCY", "4")),
+}
+
+# Endpoints of the weather providers, can be pointed at local stand-ins for benchmarks
+fmi_wfs_url = os.getenv("FMI_WFS_URL", "https://opendata.fmi.fi/wfs")
+openweather_url = os.getenv("OPENWEATHER_URL", "http://api.openweathermap.org/data/2.5/weather")
+openweather_group_url = os.getenv("OPENWEATHER_GROUP_URL", "http://api.openweathermap.org/data/2.5/group")
+
+# Number of cities in one OpenWeatherMap group request, OpenWeatherMap allows at most 20
+openweather_group_size = min(20, int(os.getenv("OPENWEATHER_GROUP_SIZE", "20")))
+
+# Number of past days the current temperature is compared against in the report
+history_comparison_days = int(os.getenv("HISTORY_COMPARISON_DAYS", "30"))
+
+# Report schedule of recipients that have no "Schedule" of their own in Users.xlsx, see scheduler.CronSchedule
+default_report_schedule = os.getenv("DEFAULT_REPORT_SCHEDULE", "@daily")
+
+# Users.xlsx is checked for new recipients and changed schedules at least this often, in seconds
+schedule_check_seconds = 300
+
+# A report that could not be made or sent is tried again after this many seconds
+report_retry_seconds = int(os.getenv("REPORT_RETRY_SECONDS", "60"))
+
+# Number of places packed into one request to the Finnish Meteorological Institute
+fmi_batch_size = int(os.getenv("FMI_BATCH_SIZE", "20"))
+
+# Format of the FMI observation responses, "multipointcoverage" gives the values as a block of numbers instead of
+# one XML element per value, which is much smaller when the time window is long
+fmi_response_format = os.getenv("FMI_RESPONSE_FORMAT", "simple")
+
+# Parsers of a single place and of several places for each FMI response format
+fmi_parsers = {
+    "simple": (parse_weather_data, parse_weather_data_by_location),
+    "multipointcoverage": (parse_coverage_weather_data, parse_coverage_weather_data_by_location),
+}
+if fmi_response_format not in fmi_parsers:
+    print(f"Unknown FMI_RESPONSE_FORMAT '{fmi_response_format}', using 'simple'")
+    fmi_response_format = "simple"
+
+# "region" gets every FMI station in FMI_BBOX with one request and gives each location the distance weighted
+# average of its nearest stations, "place" asks FMI for the one station it picks for each place
+fmi_observation_mode = os.getenv("FMI_OBSERVATION_MODE", "place")
+
+# Bounding box of the region mode as min longitude, min latitude, max longitude, max latitude, all of Finland by default
+fmi_bbox = os.getenv("FMI_BBOX", "19.0,59.5,31.6,70.1")
 
-# Load environment variables from .env file
-load_dotenv()
+# Stored query of the forecasts, without the format suffix, and how many hours ahead are fetched
+fmi_forecast_query = os.getenv("FMI_FORECAST_QUERY", "fmi::forecast::harmonie::surface::point")
+forecast_hours = int(os.getenv("FORECAST_HOURS", "48"))
+
+# Rows of Rules.xlsx that have already been reported as invalid, so they are reported only once
+__reportedInvalidRules = set()
 
 @task
 def weather_task():
     print("Starting weather task...")
+    atexit.register(metrics.export)
 
-    # Define the interval in minutes for testing or production use
-    interval_minutes = 1  # Set to your desired interval (e.g., 60 minutes)
+    # Deliver mail that an earlier run left in the outbox
+    outbox.start()
 
-    # try:
-    #     raise ValueError("Testing!!!");
-    # except Exception as e:
-    #     reportErrorData("High", e, traceback.extract_tb(e.__traceback__))
-    # return
+    scheduler = ReportScheduler(default_report_schedule)
+    next_alert_check = datetime.datetime.now()
 
     while True:
+        due_recipients = []
         try:
-            # Load API key and other settings
-            api_key = os.getenv("OPENWEATHER_API_KEY")
-            if not api_key:
-                raise ValueError("API key not set.")
-            
-            # Fetch locations and recipient emails from Excel files
-            excelFileEnd = ".xlsx"
-            locations = getLocationsFromExcel(f"Locations{excelFileEnd}", ["Helsinki,Espoo,Vantaa"])
-            recipient_emails = getRecipienEmails(f"Users{excelFileEnd}", os.getenv("DEFAULT_ADMINS"))
-
-            # Initialize data containers
-            openweather_data = []
-            weather_institute_data = []
-            weatherData_Averages = []
-
-            # Fetch weather data from OpenWeatherMap and Finnish Meteorological Institute
-            for location in locations:
-                openweather_data.append(get_weather_data(location, api_key))
-                weather_institute_data.append(fetch_weather_data_from_weatherInstitute(location, retries=3))
-
-            if openweather_data and weather_institute_data:
-                # Combine the data from both sources
-                combined_weather_data = {
-                    "OpenWeatherMap": openweather_data,
-                    "Finnish Meteorological Institute": weather_institute_data
-                }
-
-                # Sort and calculate averages
-                sortedData = sortDataByCity(combined_weather_data)
-                for city in sortedData.values():
-                    weatherData_Averages.append(calculateAverages(city))
-
-                # Send the email and log the result
-                if send_weather_email(combined_weather_data, weatherData_Averages, recipient_emails):
-                    print("Email sent and logged successfully.")
-                else:
-                    print("Failed to send email.")
-                    reportErrorData("Medium", "Failed to send email", "tasks.py")
-            else:
-                print("Failed to retrieve weather data from one or both sources.")
-                reportErrorData("Medium", "Failed to retrieve weather data", "tasks.py")
+            # Reads the recipients and their schedules, Users.xlsx is only parsed again when it has changed
+            schedules = getRecipientSchedules("Users.xlsx", os.getenv("DEFAULT_ADMINS"))
+            for recipient in scheduler.update(schedules, datetime.datetime.now()):
+                reportErrorData("Medium", f"Invalid schedule '{schedules[recipient]}' for {recipient}, using '{default_report_schedule}'", "Users.xlsx")
+            update_notification_rules()
+
+            # Data is collected only when a report is due, for the recipients it is due for, or when alerts are checked
+            due_recipients = scheduler.pop_due(datetime.datetime.now())
+            check_alerts = len(notification_rules) > 0 and datetime.datetime.now() >= next_alert_check
+            if check_alerts:
+                next_alert_check = align_to_observation_grid(datetime.datetime.now())
+            if (due_recipients or check_alerts) and not run_weather_cycle(due_recipients) and due_recipients:
+                print(f"The report was not sent, trying again in {report_retry_seconds} seconds.")
+                scheduler.retry(due_recipients, datetime.datetime.now(), report_retry_seconds)
 
         except Exception as e:
             reportErrorData("High", e, traceback.extract_tb(e.__traceback__))
+            # The recipients whose report was due get it on the next try, not only at their next scheduled time
+            scheduler.retry(due_recipients, datetime.datetime.now(), report_retry_seconds)
+
+        # Regenerate Log.xlsx and error_log.xlsx from the log store every now and then
+        export_logs_if_due()
+        metrics.export_if_due()
+
+        # Sleeps until an absolute time, so the time the cycle took doesn't make the schedule drift
+        wake_up = datetime.datetime.now() + datetime.timedelta(seconds=schedule_check_seconds)
+        next_due = scheduler.next_due()
+        if next_due is not None and next_due < wake_up:
+            wake_up = next_due
+        if len(notification_rules) > 0 and next_alert_check < wake_up:
+            wake_up = next_alert_check
+        print(f"Waiting until {wake_up:%Y-%m-%d %H:%M} before the next task...")
+        time.sleep(max(0.0, (wake_up - datetime.datetime.now()).total_seconds()))
+
+def run_weather_cycle(recipient_emails):
+    """
+    Collects the weather data of every location, checks the notification rules and sends the report to the given recipients
+
+    Parameters:
+        recipient_emails (list): The recipients whose report is due, none when only the notification rules are checked.
+
+    Returns:
+        bool: False if no weather data could be fetched or the report could not be sent.
+    """
+    # Load API key and other settings
+    api_key = os.getenv("OPENWEATHER_API_KEY")
+    if not api_key:
+        raise ValueError("API key not set.")
+    
+    with metrics.span("cycle_seconds", kind="report" if recipient_emails else "alerts"):
+        return __runWeatherCycle(api_key, recipient_emails)
 
-        # Wait for the specified interval before the next email send
-        print(f"Waiting for {interval_minutes} minutes before the next task...")
-        time.sleep(interval_minutes * 60)  # Convert minutes to seconds
+def __runWeatherCycle(api_key, recipient_emails):
+    # Fetch locations from the Excel file
+    with metrics.span("stage_seconds", stage="read_locations"):
+        locations = getLocationsFromExcel("Locations.xlsx", ["Helsinki", "Espoo", "Vantaa"])
+    # The ids of names that left the sheet are forgotten, only this task sees the whole sheet
+    location_resolver.validate("Locations.xlsx", locations)
+
+    # Fetch weather data from OpenWeatherMap and Finnish Meteorological Institute
+    with metrics.span("stage_seconds", stage="fetch"):
+        openweather_data, weather_institute_data = collect_weather_data(locations, api_key)
+    with metrics.span("stage_seconds", stage="history"):
+        historical_means = store_history(openweather_data + weather_institute_data, with_means=bool(recipient_emails))
+    if recipient_emails:
+        # Charts are drawn in other processes while the averages are calculated
+        with metrics.span("stage_seconds", stage="start_charts"):
+            pendingCharts = start_report_charts(locations)
+        with metrics.span("stage_seconds", stage="forecasts"):
+            forecasts = update_forecasts(locations)
+
+    # The report is made from the sources that answered, and the ones that didn't are named in it
+    fetched = {"OpenWeatherMap": openweather_data, "Finnish Meteorological Institute": weather_institute_data}
+    combined_weather_data = {source: [data for data in results if data is not None] for source, results in fetched.items()}
+    missing_notices = describe_missing_data(locations, fetched)
+
+    if any(combined_weather_data.values()):
+        combined_weather_data = {source: results for source, results in combined_weather_data.items() if results}
+        for source in fetched:
+            if source not in combined_weather_data:
+                reportErrorData("Medium", f"No weather data from {source}, the report is made without it", "tasks.py")
+
+        # Sort and calculate averages
+        with metrics.span("stage_seconds", stage="averages"):
+            sortedData = sortDataByCity(combined_weather_data)
+            aggregated = aggregateWeatherData(sortedData)
+        with metrics.span("stage_seconds", stage="notification_rules"):
+            check_notification_rules(aggregated)
+        if not recipient_emails:
+            return True
+        weatherData_Averages = formatAverages(aggregated, historical_means)
+
+        # Send the email and log the result
+        with metrics.span("stage_seconds", stage="collect_charts"):
+            charts = collect_charts(pendingCharts)
+        if len(charts) < len(pendingCharts):
+            missing_notices.append(f"Raportissa on kaaviot {len(charts)} kaupungille, {len(pendingCharts) - len(charts)} kaupungin kaaviot on jätetty pois.")
+        with metrics.span("stage_seconds", stage="send"):
+            sent = send_weather_email(combined_weather_data, weatherData_Averages, recipient_emails, charts, format_forecasts(forecasts), missing_notices)
+        if sent:
+            print("Email sent and logged successfully.")
+        else:
+            print("Failed to send email.")
+            reportErrorData("Medium", "Failed to send email", "tasks.py")
+        return sent
+    else:
+        print("Failed to retrieve weather data from all sources.")
+        reportErrorData("High", "Failed to retrieve weather data from all sources", "tasks.py")
+        return False
+
+def describe_missing_data(locations, fetched):
+    """
+    Describes the sources that had no data for some or all of the locations, for the notice at the top of the report
+
+    Parameters:
+        locations (list): The locations that were fetched.
+        fetched (dict): The results of each source in the same order as locations, None for a location without data.
+
+    Returns:
+        list: One notice per source that is missing data.
+    """
+    notices = []
+    for source, results in fetched.items():
+        missing = [location for location, data in zip(locations, results) if data is None]
+        if not missing:
+            continue
+        if len(missing) == len(locations):
+            notices.append(f"{source} ei ollut saatavilla, raportti on tehty muista lähteistä.")
+            continue
+        names = ", ".join(missing[:10]) + (f" ja {len(missing) - 10} muuta" if len(missing) > 10 else "")
+        notices.append(f"{source}: tiedot puuttuvat kaupungeilta {names}.")
+    return notices
+
+def update_notification_rules():
+    """
+    Reads the notification rules from Rules.xlsx, the file is only parsed again when it has changed
+    """
+    rules, invalid = getNotificationRules("Rules.xlsx")
+    newInvalid = set(invalid) - __reportedInvalidRules
+    for rowNumber, error in sorted(newInvalid):
+        reportErrorData("Medium", f"Invalid notification rule on row {rowNumber}: {error}", "Rules.xlsx")
+    __reportedInvalidRules.clear()
+    __reportedInvalidRules.update(invalid)
+    notification_rules.update(rules)
+
+def check_notification_rules(aggregated):
+    """
+    Sends alerts for the notification rules that became true with the latest averages of each city
+    """
+    values = {}
+    for index, city in enumerate(aggregated["cities"]):
+        values[(city, "temperature")] = float(aggregated["temperature_mean"][index])
+        values[(city, "wind_speed")] = float(aggregated["wind_speed_mean"][index])
+    alerts = notification_rules.evaluate(values)
+    notification_rules.save()
+    if alerts:
+        print(f"{len(alerts)} notification rules triggered, alerting {send_alert_emails(alerts)} users.")
+
+def store_history(observations, with_means=True):
+    """
+    Adds the observations to the history and gets the mean temperature of each city over the previous days
+
+    A failure here is reported but doesn't stop the report from being sent.
+
+    Parameters:
+        observations (list): The observations to store.
+        with_means (bool): Whether to read the means, they are only needed for a report.
+
+    Returns:
+        dict: The historical mean temperature of each city, or None if the history could not be used or wasn't asked for.
+    """
+    today = datetime.datetime.now(datetime.timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    try:
+        stored = history_store.append(observations)
+        print(f"Stored {stored} observations in the history.")
+        # Yesterday is left uncompacted, a provider can still report an observation from just before midnight
+        history_store.compact((today - datetime.timedelta(days=1)).date())
+        if not with_means:
+            return None
+        return history_store.location_means("temperature", today - datetime.timedelta(days=history_comparison_days), today)
+    except Exception as e:
+        print(f"Failed to use the history: {e}")
+        reportErrorData("Low", f"Failed to use the history: {e}", "tasks.py")
+        return None
+
+def start_report_charts(locations):
+    """
+    Starts drawing the chart of each location, a failure leaves the charts out of the report
+    """
+    try:
+        return start_charts(history_store, locations)
+    except Exception as e:
+        print(f"Failed to draw the charts: {e}")
+        reportErrorData("Low", f"Failed to draw the charts: {e}", "tasks.py")
+        return {}
+
+@task
+def export_logs():
+    """
+    Exports the email and error logs into Log.xlsx and error_log.xlsx on demand
+    """
+    log_store.export_all()
+
+@task
+def shard_worker():
+    """
+    Fetches this worker's share of the locations whenever the aggregator starts a collection
+
+    Run one or more of these next to a weather task started with SHARD_MODE=aggregator, each with its own SHARD_WORKER_NAME.
+    """
+    api_key = os.getenv("OPENWEATHER_API_KEY")
+    if not api_key:
+        raise ValueError("API key not set.")
+
+    print(f"Starting shard worker {shard_worker_name}...")
+    atexit.register(metrics.export)
+    shard_coordinator.start_heartbeat(shard_worker_name)
+    try:
+        while True:
+            try:
+                work = shard_coordinator.pending_work(shard_worker_name)
+                if work is not None:
+                    collection, locations = work
+                    resolve_locations(locations)
+                    with metrics.span("stage_seconds", stage="shard_fetch"):
+                        openweather_data, weather_institute_data = fetch_all_weather_data(locations, api_key)
+                    shard_coordinator.put_results(collection, shard_worker_name, locations, {
+                        "OpenWeatherMap": openweather_data,
+                        "Finnish Meteorological Institute": weather_institute_data,
+                    })
+                    print(f"Fetched {len(locations)} locations of collection {collection}.")
+                    continue
+            except Exception as e:
+                reportErrorData("High", e, traceback.extract_tb(e.__traceback__))
+            metrics.export_if_due()
+            time.sleep(shard_poll_seconds)
+    finally:
+        shard_coordinator.leave(shard_worker_name)
+
+def collect_weather_data(locations, api_key):
+    """
+    Gets the weather data of every location, from the shard workers when the task runs as their aggregator
+
+    The workers resolve the stations of their own locations. Without live workers the aggregator resolves and
+    fetches the locations itself.
+
+    Returns:
+        tuple: The OpenWeatherMap and Finnish Meteorological Institute results, as returned by fetch_all_weather_data
+    """
+    if shard_mode == "aggregator":
+        results = shard_coordinator.collect(locations, ["OpenWeatherMap", "Finnish Meteorological Institute"])
+        if results is not None:
+            # Picks up the ids the workers stored, the forecasts are asked for at their stations
+            location_resolver.refresh()
+            return results["OpenWeatherMap"], results["Finnish Meteorological Institute"]
+        print("No shard workers are alive, fetching the locations here.")
+    with metrics.span("stage_seconds", stage="resolve_locations"):
+        resolve_locations(locations)
+    return fetch_all_weather_data(locations, api_key)
+
+def fetch_all_weather_data(locations, api_key, concurrency=None, batch_size=None):
+    """
+    Fetches weather data for every location from both providers concurrently
+
+    Parameters:
+        locations (list): The city names to get weather data for.
+        api_key (str): Your OpenWeatherMap API key.
+        concurrency (dict): Maximum number of simultaneous requests per provider, defaults to provider_concurrency
+        batch_size (int): Number of places in one Finnish Meteorological Institute request, defaults to fmi_batch_size
+
+    Returns:
+        tuple: The OpenWeatherMap and Finnish Meteorological Institute results, each a list in the same order as locations,
+        with None for the locations a provider had no data for
+    """
+    limits = dict(provider_concurrency, **(concurrency or {}))
+    fmiBatchSize = max(1, batch_size or fmi_batch_size)
+
+    # Each provider gets a function that splits its locations into requests, and one that fetches one request worth of them
+    fetchers = {
+        "OpenWeatherMap": (__openWeatherRequests, lambda cities: get_weather_data_group(cities, api_key)),
+        "Finnish Meteorological Institute": (
+            lambda cities: __split(cities, fmiBatchSize),
+            lambda cities: fetch_weather_data_from_weatherInstitute_batch(cities, retries=3),
+        ),
+    }
+    if fmi_observation_mode == "region":
+        # One request covers the stations of every location
+        fetchers["Finnish Meteorological Institute"] = (
+            lambda cities: [cities] if cities else [],
+            lambda cities: fetch_weather_data_from_weatherInstitute_region(cities, retries=3, batch_size=fmiBatchSize),
+        )
+
+    # One semaphore per provider keeps a slow provider from using up the whole pool
+    semaphores = {source: threading.BoundedSemaphore(max(1, limits[source])) for source in fetchers}
+
+    def limited(source, cities):
+        with semaphores[source]:
+            return fetchers[source][1](cities)
+
+    if not locations:
+        return [], []
+
+    # Observations that are still fresh for the current 10-minute bucket are served from the cache
+    results = {source: {} for source in fetchers}
+    missing = {source: [] for source in fetchers}
+    for source in fetchers:
+        for city in locations:
+            cached = observation_cache.get(source, city)
+            if cached is None:
+                missing[source].append(city)
+            else:
+                results[source][city] = cached
+        metrics.increment("cache_hits_total", len(locations) - len(missing[source]), provider=source)
+        metrics.increment("cache_misses_total", len(missing[source]), provider=source)
+
+    with ThreadPoolExecutor(max_workers=sum(max(1, limits[source]) for source in fetchers)) as executor:
+        futures = {
+            source: [(request, executor.submit(limited, source, request)) for request in fetchers[source][0](cities)]
+            for source, cities in missing.items()
+        }
+        # A request that failed leaves its cities without data from that provider, the other requests are still used
+        for source, sourceFutures in futures.items():
+            failures = []
+            for cities, future in sourceFutures:
+                try:
+                    sourceResults = future.result()
+                except Exception as e:
+                    failures.append(e)
+                    sourceResults = [None] * len(cities)
+                for city, data in zip(cities, sourceResults):
+                    observation_cache.put(source, city, data)
+                    results[source][city] = data
+            __reportFetchFailures(source, failures)
+
+    print(f"Observation cache: {observation_cache.stats()}")
+    # The OpenWeatherMap ids learned from the responses are kept for the next cycles
+    location_resolver.save()
+
+    results = {source: [dataByCity[city] for city in locations] for source, dataByCity in results.items()}
+    return results["OpenWeatherMap"], results["Finnish Meteorological Institute"]
+
+def __split(cities, size):
+    return [cities[start:start + size] for start in range(0, len(cities), size)]
+
+def __openWeatherRequests(cities):
+    """
+    Splits the cities into OpenWeatherMap requests, cities with a known id are fetched in groups and the rest one by one
+    """
+    known = [city for city in cities if location_resolver.openweather_id(city) is not None]
+    unknown = [city for city in cities if location_resolver.openweather_id(city) is None]
+    return __split(known, openweather_group_size) + [[city] for city in unknown]
+
+def __reportFetchFailures(source, failures):
+    """
+    Reports the failed requests of a provider once, instead of once per request
+    """
+    failures = [failure for failure in failures if not isinstance(failure, CircuitOpenError)]
+    if failures:
+        print(f"{len(failures)} requests to {source} failed: {failures[0]}")
+        reportErrorData("High", f"{len(failures)} requests to {source} failed, the first with: {failures[0]}", traceback.extract_tb(failures[0].__traceback__))
+
+def resolve_locations(locations):
+    """
+    Finds the FMI station of each location that doesn't have one yet, the OpenWeatherMap ids are learned from its responses
+
+    A location that can't be resolved is still fetched by name.
+    """
+    location_resolver.refresh()
+    unresolved = location_resolver.unresolved_stations(locations)
+    if not unresolved:
+        return
+    print(f"Resolving the FMI stations of {len(unresolved)} locations")
+
+    def resolve(city):
+        try:
+            location_resolver.put_station(city, fetch_station(city))
+        except CircuitOpenError:
+            pass
+        except Exception as e:
+            print(f"Failed to resolve the FMI station of {city}: {e}")
+            location_resolver.put_station(city, None)
+
+    with ThreadPoolExecutor(max_workers=max(1, provider_concurrency["Finnish Meteorological Institute"])) as executor:
+        list(executor.map(resolve, unresolved))
+    location_resolver.save()
+
+def fetch_station(city):
+    """
+    Asks FMI which station it uses for a place name, with a request for a single value of that place
+
+    Returns:
+        tuple: The fmisid, latitude and longitude of the station, or None if FMI has no station for the name.
+    """
+    rounded_time = get_rounded_time()
+    params = {
+        "service": "WFS",
+        "version": "2.0.0",
+        "request": "getFeature",
+        "storedquery_id": "fmi::observations::weather::timevaluepair",
+        "place": city,
+        "parameters": "t2m",
+        "starttime": (rounded_time - datetime.timedelta(hours=1)).isoformat(),
+        "endtime": rounded_time.isoformat(),
+    }
+    response = request_with_retries("Finnish Meteorological Institute", fmi_wfs_url, params=params)
+    if response.status_code == 400:
+        # FMI answers an unknown place name with 400
+        return None
+    response.raise_for_status()
+    return parse_station(response.content)
+
+def update_forecasts(locations):
+    """
+    Gets the forecast of each location, fetching only the locations that don't have the newest model run yet
+
+    Forecasts are asked for at the coordinates of each location's FMI station, so locations whose station isn't
+    known have no forecast. A failed batch is reported and the forecasts that are already stored are used.
+
+    Returns:
+        dict: The origin time and forecast points of each location that has a forecast.
+    """
+    positions = {location: location_resolver.station_coordinates(location) for location in dict.fromkeys(locations)}
+    positions = {location: position for location, position in positions.items() if position is not None}
+    try:
+        if positions:
+            probe = next(iter(positions.values()))
+            origin = forecast_store.latest_origin(lambda: fetch_forecast_origin_time(probe))
+        else:
+            origin = None
+        outdated = forecast_store.outdated(list(positions), origin) if origin is not None else []
+    except CircuitOpenError as e:
+        print(f"Forecasts were not updated: {e}")
+        outdated = []
+    except Exception as e:
+        print(f"Failed to update the forecasts: {e}")
+        reportErrorData("Low", f"Failed to update the forecasts: {e}", "tasks.py")
+        outdated = []
+
+    if outdated:
+        print(f"Fetching forecasts of the model run from {origin:%Y-%m-%d %H:%M} for {len(outdated)} locations")
+    failed = []
+    for start in range(0, len(outdated), fmi_batch_size):
+        cities = outdated[start:start + fmi_batch_size]
+        try:
+            forecast_store.put(origin, fetch_forecasts_from_weatherInstitute({city: positions[city] for city in cities}, origin))
+        except CircuitOpenError as e:
+            print(f"Forecasts were not updated: {e}")
+            break
+        except Exception as e:
+            # One bad batch doesn't keep the later batches from being fetched
+            print(f"Failed to fetch the forecasts of {len(cities)} locations: {e}")
+            failed.extend(cities)
+    if failed:
+        reportErrorData("Low", f"Failed to fetch the forecasts of {len(failed)} locations, e.g. {', '.join(failed[:5])}", "tasks.py")
+    return forecast_store.get(locations)
+
+def fetch_forecast_origin_time(position):
+    """
+    Asks FMI for the origin time of the newest model run, with a request for a single value at a single point
+
+    Parameters:
+        position (tuple): The (latitude, longitude) of a known FMI station.
+    """
+    nextHour = (datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
+    params = {
+        "service": "WFS",
+        "version": "2.0.0",
+        "request": "getFeature",
+        "storedquery_id": f"{fmi_forecast_query}::timevaluepair",
+        "latlon": f"{position[0]},{position[1]}",
+        "parameters": forecast_parameters[0],
+        "starttime": nextHour.isoformat(),
+        "endtime": nextHour.isoformat(),
+    }
+    response = request_with_retries("Finnish Meteorological Institute", fmi_wfs_url, params=params)
+    response.raise_for_status()
+    return parse_forecast_origin_time(response.content)
+
+def fetch_forecasts_from_weatherInstitute(positions, origin):
+    """
+    Fetches the forecasts of several places from one model run with a single request
+
+    Parameters:
+        positions (dict): The (latitude, longitude) of each city's FMI station.
+        origin (datetime): Origin time of the model run.
+
+    Returns:
+        dict: The (time, temperature, wind speed) points of each city that was in the response.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc).replace(minute=0, second=0, microsecond=0)
+    params = {
+        "service": "WFS",
+        "version": "2.0.0",
+        "request": "getFeature",
+        "storedquery_id": f"{fmi_forecast_query}::simple",
+        # Each point is asked for once even if several cities share a station
+        "latlon": list(dict.fromkeys(f"{latitude},{longitude}" for latitude, longitude in positions.values())),
+        "parameters": ",".join(forecast_parameters),
+        # Pinning the origin time keeps every batch on the same model run, even if a new one is published meanwhile
+        "origintime": origin.isoformat(),
+        "starttime": now.isoformat(),
+        "endtime": (now + datetime.timedelta(hours=forecast_hours)).isoformat(),
+        "timestep": 60,
+    }
+    response = request_with_retries("Finnish Meteorological Institute", fmi_wfs_url, params=params)
+    response.raise_for_status()
+    return parse_forecast_by_location(response.content, positions)
 
 def fetch_weather_data_from_weatherInstitute(city: str, retries: int):
     """
@@ -88,82 +618,181 @@ def fetch_weather_data_from_weatherInstitute(city: str, retries: int):
         retries (int): The number of times this function tries to fetch data from the api
 
     Returns:
-        dict: A dictionary containing city, temperature, weather condition, and wind speed.
+        Observation: The temperature, weather state and wind speed of the city.
+    """
+    fmisid = location_resolver.fmisid(city)
+    if fmisid is not None:
+        return __fetchFromWeatherInstitute([fmisid], retries, lambda xml_data: fmi_parsers[fmi_response_format][0](xml_data, city), key="fmisid")
+    return __fetchFromWeatherInstitute([city], retries, lambda xml_data: fmi_parsers[fmi_response_format][0](xml_data, city))
+
+def fetch_weather_data_from_weatherInstitute_batch(cities: list, retries: int):
+    """
+    This function fetches data for several cities with a single request to the finnish weatherinstitutes API
+
+    Cities with a known station are asked for by fmisid, each station once even if several cities share it.
+    The stations of the response are matched to the cities by their coordinates, so cities whose station
+    coordinates aren't known yet are fetched one by one instead.
+
+    Parameters:
+        cities (list): The city names to get weather data for.
+        retries (int): The number of times this function tries to fetch data from the api
+
+    Returns:
+        list: The observations in the same order as cities, with None for the cities that had no complete data.
+    """
+    if len(cities) == 1:
+        return [fetch_weather_data_from_weatherInstitute(cities[0], retries)]
+
+    stations = {city: location_resolver.fmisid(city) for city in cities}
+    # The stations of the response are matched to the fmisids by the coordinates stored when they were resolved
+    stationPositions = {}
+    for city, fmisid in stations.items():
+        coordinates = location_resolver.station_coordinates(city)
+        if fmisid is not None and coordinates is not None:
+            stationPositions.setdefault(fmisid, coordinates)
+    stations = {city: fmisid if fmisid in stationPositions else None for city, fmisid in stations.items()}
+    dataByCity = {}
+    if len(stationPositions) > 1:
+        try:
+            dataByStation = __fetchFromWeatherInstitute(
+                list(stationPositions), retries, lambda xml_data: fmi_parsers[fmi_response_format][1](xml_data, stationPositions), key="fmisid"
+            )
+            for city, fmisid in stations.items():
+                if fmisid is not None:
+                    data = dataByStation[fmisid]
+                    dataByCity[city] = dataclasses.replace(data, city=city) if data is not None else None
+        except ValueError as e:
+            print(f"Batched request could not be parsed ({e}), fetching cities one by one")
+
+    byName = {city: location_resolver.station_coordinates(city) for city in cities if city not in dataByCity}
+    byName = {city: coordinates for city, coordinates in byName.items() if coordinates is not None}
+    if len(byName) > 1:
+        try:
+            dataByCity.update(__fetchFromWeatherInstitute(list(byName), retries, lambda xml_data: fmi_parsers[fmi_response_format][1](xml_data, byName)))
+        except ValueError as e:
+            print(f"Batched request could not be parsed ({e}), fetching cities one by one")
+
+    return [dataByCity[city] if city in dataByCity else __fetchOneOrNone(city, retries) for city in cities]
+
+def __fetchOneOrNone(city, retries):
+    """
+    Fetches one city of a batch that couldn't be split, a failure only leaves that city without data
+    """
+    try:
+        return fetch_weather_data_from_weatherInstitute(city, retries)
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        print(f"Failed to fetch FMI data for {city}: {e}")
+        return None
+
+def fetch_weather_data_from_weatherInstitute_region(cities: list, retries: int, batch_size: int):
+    """
+    This function fetches the observations of every station in FMI_BBOX with a single request and gives each city
+    the inverse distance weighted average of its nearest stations
+
+    The coordinates of the cities are the ones OpenWeatherMap gives for them, so a city is weighed by its distance
+    to the stations and not just given the station FMI picks for its name. Cities whose coordinates aren't known
+    yet are fetched by name.
+
+    Parameters:
+        cities (list): The city names to get weather data for.
+        retries (int): The number of times this function tries to fetch data from the api
+        batch_size (int): Number of places in one request for the cities that are fetched by name
+
+    Returns:
+        list: The observations in the same order as cities, with None for cities that have no station near enough.
     """
+    located = {city: location_resolver.location_coordinates(city) for city in cities}
+    located = {city: coordinates for city, coordinates in located.items() if coordinates is not None}
+    dataByCity = {}
+    if located:
+        stations = __fetchFromWeatherInstitute(
+            [fmi_bbox], retries, lambda xml_data: parse_station_observations(xml_data, coverage=fmi_response_format == "multipointcoverage"), key="bbox"
+        )
+        dataByCity.update(station_index.aggregate(located, stations))
+
+    byName = [city for city in cities if city not in located]
+    for start in range(0, len(byName), batch_size):
+        batch = byName[start:start + batch_size]
+        dataByCity.update(zip(batch, fetch_weather_data_from_weatherInstitute_batch(batch, retries)))
+    return [dataByCity[city] for city in cities]
 
+def __fetchFromWeatherInstitute(places: list, retries: int, parse, key="place"):
+    """
+    Makes the observation request for the given places and returns the result of parse for the response
+
+    The places are place names, station ids when key is "fmisid", or a single bounding box when key is "bbox".
+    """
     # Get the current time in ISO 8601 format
     rounded_time = get_rounded_time()
     starttime = (rounded_time - datetime.timedelta(hours=1)).isoformat()  # 1 hour before
     endtime = (rounded_time + datetime.timedelta(minutes=10)).isoformat()  # 10 minutes after
 
     # Defines the API endpoint and parameters for the request
-    url = "https://opendata.fmi.fi/wfs"
+    url = fmi_wfs_url
     params = {
         "service": "WFS",
         "version": "2.0.0",
         "request": "getFeature",
-        "storedquery_id": "fmi::observations::weather::simple",
-        "place": city,
+        "storedquery_id": f"fmi::observations::weather::{fmi_response_format}",
+        key: places,  # Each place is sent as its own "place", "fmisid" or "bbox" parameter
         "parameters": "t2m,ws_10min,wawa",  # t2m: temperature, ws_10min: wind speed, wawa: weather state
          "starttime": starttime,
          "endtime": endtime,
     }
 
-    attempt = 0
-    while attempt <= retries:
-        try:
-            # Attempt the request
-            response = requests.get(url, params=params, timeout=10)
-            
-            # If the response is successful (status code 200), parses and returns the data
-            if response.status_code == 200:
-                try: 
-                    return parse_weather_data(response.text,city)
-                except:
-                    reportErrorData("High", e, traceback.extract_tb(e.__traceback__))
-            else:
-                print(f"Attempt {attempt + 1} failed with status code: {response.status_code}")
-        
-        except requests.RequestException as e:
-            print(f"Attempt {attempt + 1} encountered an error: {e}")
-        
-        attempt += 1
+    try:
+        # The transport retries with a backoff, so a struggling API isn't hit again right away
+        response = request_with_retries("Finnish Meteorological Institute", url, params=params, retries=retries)
+
+        # If the response is successful (status code 200), parses and returns the data
+        if response.status_code == 200:
+            return parse(response.content)
+        print(f"Request failed with status code: {response.status_code}")
+
+    except CircuitOpenError:
+        raise
+    except requests.RequestException as e:
+        print(f"Request encountered an error: {e}")
 
     # If all attempts fail, raises an exception
-    raise Exception(f"Failed to fetch data for {city}, after multiple attempts")
+    raise Exception(f"Failed to fetch data for {', '.join(places)}, after multiple attempts")
   
 # Defines the function to get weather data
 def get_weather_data(city, api_key):
     """
     Fetch weather data for a specified city from OpenWeatherMap API.
 
+    The city is asked for by its OpenWeatherMap id once the name has been resolved, and the id the name resolved to
+    is stored from the first response.
+
     Parameters:
         city (str): The city name to get weather data for.
         api_key (str): Your OpenWeatherMap API key.
 
     Returns:
-        dict: A dictionary containing city, temperature, weather condition, and wind speed.
+        Observation: The temperature, weather condition and wind speed of the city, or None if it could not be fetched.
     """
-    url = f"http://api.openweathermap.org/data/2.5/weather?q={city}&appid={api_key}&units=metric"
+    url = openweather_url
+    openweather_id = location_resolver.openweather_id(city)
+    if openweather_id is not None:
+        params = {"id": openweather_id, "appid": api_key, "units": "metric"}
+    else:
+        params = {"q": city, "appid": api_key, "units": "metric"}
     try:
-        response = requests.get(url)
+        response = request_with_retries("OpenWeatherMap", url, params=params)
         response.raise_for_status()  # Raise an error for bad responses (4xx, 5xx)
 
         data = response.json()
+        __learnOpenWeatherLocation(city, data)
 
-        # Extract the required information
-        temperature = data['main']['temp']
-        weather_condition = data['weather'][0]['description']
-        wind_speed = data['wind']['speed']
-
-        # Return the data in the desired format
-        return {
-            "kaupunki": city,
-            "lämpötila": str(temperature),  # Temperature as string
-            "säätila": str(weather_condition),  # Weather condition as string
-            "tuulen_nopeus": str(wind_speed)  # Wind speed as string
-        }
+        # Return the data as an observation
+        return __openWeatherObservation(city, data)
 
+    except CircuitOpenError:
+        # The provider is known to be down, the report names it as missing
+        pass
     except requests.exceptions.HTTPError as http_err:
         print(f"HTTP error occurred: {http_err}")  # Log HTTP error
         reportErrorData("High", http_err, traceback.extract_tb(http_err.__traceback__))
@@ -171,4 +800,56 @@ def get_weather_data(city, api_key):
         print(f"An error occurred: {err}")  # Log any other error
         reportErrorData("High", err, traceback.extract_tb(err.__traceback__))
 
-    return None  # Return None if an error occurs
\ No newline at end of file
+    return None  # Return None if an error occurs
+
+def get_weather_data_group(cities, api_key):
+    """
+    Fetch weather data for several cities from OpenWeatherMap API, with one group request for the cities whose id is known
+
+    Cities missing from the group response, or all of them if the group request fails, are fetched one by one.
+
+    Returns:
+        list: The observations in the same order as cities, with None for the cities that could not be fetched.
+    """
+    ids = {city: location_resolver.openweather_id(city) for city in cities}
+    known = [city for city in cities if ids[city] is not None]
+    dataByCity = {}
+    if len(known) > 1:
+        params = {"id": ",".join(dict.fromkeys(str(ids[city]) for city in known)), "appid": api_key, "units": "metric"}
+        try:
+            response = request_with_retries("OpenWeatherMap", openweather_group_url, params=params)
+            response.raise_for_status()
+            dataById = {data["id"]: data for data in response.json()["list"]}
+            for city in known:
+                if ids[city] in dataById:
+                    __learnOpenWeatherLocation(city, dataById[ids[city]])
+                    dataByCity[city] = __openWeatherObservation(city, dataById[ids[city]])
+        except CircuitOpenError:
+            return [None] * len(cities)
+        except Exception as err:
+            print(f"Group request to OpenWeatherMap failed ({err}), fetching cities one by one")
+
+    return [dataByCity[city] if city in dataByCity else get_weather_data(city, api_key) for city in cities]
+
+def __learnOpenWeatherLocation(city, data):
+    """
+    Stores the id and coordinates a city resolved to, from its first OpenWeatherMap response that has them
+    """
+    if "id" not in data or location_resolver.location_coordinates(city) is not None:
+        return
+    coordinates = (data["coord"]["lat"], data["coord"]["lon"]) if "coord" in data else None
+    if coordinates is not None or location_resolver.openweather_id(city) is None:
+        location_resolver.put_openweather(city, data["id"], coordinates)
+
+def __openWeatherObservation(city, data):
+    """
+    Forms the observation of a city from an OpenWeatherMap response
+    """
+    return Observation(
+        city=city,
+        source="OpenWeatherMap",
+        temperature=float(data['main']['temp']),
+        wind_speed=float(data['wind']['speed']),
+        timestamp=datetime.datetime.fromtimestamp(data['dt'], datetime.timezone.utc),
+        condition=data['weather'][0]['description'],
+    )
@@ -0,0 +1,26 @@
+import datetime
+
+from historyStore import HistoryStore
+from observation import Observation
+
+def observation(city, timestamp):
+    return Observation(city=city, source="OpenWeatherMap", temperature=1.0, wind_speed=2.0, timestamp=timestamp, wawa=None)
+
+def test_stale_observation_of_compacted_day_is_skipped(tmp_path):
+    stale = datetime.datetime(2026, 10, 10, 12, 0, tzinfo=datetime.timezone.utc)
+    fresh = datetime.datetime(2026, 10, 17, 12, 0, tzinfo=datetime.timezone.utc)
+    store = HistoryStore(str(tmp_path))
+    store.append([observation("Turku", stale)])
+    assert store.compact(datetime.date(2026, 10, 16)) == 1
+
+    assert store.append([observation("Oulu", stale), observation("Helsinki", fresh)]) == 1
+    times, _ = store.query("Helsinki", "temperature", fresh, fresh + datetime.timedelta(minutes=1))
+    assert len(times) == 1
+
+def test_observations_are_not_stored_twice_after_restart(tmp_path):
+    moment = datetime.datetime(2026, 10, 17, 12, 0, tzinfo=datetime.timezone.utc)
+    assert HistoryStore(str(tmp_path)).append([observation("Helsinki", moment), observation("Espoo", moment)]) == 2
+
+    store = HistoryStore(str(tmp_path))
+    assert store.append([observation("Helsinki", moment), observation("Espoo", moment)]) == 0
+    assert store.append([observation("Helsinki", moment + datetime.timedelta(minutes=10))]) == 1
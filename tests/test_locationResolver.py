@@ -0,0 +1,51 @@
+import os
+
+from locationResolver import LocationResolver
+
+def test_worker_keeps_the_ids_of_other_shards(tmp_path):
+    path = str(tmp_path / "location_ids.json")
+    sheet = tmp_path / "Locations.xlsx"
+    sheet.write_bytes(b"1")
+
+    aggregator = LocationResolver(path)
+    aggregator.validate(str(sheet), ["A", "B", "C", "D"])
+    for location in ("A", "B", "C", "D"):
+        aggregator.put_station(location, (1, 60.0, 24.0))
+    aggregator.save()
+
+    # Two workers resolve their own shards at the same time
+    first, second = LocationResolver(path), LocationResolver(path)
+    first.put_openweather("A", 11)
+    second.put_openweather("C", 13)
+    first.save()
+    second.save()
+
+    reader = LocationResolver(path)
+    assert reader.unresolved_stations(["A", "B", "C", "D"]) == []
+    assert (reader.openweather_id("A"), reader.openweather_id("C")) == (11, 13)
+
+def test_changed_sheet_forgets_only_the_names_that_left_it(tmp_path):
+    path = str(tmp_path / "location_ids.json")
+    sheet = tmp_path / "Locations.xlsx"
+    sheet.write_bytes(b"1")
+    resolver = LocationResolver(path)
+    resolver.validate(str(sheet), ["A", "B"])
+    resolver.put_station("A", (1, 60.0, 24.0))
+    resolver.put_station("B", (2, 61.0, 25.0))
+    resolver.save()
+
+    sheet.write_bytes(b"22")
+    os.utime(sheet, ns=(0, 0))
+    resolver.validate(str(sheet), ["A", "C"])
+    resolver.save()
+    assert LocationResolver(path).unresolved_stations(["A", "B", "C"]) == ["B", "C"]
+
+def test_refresh_reads_ids_stored_by_another_process(tmp_path):
+    path = str(tmp_path / "location_ids.json")
+    aggregator = LocationResolver(path)
+    assert aggregator.fmisid("A") is None
+    worker = LocationResolver(path)
+    worker.put_station("A", (101, 60.0, 24.0))
+    worker.save()
+    aggregator.refresh()
+    assert aggregator.fmisid("A") == 101
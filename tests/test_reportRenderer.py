@@ -0,0 +1,15 @@
+import datetime
+import math
+
+from observation import Observation
+from reportRenderer import format_observation, render_report
+
+def test_missing_station_value_is_shown_as_no_data():
+    observation = Observation(
+        city="Espoo", source="Finnish Meteorological Institute", temperature=math.nan, wind_speed=4.0,
+        timestamp=datetime.datetime(2026, 10, 18, 12, 0, tzinfo=datetime.timezone.utc), wawa=None,
+    )
+    assert format_observation(observation)["lämpötila"] == "Ei tietoa"
+    report = render_report({"Finnish Meteorological Institute": [observation]}, [])
+    assert "nan" not in report
+    assert "<td>Ei tietoa</td>" in report
@@ -0,0 +1,80 @@
+import datetime
+
+import pytest
+
+from scheduler import CronSchedule, ReportScheduler
+
+def test_sunday_is_zero_or_seven():
+    saturday = datetime.datetime(2026, 10, 17, 12, 0)
+    sunday = datetime.datetime(2026, 10, 18, 7, 0)
+    assert CronSchedule("0 7 * * 0").next_after(saturday) == sunday
+    assert CronSchedule("0 7 * * 7").next_after(saturday) == sunday
+
+def test_weekday_names_monday_as_one():
+    assert CronSchedule("@weekly").next_after(datetime.datetime(2026, 10, 17, 12, 0)) == datetime.datetime(2026, 10, 19, 7, 0)
+
+def test_steps():
+    schedule = CronSchedule("*/15 * * * *")
+    assert schedule.minutes == [0, 15, 30, 45]
+    assert schedule.next_after(datetime.datetime(2026, 10, 17, 12, 16)) == datetime.datetime(2026, 10, 17, 12, 30)
+    assert schedule.next_after(datetime.datetime(2026, 10, 17, 23, 50)) == datetime.datetime(2026, 10, 18, 0, 0)
+    assert CronSchedule("0 7 */3 * *").days == set(range(1, 32, 3))
+    assert CronSchedule("0 8-18/5 * * *").hours == [8, 13, 18]
+
+def test_next_after_is_strictly_later():
+    moment = datetime.datetime(2026, 10, 17, 7, 0)
+    assert CronSchedule("0 7 * * *").next_after(moment) == datetime.datetime(2026, 10, 18, 7, 0)
+
+def test_day_of_month_or_weekday():
+    # Like cron, a restricted day of month and day of week match when either does
+    schedule = CronSchedule("0 7 1 * 1")
+    assert schedule.next_after(datetime.datetime(2026, 10, 17, 12, 0)) == datetime.datetime(2026, 10, 19, 7, 0)
+    assert schedule.next_after(datetime.datetime(2026, 10, 27, 12, 0)) == datetime.datetime(2026, 11, 1, 7, 0)
+
+def test_february_29th():
+    assert CronSchedule("0 7 29 2 *").next_after(datetime.datetime(2026, 10, 17, 12, 0)) == datetime.datetime(2028, 2, 29, 7, 0)
+
+def test_schedule_that_never_fires():
+    with pytest.raises(ValueError):
+        CronSchedule("0 7 31 2 *").next_after(datetime.datetime(2026, 10, 17, 12, 0))
+
+@pytest.mark.parametrize("expression", ["0 7 * *", "60 7 * * *", "0 24 * * *", "0 7 0 * *", "0 7 * 13 *", "0 7 * * 8", "*/0 * * * *", "a 7 * * *"])
+def test_invalid_expressions(expression):
+    with pytest.raises(ValueError):
+        CronSchedule(expression)
+
+def test_update_falls_back_to_default_schedule():
+    now = datetime.datetime(2026, 10, 17, 12, 0)
+    scheduler = ReportScheduler("0 7 * * *")
+    invalid = scheduler.update({"a": None, "b": "0 7 31 2 *", "c": "not a schedule"}, now)
+    assert sorted(invalid) == ["b", "c"]
+    assert scheduler.next_due() == datetime.datetime(2026, 10, 18, 7, 0)
+    assert sorted(scheduler.pop_due(datetime.datetime(2026, 10, 18, 7, 0))) == ["a", "b", "c"]
+
+def test_update_keeps_due_time_of_unchanged_schedules():
+    scheduler = ReportScheduler("0 7 * * *")
+    scheduler.update({"a": "0 9 * * *"}, datetime.datetime(2026, 10, 17, 8, 0))
+    scheduler.update({"a": "0 9 * * *", "b": None}, datetime.datetime(2026, 10, 17, 10, 0))
+    assert scheduler.pop_due(datetime.datetime(2026, 10, 17, 10, 0)) == ["a"]
+
+def test_missed_reports_are_sent_once():
+    scheduler = ReportScheduler("0 * * * *")
+    scheduler.update({"a": None}, datetime.datetime(2026, 10, 17, 8, 30))
+    assert scheduler.pop_due(datetime.datetime(2026, 10, 17, 12, 5)) == ["a"]
+    assert scheduler.pop_due(datetime.datetime(2026, 10, 17, 12, 5)) == []
+    assert scheduler.next_due() == datetime.datetime(2026, 10, 17, 13, 0)
+
+def test_due_times_are_aligned_to_observation_grid():
+    scheduler = ReportScheduler("5 7 * * *")
+    scheduler.update({"a": None}, datetime.datetime(2026, 10, 17, 8, 0))
+    assert scheduler.next_due() == datetime.datetime(2026, 10, 18, 7, 10)
+
+def test_retry_keeps_sooner_scheduled_time():
+    now = datetime.datetime(2026, 10, 17, 7, 0)
+    scheduler = ReportScheduler("0 * * * *")
+    scheduler.update({"a": None}, datetime.datetime(2026, 10, 17, 6, 30))
+    assert scheduler.pop_due(now) == ["a"]
+    scheduler.retry(["a"], now, 60)
+    assert scheduler.next_due() == datetime.datetime(2026, 10, 17, 7, 1)
+    scheduler.retry(["a"], now, 7200)
+    assert scheduler.next_due() == datetime.datetime(2026, 10, 17, 7, 1)
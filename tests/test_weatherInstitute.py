@@ -0,0 +1,37 @@
+import math
+
+from weatherInstitute import parse_forecast_by_location, parse_weather_data_by_location
+
+HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<wfs:FeatureCollection xmlns:wfs="http://www.opengis.net/wfs/2.0" xmlns:BsWfs="http://xml.fmi.fi/schema/wfs/2.0" xmlns:gml="http://www.opengis.net/gml/3.2">'
+MEMBER = "<wfs:member><BsWfs:BsWfsElement><BsWfs:Location><gml:Point><gml:pos>{position} </gml:pos></gml:Point></BsWfs:Location><BsWfs:Time>{time}</BsWfs:Time><BsWfs:ParameterName>{name}</BsWfs:ParameterName><BsWfs:ParameterValue>{value}</BsWfs:ParameterValue></BsWfs:BsWfsElement></wfs:member>"
+
+def response(rows):
+    return HEADER + "".join(MEMBER.format(position=position, time=time, name=name, value=value) for position, time, name, value in rows) + "</wfs:FeatureCollection>"
+
+def test_forecasts_are_matched_by_coordinates():
+    # The response lists the points in the opposite order to the request
+    xml = response([
+        ("65.01 25.47", "2026-10-18T12:00:00Z", "Temperature", "-3.0"),
+        ("65.01 25.47", "2026-10-18T12:00:00Z", "WindSpeedMS", "2.0"),
+        ("60.17 24.94", "2026-10-18T12:00:00Z", "Temperature", "5.0"),
+        ("60.17 24.94", "2026-10-18T12:00:00Z", "WindSpeedMS", "6.0"),
+    ])
+    forecasts = parse_forecast_by_location(xml, {"Helsinki": (60.17, 24.94), "Oulu": (65.01, 25.47), "Inari": (68.9, 27.0)})
+    assert [point[1:] for point in forecasts["Helsinki"]] == [(5.0, 6.0)]
+    assert [point[1:] for point in forecasts["Oulu"]] == [(-3.0, 2.0)]
+    assert "Inari" not in forecasts
+
+def test_missing_forecast_value_is_nan():
+    xml = response([("60.17 24.94", "2026-10-18T12:00:00Z", "Temperature", "NaN")])
+    (point,) = parse_forecast_by_location(xml, {"Helsinki": (60.17, 24.94)})["Helsinki"]
+    assert math.isnan(point[1]) and math.isnan(point[2])
+
+def test_observations_are_matched_by_coordinates():
+    xml = response([
+        (position, "2026-10-18T12:00:00Z", name, value)
+        for position, values in (("65.01 25.47", ("-3.0", "2.0", "0")), ("60.17 24.94", ("5.0", "6.0", "10")))
+        for name, value in zip(("t2m", "ws_10min", "wawa"), values)
+    ])
+    observations = parse_weather_data_by_location(xml, {"Helsinki": (60.17, 24.94), "Oulu": (65.01, 25.47)})
+    assert observations["Helsinki"].temperature == 5.0
+    assert observations["Oulu"].temperature == -3.0
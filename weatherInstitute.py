@@ -1,109 +1,360 @@
 import datetime
+import io
 import xml.etree.ElementTree as ET
 
+from metrics import metrics
+from observation import Observation
+
+# Namespaces used in the responses of the FMI WFS service
+_BSWFS_NS = "http://xml.fmi.fi/schema/wfs/2.0"
+_GML_NS = "http://www.opengis.net/gml/3.2"
+
+_ELEMENT_TAG = f"{{{_BSWFS_NS}}}BsWfsElement"
+_TIME_TAG = f"{{{_BSWFS_NS}}}Time"
+_PARAMETER_NAME_TAG = f"{{{_BSWFS_NS}}}ParameterName"
+_PARAMETER_VALUE_TAG = f"{{{_BSWFS_NS}}}ParameterValue"
+_POS_TAG = f"{{{_GML_NS}}}pos"
+_TIME_POSITION_TAG = f"{{{_GML_NS}}}timePosition"
+_RESULT_TIME_TAG = "{http://www.opengis.net/om/2.0}resultTime"
+_IDENTIFIER_TAG = f"{{{_GML_NS}}}identifier"
+_FMISID_CODE_SPACE = "http://xml.fmi.fi/namespace/stationcode/fmisid"
+_FIELD_TAG = "{http://www.opengis.net/swe/2.0}field"
+_TUPLE_LIST_TAG = f"{{{_GML_NS}}}doubleOrNilReasonTupleList"
+_POSITIONS_TAG = "{http://www.opengis.net/gmlcov/1.0}positions"
+
+# FMI publishes observations on a grid of this many minutes
+observation_interval_minutes = 10
+
+# Parameters requested from FMI: t2m: temperature, ws_10min: wind speed, wawa: weather state
+_PARAMETERS = ("t2m", "ws_10min", "wawa")
+
+# A station this close to a requested coordinate, in degrees, is taken to be the station of that location
+_POSITION_TOLERANCE = 0.001
+
+# Parameters requested from FMI forecasts
+forecast_parameters = ("Temperature", "WindSpeedMS")
+
 def get_rounded_time():
     """
     Gets the nearest 10-minute interval for fetching data from the finish weather institutes API
     """
     # Gets the current UTC time and rounds it down to the nearest 10-minute interval
     now = datetime.datetime.now(datetime.timezone.utc)
-    rounded_minute = (now.minute // 10) * 10
+    rounded_minute = (now.minute // observation_interval_minutes) * observation_interval_minutes
     rounded_time = now.replace(minute=rounded_minute, second=0, microsecond=0)
     return rounded_time
 
 def parse_weather_data(xml_data, location):
     """
     Parses XMl data from the request made to the finish weather insitute
+
+    The XML is read as a stream, so only the latest value of each parameter is kept in memory
+    instead of the whole document.
+    """
+    latest = {}
+    with metrics.span("xml_parse_seconds", query="observations"):
+        for _, obs_time, param_name, param_value in __iterObservations(xml_data):
+            __keepLatest(latest, obs_time, param_name, param_value)
+
+    return __formatWeatherData(location, latest)
+
+def parse_weather_data_by_location(xml_data, positions):
+    """
+    Parses XML data from a request that was made for several places at once and splits it back out per location
+
+    The stations of the response are matched to the locations by their coordinates, as FMI doesn't promise to
+    return them in the order they were requested in.
+
+    Parameters:
+        xml_data (str): The response of a request that had one "place" or "fmisid" parameter per location.
+        positions (dict): The (latitude, longitude) of the station of each location.
+
+    Returns:
+        dict: The observation of each location, keyed by location, None for a location whose station is missing
+        from the response or lacks values.
+    """
+    # Keeps the latest values of each station
+    stations = {}
+    with metrics.span("xml_parse_seconds", query="observations"):
+        for position, obs_time, param_name, param_value in __iterObservations(xml_data):
+            __keepLatest(stations.setdefault(position, {}), obs_time, param_name, param_value)
+
+    stations = [(tuple(float(part) for part in position.split()[:2]), latest) for position, latest in stations.items() if position]
+    return {location: __formatOrNone(location, latest) for location, latest in __matchPositions(stations, positions).items()}
+
+def parse_coverage_weather_data(xml_data, location):
+    """
+    Parses a response of the multipointcoverage format, the same way as parse_weather_data
+
+    In this format the values of all parameters, times and stations come as one block of numbers instead of an
+    element per value, so the response is several times smaller and is read into arrays in one go.
+    """
+    with metrics.span("xml_parse_seconds", query="observations_coverage"):
+        stations = __readCoverageStations(xml_data)
+    if len(stations) != 1:
+        raise ValueError(f"Expected data for 1 location, but the response contained {len(stations)} stations")
+    return __formatWeatherData(location, stations[0][1])
+
+def parse_coverage_weather_data_by_location(xml_data, positions):
+    """
+    Parses a response of the multipointcoverage format that was requested for several places at once, the same way
+    as parse_weather_data_by_location
+    """
+    with metrics.span("xml_parse_seconds", query="observations_coverage"):
+        stations = __readCoverageStations(xml_data)
+    return {location: __formatOrNone(location, latest) for location, latest in __matchPositions(stations, positions).items()}
+
+def parse_station_observations(xml_data, coverage=False):
+    """
+    Parses the latest values of every station in a response, such as the response of a bounding box query
+
+    Each station keeps its own latest values, and a station that doesn't measure every parameter is kept with
+    NaN or None for the missing ones.
+
+    Parameters:
+        xml_data (str): The response, in the simple format or, if coverage is true, in the multipointcoverage format.
+
+    Returns:
+        list: The latitude, longitude and observation of each station, the observation named by the coordinates.
+    """
+    with metrics.span("xml_parse_seconds", query="stations"):
+        if coverage:
+            stations = [(tuple(position), latest) for position, latest in __readCoverageStations(xml_data)]
+        else:
+            latestByPosition = {}
+            for position, obs_time, param_name, param_value in __iterObservations(xml_data):
+                __keepLatest(latestByPosition.setdefault(position, {}), obs_time, param_name, param_value)
+            stations = [(tuple(float(part) for part in position.split()[:2]), latest) for position, latest in latestByPosition.items()]
+
+    nan = float("nan")
+    observations = []
+    for (latitude, longitude), latest in stations:
+        if not latest:
+            continue
+        obs_time = latest["t2m"][0] if "t2m" in latest else max(value[0] for value in latest.values())
+        observations.append((float(latitude), float(longitude), Observation(
+            city=f"{latitude:.5f} {longitude:.5f}",
+            source="Finnish Meteorological Institute",
+            temperature=float(latest["t2m"][1]) if "t2m" in latest else nan,
+            wind_speed=float(latest["ws_10min"][1]) if "ws_10min" in latest else nan,
+            timestamp=datetime.datetime.fromisoformat(obs_time.replace("Z", "+00:00")),
+            wawa=int(float(latest["wawa"][1])) if "wawa" in latest else None,
+        )))
+    return observations
+
+def parse_station(xml_data):
+    """
+    Gets the station FMI picked for a place from an observation response in the timevaluepair format
+
+    Returns:
+        tuple: The fmisid, latitude and longitude of the station, or None if the response has no station.
+    """
+    if isinstance(xml_data, str):
+        xml_data = xml_data.encode("utf-8")
+
+    fmisid = position = None
+    for _, element in ET.iterparse(io.BytesIO(xml_data)):
+        if element.tag == _IDENTIFIER_TAG and element.get("codeSpace") == _FMISID_CODE_SPACE:
+            fmisid = element.text.strip()
+        elif element.tag == _POS_TAG and position is None:
+            position = element.text.split()
+        if fmisid and position:
+            return fmisid, float(position[0]), float(position[1])
+    return None
+
+def parse_forecast_origin_time(xml_data):
+    """
+    Gets the origin time of the model run from a forecast response in the timevaluepair format
+
+    Returns:
+        datetime: The time the forecast was made from, or None if the response has no forecast.
+    """
+    if isinstance(xml_data, str):
+        xml_data = xml_data.encode("utf-8")
+
+    inResultTime = False
+    for event, element in ET.iterparse(io.BytesIO(xml_data), events=("start", "end")):
+        if element.tag == _RESULT_TIME_TAG:
+            inResultTime = event == "start"
+        elif inResultTime and event == "end" and element.tag == _TIME_POSITION_TAG:
+            return datetime.datetime.fromisoformat(element.text.strip().replace("Z", "+00:00"))
+    return None
+
+def parse_forecast_by_location(xml_data, positions):
+    """
+    Parses a forecast in the simple format that was requested for several places at once
+
+    The points of the response are matched to the locations by their coordinates, like in parse_weather_data_by_location.
+
+    Parameters:
+        xml_data (str): The response of a request that had one "latlon" parameter per location.
+        positions (dict): The (latitude, longitude) that was requested for each location.
+
+    Returns:
+        dict: The forecast of each location as a list of (time, temperature, wind speed) tuples sorted by time,
+        locations whose point is missing from the response are left out.
+    """
+    stations = {}
+    with metrics.span("xml_parse_seconds", query="forecasts"):
+        for position, forecast_time, param_name, param_value in __iterObservations(xml_data):
+            if param_name not in forecast_parameters or not position:
+                continue
+            value = float(param_value) if param_value not in (None, "NaN") else float("nan")
+            stations.setdefault(position, {}).setdefault(forecast_time, {})[param_name] = value
+
+    stations = [(tuple(float(part) for part in position.split()[:2]), points) for position, points in stations.items()]
+    nan = float("nan")
+    forecasts = {}
+    for location, points in __matchPositions(stations, positions).items():
+        if points is None:
+            print(f"No FMI forecast for {location}: its point is not in the response")
+            continue
+        forecasts[location] = [
+            (datetime.datetime.fromisoformat(forecast_time.replace("Z", "+00:00")), values.get("Temperature", nan), values.get("WindSpeedMS", nan))
+            for forecast_time, values in sorted(points.items())
+        ]
+    return forecasts
+
+def __iterObservations(xml_data):
+    """
+    Reads the <BsWfs:BsWfsElement> elements of the XML one by one
+
+    Yields:
+        tuple: The station position, time, parameter name and parameter value of each element.
+    """
+    if isinstance(xml_data, str):
+        xml_data = xml_data.encode("utf-8")
+
+    position = time = name = value = None
+    root = None
+    for event, element in ET.iterparse(io.BytesIO(xml_data), events=("start", "end")):
+        if root is None:
+            root = element
+        if event == "start":
+            continue
+
+        tag = element.tag
+        if tag == _POS_TAG:
+            position = element.text
+        elif tag == _TIME_TAG:
+            time = element.text
+        elif tag == _PARAMETER_NAME_TAG:
+            name = element.text
+        elif tag == _PARAMETER_VALUE_TAG:
+            value = element.text
+        elif tag == _ELEMENT_TAG:
+            yield position.strip() if position else None, time, name, value
+            position = time = name = value = None
+            # Drops the finished element and its siblings, so memory use stays constant
+            root.clear()
+
+def __readCoverageStations(xml_data):
+    """
+    Reads a multipointcoverage response into the latest values of each station
+
+    Returns:
+        list: The (latitude, longitude) of each station and the latest (time, value) of each of its parameters, in the
+        order in which the stations appear.
     """
-    # wawa-koodien sanakirja säätilojen kuvausten kanssa
-    wawa_mapping = {
-        0: "Ei merkittäviä sääilmiöitä",
-        4: "Auerta, savua tai ilmassa leijuvaa pölyä, näkyvyys vähintään 1 km",
-        5: "Auerta, savua tai ilmassa leijuvaa pölyä, näkyvyys alle 1 km",
-        10: "Utua",
-        20: "Sumua",
-        21: "Sadetta (olomuoto on määrittelemätön)",
-        22: "Tihkusadetta tai lumijyväsiä",
-        23: "Vesisadetta (ei jäätävää)",
-        24: "Lumisadetta",
-        25: "Jäätävää vesisadetta tai tihkua",
-        30: "Sumua havaintohetkellä",
-        31: "Sumua tai jääsumua erillisinä hattaroina",
-        32: "Sumua tai jääsumua, ohentunut edellisen tunnin aikana",
-        33: "Sumua tai jääsumua, ilman muutoksia",
-        34: "Sumua tai jääsumua, tullut sakeammaksi",
-        40: "Sadetta havaintohetkellä",
-        41: "Heikkoa tai kohtalaista sadetta",
-        42: "Kovaa sadetta",
-        50: "Tihkusadetta (heikkoa, ei jäätävää)",
-        51: "Heikkoa tihkua, ei jäätävää",
-        52: "Kohtalaista tihkua, ei jäätävää",
-        53: "Kovaa tihkua, ei jäätävää",
-        54: "Jäätävää heikkoa tihkua",
-        55: "Jäätävää kohtalaista tihkua",
-        56: "Jäätävää kovaa tihkua",
-        60: "Vesisadetta (heikkoa, ei jäätävää)",
-        61: "Heikkoa vesisadetta, ei jäätävää",
-        62: "Kohtalaista vesisadetta, ei jäätävää",
-        63: "Kovaa vesisadetta, ei jäätävää",
-        64: "Jäätävää heikkoa vesisadetta",
-        65: "Jäätävää kohtalaista vesisadetta",
-        66: "Jäätävää kovaa vesisadetta",
-        67: "Heikkoa lumensekaista vesisadetta tai tihkua (räntää)",
-        68: "Kohtalaista tai kovaa lumensekaista vesisadetta tai tihkua (räntää)",
-        70: "Lumisadetta",
-        71: "Heikkoa lumisadetta",
-        72: "Kohtalaista lumisadetta",
-        73: "Tiheää lumisadetta",
-        74: "Heikkoa jääjyvässadetta",
-        75: "Kohtalaista jääjyväsadetta",
-        76: "Kovaa jääjyväsadetta",
-        77: "Lumijyväsiä",
-        78: "Jääkiteitä",
-        80: "Heikkoja kuuroja tai ajoittaista sadetta",
-        81: "Heikkoja vesikuuroja",
-        82: "Kohtalaisia vesikuuroja",
-        83: "Kovia vesikuuroja",
-        84: "Ankaria vesikuuroja (>32 mm/h)",
-        85: "Heikkoja lumikuuroja",
-        86: "Kohtalaisia lumikuuroja",
-        87: "Kovia lumikuuroja",
-        89: "Raekuuroja mahdollisesti yhdessä vesi- tai räntäsateen kanssa"
-    }
-
-    # Forms XML from string that is used for finding data
-    root = ET.fromstring(xml_data)
-
-    # Initializes variables to store values
-    latest_time = None
-    temperature = None
-    wind_speed = None
-    weather_state = None
-
-    # Iterates through each <BsWfs:BsWfsElement> in the XML
-    for element in root.findall(".//{*}BsWfsElement"):
-        obs_time = element.find("{*}Time").text
-        param_name = element.find("{*}ParameterName").text
-        param_value = element.find("{*}ParameterValue").text
-
-        # If this observation is more recent than the stored one, updates the values
-        if latest_time is None or obs_time >= latest_time:
-            latest_time = obs_time
-            if param_name == "t2m":
-                temperature = param_value
-            elif param_name == "ws_10min":
-                wind_speed = param_value
-            elif param_name == "wawa":
-                weather_state = param_value
+    import numpy as np
 
+    if isinstance(xml_data, str):
+        xml_data = xml_data.encode("utf-8")
+
+    names = []
+    values = positions = None
+    for _, element in ET.iterparse(io.BytesIO(xml_data)):
+        if element.tag == _FIELD_TAG:
+            names.append(element.get("name"))
+        elif element.tag == _TUPLE_LIST_TAG:
+            values = np.fromstring(element.text or "", sep=" ")
+            element.clear()
+        elif element.tag == _POSITIONS_TAG:
+            # Each row is the latitude, longitude and time of one row of values
+            positions = np.fromstring(element.text or "", sep=" ")
+            element.clear()
+
+    if values is None or positions is None or not names or not len(positions):
+        return []
+    positions = positions.reshape(-1, 3)
+    values = values.reshape(len(positions), len(names))
+
+    # The rows of each station are contiguous and in time order, a station starts where the coordinates change
+    starts = np.flatnonzero(np.any(positions[1:, :2] != positions[:-1, :2], axis=1)) + 1
+    stations = []
+    for rows in np.split(np.arange(len(positions)), starts):
+        latest = {}
+        position = (float(positions[rows[0], 0]), float(positions[rows[0], 1]))
+        for column, name in enumerate(names):
+            if name not in _PARAMETERS:
+                continue
+            valid = rows[~np.isnan(values[rows, column])]
+            if len(valid):
+                row = valid[np.argmax(positions[valid, 2])]
+                obs_time = datetime.datetime.fromtimestamp(int(positions[row, 2]), datetime.timezone.utc).isoformat()
+                latest[name] = (obs_time, values[row, column])
+        stations.append((position, latest))
+    return stations
+
+def __keepLatest(latest, obs_time, param_name, param_value):
+    """
+    Stores the value of a parameter if it is the most recent one seen for that parameter
+    """
+    if param_name not in _PARAMETERS or param_value is None or param_value == "NaN":
+        return
+    previous = latest.get(param_name)
+    if previous is None or obs_time >= previous[0]:
+        latest[param_name] = (obs_time, param_value)
+
+def __matchPositions(stations, positions):
+    """
+    Matches the stations of a response to the locations by their coordinates
+
+    Parameters:
+        stations (list): The (latitude, longitude) of each station and its values.
+        positions (dict): The (latitude, longitude) of the station of each location.
+
+    Returns:
+        dict: The values of each location, None for a location that has no station in the response.
+    """
+    matched = {}
+    for location, (latitude, longitude) in positions.items():
+        distance, latest = min(
+            ((max(abs(position[0] - latitude), abs(position[1] - longitude)), latest) for position, latest in stations),
+            key=lambda station: station[0], default=(None, None),
+        )
+        matched[location] = latest if distance is not None and distance <= _POSITION_TOLERANCE else None
+    return matched
+
+def __formatOrNone(location, latest):
+    """
+    Forms the observation of one location of a batch, a station that lacks values only leaves its own location without data
+    """
+    if latest is None:
+        print(f"No FMI observation for {location}: its station is not in the response")
+        return None
+    try:
+        return __formatWeatherData(location, latest)
+    except ValueError as e:
+        print(f"No FMI observation for {location}: {e}")
+        return None
+
+def __formatWeatherData(location, latest):
+    """
+    Forms the observation of a location from the latest values of its parameters
+    """
     # Ensures we found all values, otherwise raise an exception
-    if temperature is None or wind_speed is None or weather_state is None:
+    if any(param_name not in latest for param_name in _PARAMETERS):
         raise ValueError("One or more required weather parameters were not found in the XML data")
-    
-    # Returns the formatted weather data dictionary for the most recent observation
-    return {
-        "kaupunki": location,
-        "lämpötila": temperature + " Celsius",
-        "säätila": wawa_mapping.get(int(float(weather_state)), "Tuntematon säätila"),
-        "tuulen_nopeus": wind_speed + " m/s avarage speed measured in the last 10 minutes",
-    }
\ No newline at end of file
+
+    obs_time, temperature = latest["t2m"]
+
+    # Returns the observation for the most recent values
+    return Observation(
+        city=location,
+        source="Finnish Meteorological Institute",
+        temperature=float(temperature),
+        wind_speed=float(latest["ws_10min"][1]),
+        timestamp=datetime.datetime.fromisoformat(obs_time.replace("Z", "+00:00")),
+        wawa=int(float(latest["wawa"][1])),
+    )
@@ -1,129 +1,68 @@
 import os
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from dotenv import load_dotenv
-from openpyxl import Workbook, load_workbook
-import zipfile
-import datetime
 
-# Load environment variables
-load_dotenv()
+import config
+from mailTransport import outbox
+from metrics import metrics
+from notificationRules import format_alert
+from reportRenderer import render_report
+
+# How long sending the report waits for the outbox, in seconds
+report_send_timeout = 60
+
+def send_weather_email(weather_data, averages, recipient_emails, charts=None, forecasts=None, notices=None):
+    from email.mime.image import MIMEImage
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    from email.utils import make_msgid
 
-def send_weather_email(weather_data, averages, recipient_emails):
-    smtp_server = "smtp.gmail.com"
-    smtp_port = 587
     sender_email = os.getenv("EMAIL_ADDRESS")
-    sender_password = os.getenv("EMAIL_PASSWORD")
 
-    # Compose the email
-    msg = MIMEMultipart()
+    # Compose the email, charts are attached as inline images the HTML body refers to
+    msg = MIMEMultipart("related" if charts else "mixed")
     msg['From'] = sender_email
     msg['To'] = ", ".join(recipient_emails)
     msg['Subject'] = "Weather Report"
 
-    # Format the weather data into an HTML table
-    body = """
-    <!DOCTYPE html>
-    <html lang="en">
-    <head>
-        <meta charset="UTF-8">
-         <style>
-            body { font-family: Arial, sans-serif; margin: 20px; }
-            h1 { color: #333; }
-            h2 { color: #555; margin-top: 20px; }
-            table { width: 80%; border-collapse: collapse; margin-bottom: 20px; }
-            th, td { border: 1px solid #ddd; padding: 10px; text-align: left; }
-            th { background-color: #f2f2f2; color: #333; }
-            tr:nth-child(even) { background-color: #f9f9f9; }
-            tr:hover { background-color: #ddd; }
-            /* Specific styles for averages */
-            .averages-table {
-                width: 80%;
-                margin-top: 20px;
-                border: 2px solid #007BFF; /* blue border for emphasis */
-            }
-            .averages-table th {
-                background-color: #007BFF; /* blue background for headers */
-                color: white; /* white text for headers */
-                font-weight: bold;
-            }
-            .averages-table td {
-                background-color: #E7F1FF; /* light blue background for data */
-            }
-        </style>
-    </head>
-    <body>
-    <h1>Weather Report</h1>
-    """
-    body = printAverages(averages, body)
-
-    for source, data in weather_data.items():
-        body += f"<h2>Source: {source}</h2>"
-        body += "<table border='1'><tr>"
-        
-        # Add table headers from the keys of the first item in the list
-        headers = data[0].keys()
-        for key in headers:
-            body += f"<th>{key.capitalize()}</th>"
-        body += "</tr>"
+    chartIds = {city: make_msgid(domain="weatherbot")[1:-1] for city in (charts or {})}
 
-        # Populate the table rows with weather data
-        for city_data in data:
-            body += "<tr>"
-            for key in headers:
-                body += f"<td>{city_data[key]}</td>"
-            body += "</tr>"
-        body += "</table>"
-
-    # Close the HTML tags
-    body += "</body>"
+    # Format the weather data into HTML tables
+    with metrics.span("report_render_seconds"):
+        body = render_report(weather_data, averages, chartIds, forecasts, notices)
 
     msg.attach(MIMEText(body, 'html'))  # Attach the HTML body
+    for city, contentId in chartIds.items():
+        image = MIMEImage(charts[city], "png")
+        image.add_header("Content-ID", f"<{contentId}>")
+        image.add_header("Content-Disposition", "inline", filename=f"{city}.png")
+        msg.attach(image)
+    summary = f"{msg['Subject']} with {len(averages)} cities to {msg['To']}"
 
-    try:
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()  # Secure the connection
-            server.login(sender_email, sender_password)
-            server.sendmail(sender_email, recipient_emails, msg.as_string())
-        print("Email sent successfully.")
-        log_email_send("Success", body)  # Log success if email is sent
-        return True
-    except Exception as e:
-        print(f"Failed to send email: {e}")
-        log_email_send("Failed", body)  # Log failure if email is not sent
-        return False
+    # The outbox delivers the report and logs the result, a report that can't be sent right away is retried later
+    messageId = outbox.queue(msg, recipient_emails, summary)
+    with metrics.span("report_delivery_seconds"):
+        status = outbox.wait(messageId, report_send_timeout)
+    if status == "pending":
+        print("Email could not be sent yet, it stays in the outbox and is retried.")
+    return status != "failed"
 
-def log_email_send(status="Failed", message="message that was sent, by email", log_file="Log.xlsx"):
-    try:
-        wb = load_workbook(log_file)  # Attempt to load existing workbook
-        sheet = wb.active
-    except (FileNotFoundError, zipfile.BadZipFile):  # Handle both file not found and bad zip file
-        wb = Workbook()  # Create a new workbook
-        sheet = wb.active
-        sheet.append(["Timestamp", "Status", "Message"])  # Add headers
+def send_alert_emails(alerts):
+    """
+    Sends each user one email listing the rules of theirs that were triggered
 
-    # Append log entry
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    sheet.append([timestamp, status, message])  # Log the email send status
+    Parameters:
+        alerts (list): The triggered rules and their values, as returned by NotificationRules.evaluate.
+    """
+    from email.mime.text import MIMEText
 
-    wb.save(log_file)  # Save workbook
-    print("Logged email send to Log.xlsx")
+    alertsByUser = {}
+    for rule, value in alerts:
+        alertsByUser.setdefault(rule.email, []).append(format_alert(rule, value))
 
-def printAverages(averages, body):
-    emailBody = body
-    emailBody += """
-    <h2>Averages:</h2>
-    <table class="averages-table">
-    <tr>
-    """
-    for key in averages[0].keys():
-        emailBody += f"<th>{key.capitalize()}</th>"
-    emailBody += "</tr>"
-    for average in averages:
-        emailBody += "<tr>"
-        for key in average.keys():
-            emailBody += f"<td>{average[key]}</td>"
-        emailBody += "</tr>"
-    emailBody += "</table>"
-    return emailBody
\ No newline at end of file
+    # Alerts aren't waited for, the outbox delivers them in the background
+    for email, lines in alertsByUser.items():
+        msg = MIMEText("\n".join(lines), "plain", "utf-8")
+        msg["From"] = os.getenv("EMAIL_ADDRESS")
+        msg["To"] = email
+        msg["Subject"] = "Weather Alert"
+        outbox.queue(msg, [email], f"Weather Alert with {len(lines)} conditions to {email}")
+    return len(alertsByUser)